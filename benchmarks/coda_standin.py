@@ -0,0 +1,92 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+
+def request_key(method, target):
+    """"GET /docs/x/pages?limit=100": the path with its query parameters sorted, as recordings are keyed."""
+    parts = urlsplit(target)
+    query = urlencode(sorted(parse_qsl(parts.query)))
+    return f"{method} {parts.path}" + (f"?{query}" if query else "")
+
+
+class CodaStandIn:
+    """
+    Replays recorded Coda API responses. A recording maps request keys (see request_key) to the responses to send,
+    in order; the last one is repeated once the others are used up. Each response has a status, optional headers,
+    and a JSON "body" or a "text" body, in which {base_url} is replaced with the stand-in's own address.
+    """
+
+    def __init__(self, recording_path):
+        with open(recording_path, "r", encoding="utf-8") as recording_file:
+            self.recording = json.load(recording_file)
+        self.served = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def api_url(self):
+        return f"{self.base_url}/apis/v1"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, prefix):
+        """Requests served whose key starts with prefix, e.g. "POST" for started exports."""
+        with self.lock:
+            return sum(1 for key in self.requests if key.startswith(prefix))
+
+    def next_response(self, key):
+        with self.lock:
+            self.requests.append(key)
+            responses = self.recording.get(key)
+            if not responses:
+                return {"status": 404, "body": {"statusCode": 404, "message": f"Not recorded: {key}"}}
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+            return responses[min(index, len(responses) - 1)]
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.replay("GET")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                self.replay("POST")
+
+            def replay(self, method):
+                target = self.path[len("/apis/v1"):] if self.path.startswith("/apis/v1/") else self.path
+                response = standin.next_response(request_key(method, target))
+                if "text" in response:
+                    body, content_type = response["text"], "text/markdown"
+                else:
+                    body, content_type = json.dumps(response.get("body", {})), "application/json"
+                body = body.replace("{base_url}", standin.base_url).encode("utf-8")
+                self.send_response(response["status"])
+                for name, value in response.get("headers", {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,94 @@
+import argparse
+import json
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+from benchmarks.corpus import generate_corpus, seed_index
+from benchmarks.stats import latency_summary
+from compact_store import SKIPPED_COLLECTIONS, CompactStore
+from embeddings import embed_documents
+from markdown_loader import make_valid_collection_name
+
+
+def exact_neighbours(client, names, n_results):
+    """Brute force float32 search, the ground truth both paths are scored against."""
+    truth = {}
+    for name in names:
+        page = client.get_collection(name=name).get(include=["embeddings"])
+        truth[name] = (page["ids"], np.asarray(page["embeddings"], dtype=np.float32))
+
+    def search(name, query):
+        ids, vectors = truth[name]
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        return [ids[i] for i in np.argsort(distances)[:n_results]]
+
+    return search
+
+
+def run_path(name, query, queries, search, n_results):
+    latencies = []
+    recall = 0.0
+    started = time.perf_counter()
+    for collection, embedding in queries:
+        start = time.perf_counter()
+        result = query(collection, embedding)
+        latencies.append(time.perf_counter() - start)
+        expected = search(collection, np.asarray(embedding, dtype=np.float32))
+        recall += len(set(result["ids"][0]) & set(expected)) / len(expected)
+    wall_seconds = time.perf_counter() - started
+    return {"path": name, "recall": round(recall / len(queries), 4),
+            "latency": latency_summary(latencies, wall_seconds)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the compact section store with querying chroma")
+    parser.add_argument("--db", help="Use an existing chroma index at this path instead of seeding one")
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--sections-per-category", type=int, default=250)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-results", type=int, default=5)
+    parser.add_argument("--candidates", default="8,32,128", help="Rescoring shortlist sizes to try")
+    parser.add_argument("--dtypes", default="int8,float16")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    categories, sections, questions = generate_corpus(args.categories, args.sections_per_category, seed=args.seed)
+    if args.db:
+        client = chromadb.PersistentClient(path=args.db)
+    else:
+        client = chromadb.EphemeralClient()
+        seed_index(client, categories, sections)
+
+    names = [c.name for c in client.list_collections() if c.name not in SKIPPED_COLLECTIONS]
+    # Against an existing index the synthetic questions are sent to every collection in turn
+    targets = [make_valid_collection_name(q["Category"]) if not args.db else names[i % len(names)]
+               for i, q in enumerate(questions)]
+    queries = list(zip(targets, embed_documents([q["Question"] for q in questions])))
+    search = exact_neighbours(client, names, args.n_results)
+
+    def query_chroma(collection, embedding):
+        return client.get_collection(name=collection).query(query_embeddings=[list(embedding)],
+                                                            n_results=args.n_results)
+
+    results = [run_path("chroma", query_chroma, queries, search, args.n_results)]
+    with tempfile.TemporaryDirectory() as directory:
+        for dtype in args.dtypes.split(","):
+            store = CompactStore(directory, dtype)
+            store.sync(client)
+
+            def query_store(collection, embedding):
+                return store.query_collections([collection], [embedding], args.n_results)
+
+            for candidates in (int(c) for c in args.candidates.split(",")):
+                store.candidates = candidates
+                result = run_path(f"{dtype}@{candidates}", query_store, queries, search, args.n_results)
+                result["memory"] = store.stats()
+                results.append(result)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
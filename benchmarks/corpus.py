@@ -0,0 +1,150 @@
+import csv
+import os
+import random
+
+from context import adjacency_metadata
+from markdown_loader import make_valid_collection_name, store_text_with_header
+from ingest_profile import FileProfile, add_to_collection
+
+# Vocabulary for synthetic documents. Each category draws most of its words from its own slice, so questions
+# generated from a category are routable back to it
+WORDS = (
+    "mission vision values integrity ownership curiosity kindness customer delivery software secure continuous "
+    "benefits insurance medical dental retirement match premium wellness stipend leave holiday vacation parental "
+    "onboarding laptop account buddy training orientation badge travel flight hotel receipt expense reimbursement "
+    "security clearance compliance encryption phishing incident engineering review testing release pipeline "
+    "kubernetes cluster airgap package deploy monitoring logging alert oncall runbook hiring interview offer "
+    "promotion feedback career growth mentor meeting planning roadmap quarter budget contract proposal partner"
+).split()
+
+
+def read_csv(csv_location):
+    with open(csv_location, "r", encoding="utf-8") as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def generate_corpus(categories=8, sections_per_category=20, words_per_section=120, seed=0):
+    """
+    Returns (categories, sections, questions) rows in the same shape as the CSVs in benchmarks/data:
+    Category,Description / Category,Content / Question,Category,Expected.
+    """
+    rng = random.Random(seed)
+    slice_size = max(3, len(WORDS) // categories)
+
+    category_rows = []
+    section_rows = []
+    question_rows = []
+    for c in range(categories):
+        name = f"Topic {c:03d}"
+        own_words = [WORDS[(c * slice_size + i) % len(WORDS)] for i in range(slice_size)]
+        category_rows.append({"Category": name,
+                              "Description": f"The {name} section covers " + ", ".join(own_words) + "."})
+
+        for s in range(sections_per_category):
+            marker = f"marker{c:03d}x{s:03d}"
+            words = [rng.choice(own_words) if rng.random() < 0.7 else rng.choice(WORDS)
+                     for _ in range(words_per_section)]
+            section_rows.append({"Category": name, "Content": marker + " " + " ".join(words) + "."})
+            question_rows.append({"Category": name, "Expected": marker,
+                                  "Question": "Tell me about " + " ".join(rng.sample(own_words, 3)) + "?"})
+
+    return category_rows, section_rows, question_rows
+
+
+def seed_index(chroma_client, categories, sections):
+    """
+    Builds the same layout the loaders produce: one "categories" collection holding the category descriptions and
+    one collection per category holding its sections.
+    """
+    profile = FileProfile("seed")
+    for idx, row in enumerate(categories):
+        store_text_with_header(chroma_client, row["Description"], {"category": row["Category"]}, str(idx), profile)
+
+    by_category = {}
+    for row in sections:
+        by_category.setdefault(row["Category"], []).append(row["Content"])
+
+    for category, contents in by_category.items():
+        name = make_valid_collection_name(category)
+        ids = [str(i) for i in range(len(contents))]
+        collection = chroma_client.get_or_create_collection(name=name)
+        add_to_collection(collection, profile, contents, ids, adjacency_metadata([(name, i) for i in ids]))
+
+    return profile.chunks_out
+
+
+def write_hugo_tree(root, files=200, sections=10, paragraphs=6, seed=0):
+    """Writes a Hugo style content/en/docs tree of markdown files with frontmatter titles and nested headers."""
+    rng = random.Random(seed)
+    docs = os.path.join(root, "content", "en", "docs")
+    total_bytes = 0
+    for i in range(files):
+        section_dir = os.path.join(docs, f"section-{i % sections:02d}")
+        os.makedirs(section_dir, exist_ok=True)
+
+        lines = ["---", f'title: "Page {i:04d}"', f"weight: {i}", "---", ""]
+        for h in range(paragraphs):
+            lines.append(f"{'#' * (2 + h % 3)} Heading {i:04d}.{h}")
+            lines.append("")
+            lines.append(" ".join(rng.choice(WORDS) for _ in range(80)))
+            lines.append("")
+        content = "\n".join(lines).encode("utf-8")
+        with open(os.path.join(section_dir, f"page-{i:04d}.md"), "wb") as md_file:
+            md_file.write(content)
+        total_bytes += len(content)
+    return total_bytes
+
+
+def write_text_documents(root, extension, files=50, sections=6, seed=0):
+    """Writes plain text, HTML or CSV documents of synthetic sections for the per-format parse benchmark."""
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    total_bytes = 0
+    for i in range(files):
+        bodies = [(f"Heading {i:04d}.{h}", " ".join(rng.choice(WORDS) for _ in range(120))) for h in range(sections)]
+        if extension == ".html":
+            content = "<html><head><style>p {margin: 0}</style></head><body>" + "".join(
+                f"<h2>{heading}</h2><p>{body}</p>" for heading, body in bodies) + "</body></html>"
+        elif extension == ".csv":
+            content = "Heading,Content\n" + "".join(f"{heading},{body}\n" for heading, body in bodies)
+        else:
+            content = "".join(f"{heading}\n\n{body}\n\n" for heading, body in bodies)
+        data = content.encode("utf-8")
+        with open(os.path.join(root, f"document-{i:04d}{extension}"), "wb") as output_file:
+            output_file.write(data)
+        total_bytes += len(data)
+    return total_bytes
+
+
+def write_guide_pdf(path, categories, pages=300, seed=0):
+    """
+    Writes a PDF laid out like the Coda export extract_sections expects: category and subsection headings in the
+    largest font, body text in a smaller one.
+    """
+    import fitz
+
+    rng = random.Random(seed)
+    pages_per_category = max(1, pages // len(categories))
+    pdf = fitz.open()
+    for p in range(pages):
+        page = pdf.new_page()
+        y = 60
+        category_index, offset = divmod(p, pages_per_category)
+        if offset == 0 and category_index < len(categories):
+            page.insert_text((50, y), categories[category_index], fontsize=24)
+            y += 40
+        page.insert_text((50, y), f"Subsection {p:04d}", fontsize=24)
+        y += 36
+        for _ in range(30):
+            page.insert_text((50, y), " ".join(rng.choice(WORDS) for _ in range(10)), fontsize=11)
+            y += 20
+    pdf.save(path)
+    pdf.close()
+    return os.path.getsize(path)
+
+
+def write_categories_csv(path, categories):
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Category", "Description"])
+        writer.writerows([[c, f"The {c} section of the guide."] for c in categories])
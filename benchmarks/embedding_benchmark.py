@@ -0,0 +1,136 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.stats import latency_summary
+from embeddings import make_embedder
+
+
+def embed_all(embedder, texts, batch_size):
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        vectors.extend(embedder.embed_documents(texts[start:start + batch_size]))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def normalized(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def cosine_drift(reference, candidate):
+    """1 - cosine similarity between the two backends' vectors for the same texts."""
+    drift = 1.0 - (normalized(reference) * normalized(candidate)).sum(axis=1)
+    return {"mean": round(float(drift.mean()), 6), "p99": round(float(np.percentile(drift, 99)), 6),
+            "max": round(float(drift.max()), 6)}
+
+
+def top_k(queries, documents, k):
+    # Squared L2 like chroma's default space
+    distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ documents.T + (documents ** 2).sum(axis=1)[None]
+    return np.argsort(distances, axis=1)[:, :k]
+
+
+def retrieval_agreement(reference, candidate, k):
+    """Top-1 agreement and overlap@k of the documents each question retrieves under the two sets of rankings."""
+    top1 = float((reference[:, 0] == candidate[:, 0]).mean())
+    overlap = float(np.mean([len(set(r) & set(c)) / k for r, c in zip(reference, candidate)]))
+    return {"top1": round(top1, 4), f"overlap@{k}": round(overlap, 4)}
+
+
+def latencies(embedder, questions, batch_size, repeats):
+    single = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for question in questions:
+            start = time.perf_counter()
+            embedder.embed_query(question)
+            single.append(time.perf_counter() - start)
+    single_wall = time.perf_counter() - started
+
+    batched = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for start_index in range(0, len(questions), batch_size):
+            start = time.perf_counter()
+            embedder.embed_documents(questions[start_index:start_index + batch_size])
+            batched.append(time.perf_counter() - start)
+    batched_wall = time.perf_counter() - started
+    batched_summary = latency_summary(batched, batched_wall)
+    batched_summary["texts_per_s"] = round(len(questions) * repeats / batched_wall, 3) if batched_wall else 0.0
+    return {"single": latency_summary(single, single_wall), "batched": batched_summary}
+
+
+def run_backend(name, threads, texts, questions, args):
+    embedder = make_embedder(name, threads)
+    started = time.perf_counter()
+    # Also loads the model, so the timed runs below exclude model loading
+    embedder.embed_query(questions[0])
+    load_seconds = time.perf_counter() - started
+    documents = embed_all(embedder, texts, args.batch_size)
+    queries = embed_all(embedder, questions, args.batch_size)
+    result = {"backend": name, "threads": threads, "load_seconds": round(load_seconds, 3)}
+    result.update(latencies(embedder, questions[:args.latency_questions], args.batch_size, args.repeats))
+    return result, documents, queries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare embedding backends against the PyTorch model")
+    parser.add_argument("--reference", default="sentence-transformers")
+    parser.add_argument("--backends", default="onnx,onnx-int8")
+    parser.add_argument("--threads", default="1,2,4", help="ONNX intra-op thread counts to try, 0 for the default")
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--sections-per-category", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--latency-questions", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-drift", type=float, help="Fail if any backend's mean cosine drift is above this")
+    parser.add_argument("--min-top1", type=float, help="Fail if any backend's top-1 agreement is below this")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    _, sections, question_rows = generate_corpus(args.categories, args.sections_per_category, seed=args.seed)
+    texts = [s["Content"] for s in sections]
+    questions = [q["Question"] for q in question_rows]
+
+    reference, reference_documents, reference_queries = run_backend(args.reference, 0, texts, questions, args)
+    reference_top = top_k(reference_queries, reference_documents, args.k)
+    results = [reference]
+    for name in args.backends.split(","):
+        for threads in (int(t) for t in args.threads.split(",")):
+            result, documents, queries = run_backend(name, threads, texts, questions, args)
+            result["cosine_drift"] = {"documents": cosine_drift(reference_documents, documents),
+                                      "questions": cosine_drift(reference_queries, queries)}
+            result["retrieval_agreement"] = {
+                # Both the index and the questions embedded by the backend, as after re-ingesting with it
+                "reindexed": retrieval_agreement(reference_top, top_k(queries, documents, args.k), args.k),
+                # Only the questions, against an index ingested with the reference
+                "queries_only": retrieval_agreement(reference_top, top_k(queries, reference_documents, args.k),
+                                                    args.k),
+            }
+            results.append(result)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    failures = []
+    for result in results[1:]:
+        label = f"{result['backend']}@{result['threads']}"
+        if args.max_drift is not None and result["cosine_drift"]["questions"]["mean"] > args.max_drift:
+            failures.append(f"{label} mean cosine drift {result['cosine_drift']['questions']['mean']} "
+                            f"is over {args.max_drift}")
+        if args.min_top1 is not None and result["retrieval_agreement"]["reindexed"]["top1"] < args.min_top1:
+            failures.append(f"{label} top-1 agreement {result['retrieval_agreement']['reindexed']['top1']} "
+                            f"is under {args.min_top1}")
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
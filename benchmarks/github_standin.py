@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+class GitHubStandIn:
+    """
+    Serves a local directory through the subset of the GitHub contents API fetch_markdown uses:
+    GET /repos/<owner>/<repo>/contents/<path> lists a directory, and each file's download_url serves its bytes.
+    """
+
+    def __init__(self, root, owner="owner", repo="repo"):
+        self.root = root
+        self.owner = owner
+        self.repo = repo
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def contents_url(self):
+        return f"{self.base_url}/repos/{self.owner}/{self.repo}/contents/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        standin = self
+        contents_prefix = f"/repos/{self.owner}/{self.repo}/contents/"
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                standin.requests += 1
+                path = unquote(self.path)
+                if path.startswith(contents_prefix):
+                    self.list_directory(path[len(contents_prefix):].strip("/"))
+                elif path.startswith("/raw/"):
+                    self.send_file(path[len("/raw/"):])
+                else:
+                    self.send_error(404)
+
+            def list_directory(self, relative):
+                directory = os.path.join(standin.root, relative)
+                if not os.path.isdir(directory):
+                    self.send_error(404)
+                    return
+                entries = []
+                for name in sorted(os.listdir(directory)):
+                    entry_path = f"{relative}/{name}" if relative else name
+                    is_dir = os.path.isdir(os.path.join(directory, name))
+                    entries.append({
+                        "name": name,
+                        "path": entry_path,
+                        "type": "dir" if is_dir else "file",
+                        "download_url": None if is_dir else f"{standin.base_url}/raw/{entry_path}",
+                    })
+                self.send_body(json.dumps(entries).encode("utf-8"), "application/json")
+
+            def send_file(self, relative):
+                file_path = os.path.join(standin.root, relative)
+                if not os.path.isfile(file_path):
+                    self.send_error(404)
+                    return
+                with open(file_path, "rb") as f:
+                    self.send_body(f.read(), "text/markdown")
+
+            def send_body(self, body, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import chromadb
+
+from benchmarks.corpus import (write_categories_csv, write_guide_pdf,
+                               write_hugo_tree, write_text_documents)
+from benchmarks.github_standin import GitHubStandIn
+from benchmarks.resources import ProcessSampler
+from ingest_profile import IngestionProfiler
+
+
+def measure(name, run):
+    profiler = IngestionProfiler(f"bench-{name}")
+    with ProcessSampler(interval=0.1) as sampler:
+        started = time.perf_counter()
+        run(profiler)
+        wall_seconds = time.perf_counter() - started
+
+    report = profiler.report()
+    totals = report["totals"]
+    # Directory listings and other run level entries have no bytes of their own, so they don't count as files
+    files = sum(1 for f in report["files"] if f["bytes_in"])
+    return {
+        "phase": name,
+        "wall_seconds": round(wall_seconds, 3),
+        "files": files,
+        "errors": totals["errors"],
+        "bytes_in": totals["bytes_in"],
+        "chunks": totals["chunks_out"],
+        "files_per_s": round(files / wall_seconds, 3),
+        "chunks_per_s": round(totals["chunks_out"] / wall_seconds, 3),
+        "mb_per_s": round(totals["bytes_in"] / 2 ** 20 / wall_seconds, 3),
+        "peak_rss_mb": sampler.summary().get("peak_rss_mb"),
+        "stages": totals["stages"],
+    }
+
+
+def bench_markdown(workdir, args):
+    from markdown_loader import load_markdown_data
+
+    tree = os.path.join(workdir, "markdown")
+    write_hugo_tree(tree, files=args.md_files, seed=args.seed)
+    client = chromadb.PersistentClient(path=os.path.join(workdir, "db-markdown"))
+    with GitHubStandIn(tree) as github:
+        return measure("markdown", lambda profiler: load_markdown_data(client, github.contents_url, profiler))
+
+
+def bench_doug(workdir, args):
+    from doug_loader import load_doug_data
+
+    categories = [f"Category {i:02d}" for i in range(args.categories)]
+    csv_location = os.path.join(workdir, "categories.csv")
+    pdf_location = os.path.join(workdir, "guide.pdf")
+    write_categories_csv(csv_location, categories)
+    write_guide_pdf(pdf_location, categories, pages=args.pdf_pages, seed=args.seed)
+    client = chromadb.PersistentClient(path=os.path.join(workdir, "db-doug"))
+    return measure("doug", lambda profiler: load_doug_data(client, csv_location, pdf_location, profiler))
+
+
+def bench_directory(workdir, args):
+    import ingest
+
+    folder = os.path.join(workdir, "preload")
+    os.makedirs(folder, exist_ok=True)
+    categories = [f"Category {i:02d}" for i in range(args.categories)]
+    for i in range(args.local_pdfs):
+        write_guide_pdf(os.path.join(folder, f"document-{i:03d}.pdf"), categories, pages=args.local_pdf_pages,
+                        seed=args.seed + i)
+    write_hugo_tree(folder, files=args.local_md_files, seed=args.seed)
+
+    client = chromadb.PersistentClient(path=os.path.join(workdir, "db-directory"))
+    collection = client.get_or_create_collection(name="default")
+    ingestor = ingest.Ingest("bench", client, collection)
+    result = measure("directory", lambda profiler: ingestor.load_data(folder, profiler))
+    # Nothing changed, so every file should be skipped on its fingerprint without being parsed
+    result["unchanged"] = measure("directory-unchanged", lambda profiler: ingestor.load_data(folder, profiler))
+    return result
+
+
+def bench_formats(workdir, args):
+    """Parse throughput of each format on its own, without chunking, embedding or writing."""
+    from file_loaders import parse_file
+
+    folder = os.path.join(workdir, "formats")
+    categories = [f"Category {i:02d}" for i in range(args.categories)]
+    write_hugo_tree(os.path.join(folder, "md"), files=args.format_files, seed=args.seed)
+    for extension in (".txt", ".html", ".csv"):
+        write_text_documents(os.path.join(folder, extension.lstrip(".")), extension, files=args.format_files,
+                             seed=args.seed)
+    os.makedirs(os.path.join(folder, "pdf"), exist_ok=True)
+    for i in range(max(1, args.format_files // 20)):
+        write_guide_pdf(os.path.join(folder, "pdf", f"document-{i:03d}.pdf"), categories,
+                        pages=args.local_pdf_pages, seed=args.seed + i)
+
+    results = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            extension = os.path.splitext(name)[1].lower()
+            started = time.perf_counter()
+            records = sum(1 for _ in parse_file(path))
+            totals = results.setdefault(extension, {"files": 0, "bytes": 0, "records": 0, "seconds": 0.0})
+            totals["seconds"] += time.perf_counter() - started
+            totals["files"] += 1
+            totals["records"] += records
+            totals["bytes"] += os.path.getsize(path)
+
+    formats = []
+    for extension, totals in sorted(results.items()):
+        seconds = totals["seconds"]
+        formats.append({"format": extension, **totals, "seconds": round(seconds, 3),
+                        "files_per_s": round(totals["files"] / seconds, 3) if seconds else 0.0,
+                        "records_per_s": round(totals["records"] / seconds, 3) if seconds else 0.0,
+                        "mb_per_s": round(totals["bytes"] / 2 ** 20 / seconds, 3) if seconds else 0.0})
+    return {"phase": "formats", "formats": formats}
+
+
+PHASES = {"markdown": bench_markdown, "doug": bench_doug, "directory": bench_directory, "formats": bench_formats}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ingestion throughput on a synthetic corpus")
+    parser.add_argument("--phases", default="markdown,doug,directory,formats")
+    parser.add_argument("--md-files", type=int, default=200)
+    parser.add_argument("--pdf-pages", type=int, default=300)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--local-pdfs", type=int, default=5)
+    parser.add_argument("--local-pdf-pages", type=int, default=50)
+    parser.add_argument("--local-md-files", type=int, default=20)
+    parser.add_argument("--format-files", type=int, default=100, help="Files per format for the formats phase")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="Keep the generated corpus and indexes")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="eight-ball-ingest-bench-")
+    try:
+        results = [PHASES[phase](workdir, args) for phase in args.phases.split(",")]
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
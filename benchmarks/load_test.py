@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import chromadb
+import httpx
+
+from benchmarks.corpus import generate_corpus, seed_index
+from benchmarks.resources import ProcessSampler
+from benchmarks.stats import latency_summary
+from deadlines import DEADLINE_HEADER
+from index_generations import IndexGenerations
+from memory import chroma_settings
+
+# Relative change beyond which compare() flags a metric as a regression
+DEFAULT_TOLERANCE = 0.10
+
+
+def build_query_mix(questions, size, seed=0, skew=1.1):
+    # Zipf weighted, so a few questions dominate the way popular questions do in real traffic
+    rng = random.Random(seed)
+    texts = [q["Question"] for q in questions]
+    rng.shuffle(texts)
+    weights = [1 / (rank + 1) ** skew for rank in range(len(texts))]
+    return rng.choices(texts, weights=weights, k=size)
+
+
+def save_mix(path, mix):
+    with open(path, "w", encoding="utf-8") as mix_file:
+        for text in mix:
+            mix_file.write(json.dumps({"input": text}) + "\n")
+
+
+def load_mix(path):
+    with open(path, "r", encoding="utf-8") as mix_file:
+        return [json.loads(line)["input"] for line in mix_file if line.strip()]
+
+
+async def send(client, text, started, results):
+    start = time.perf_counter()
+    try:
+        response = await client.post("/query/", json={"input": text, "collection_name": "default"})
+        status = response.status_code
+        degraded = status == 200 and response.json().get("execution", {}).get("degraded", False)
+    except Exception as e:
+        status = type(e).__name__
+        degraded = False
+    results.append({"t": start - started, "latency": time.perf_counter() - start, "status": status,
+                    "degraded": degraded})
+
+
+async def closed_loop(client, mix, concurrency, duration, max_requests):
+    """Each of `concurrency` users sends its next request as soon as the previous one returns."""
+    results = []
+    started = time.perf_counter()
+    position = iter(range(max_requests))
+
+    async def user():
+        for i in position:
+            if time.perf_counter() - started > duration:
+                return
+            await send(client, mix[i % len(mix)], started, results)
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+async def open_loop(client, mix, rate, duration, max_requests, seed=0):
+    """Requests arrive as a Poisson process at `rate` per second regardless of how fast earlier ones finish."""
+    rng = random.Random(seed)
+    results = []
+    tasks = []
+    started = time.perf_counter()
+    next_arrival = 0.0
+    for i in range(max_requests):
+        if next_arrival > duration:
+            break
+        delay = next_arrival - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, mix[i % len(mix)], started, results)))
+        next_arrival += rng.expovariate(rate)
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - started
+
+
+def summarize(results, wall_seconds):
+    ok = [r["latency"] for r in results if r["status"] == 200]
+    status_counts = {}
+    for r in results:
+        status_counts[str(r["status"])] = status_counts.get(str(r["status"]), 0) + 1
+    return {
+        "requests": len(results),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_s": round(len(ok) / wall_seconds, 3) if wall_seconds else 0.0,
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        # Answered from a fallback because a stage ran out of its deadline
+        "degraded_rate": round(sum(1 for r in results if r.get("degraded")) / len(ok), 4) if ok else 0.0,
+        "status_counts": status_counts,
+        "latency": latency_summary(ok, wall_seconds),
+    }
+
+
+def compare(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    checks = [
+        ("throughput_per_s", baseline["throughput_per_s"], current["throughput_per_s"], False),
+        ("p50_ms", baseline["latency"]["p50_ms"], current["latency"]["p50_ms"], True),
+        ("p95_ms", baseline["latency"]["p95_ms"], current["latency"]["p95_ms"], True),
+        ("p99_ms", baseline["latency"]["p99_ms"], current["latency"]["p99_ms"], True),
+    ]
+    comparison = {}
+    for name, old, new, higher_is_worse in checks:
+        change = (new - old) / old if old else 0.0
+        regressed = change > tolerance if higher_is_worse else change < -tolerance
+        comparison[name] = {"baseline": old, "current": new, "change": round(change, 4), "regressed": regressed}
+
+    error_change = current["error_rate"] - baseline["error_rate"]
+    comparison["error_rate"] = {"baseline": baseline["error_rate"], "current": current["error_rate"],
+                                "change": round(error_change, 4), "regressed": error_change > 0.01}
+    return comparison
+
+
+def seed_local_index(db_path, args):
+    categories, sections, questions = generate_corpus(args.categories, args.sections_per_category, seed=args.seed)
+    # Seed a generation and make it live, the layout DocumentStore serves from
+    generations = IndexGenerations(db_path)
+    generation = generations.create()
+    seed_index(chromadb.PersistentClient(path=generations.path(generation), settings=chroma_settings()), categories,
+               sections)
+    generations.promote(generation)
+    return questions
+
+
+def make_client(args):
+    headers = {DEADLINE_HEADER: str(args.deadline_ms)} if args.deadline_ms else {}
+    if args.url:
+        return httpx.AsyncClient(base_url=args.url, timeout=args.timeout, headers=headers)
+
+    # Serve main.app in-process. It reads its settings at import time, so point it at the seeded index first
+    os.environ["CHROMA_DB_PATH"] = args.db
+    os.environ["PRELOAD_DOCUMENTS"] = "0"
+    import main
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://loadtest",
+                             timeout=args.timeout, headers=headers)
+
+
+async def run(args, mix):
+    async with make_client(args) as client:
+        # One request to load models before measuring
+        await client.post("/query/", json={"input": mix[0], "collection_name": "default"})
+        with ProcessSampler(args.pid, args.sample_interval) as sampler:
+            if args.arrival == "closed":
+                results, wall_seconds = await closed_loop(client, mix, args.concurrency, args.duration, args.requests)
+            else:
+                results, wall_seconds = await open_loop(client, mix, args.rate, args.duration, args.requests,
+                                                        args.seed)
+    report = summarize(results, wall_seconds)
+    report["resources"] = sampler.summary()
+    report["config"] = {k: v for k, v in vars(args).items() if k not in ("compare", "output")}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the /query/ endpoint")
+    parser.add_argument("--url", help="Target a running service instead of serving main.app in-process")
+    parser.add_argument("--pid", type=int, help="Process to sample CPU/RSS from (defaults to this process)")
+    parser.add_argument("--db", help="Existing chroma index to serve in-process; a synthetic one is seeded if unset")
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--sections-per-category", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mix", help="Replay the queries in this JSONL file")
+    parser.add_argument("--record-mix", help="Write the generated query mix to this JSONL file")
+    parser.add_argument("--mix-size", type=int, default=1000)
+    parser.add_argument("--arrival", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent users for the closed model")
+    parser.add_argument("--rate", type=float, default=20.0, help="Requests per second for the open model")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--requests", type=int, default=100000, help="Stop after this many requests")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--deadline-ms", type=float, help="Query deadline sent with every request")
+    parser.add_argument("--sample-interval", type=float, default=0.5)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--compare", help="Baseline report to compare this run against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    if args.url is None and args.db is None:
+        args.db = tempfile.mkdtemp(prefix="eight-ball-loadtest-")
+        questions = seed_local_index(args.db, args)
+    else:
+        _, _, questions = generate_corpus(args.categories, args.sections_per_category, seed=args.seed)
+
+    mix = load_mix(args.mix) if args.mix else build_query_mix(questions, args.mix_size, args.seed)
+    if args.record_mix:
+        save_mix(args.record_mix, mix)
+
+    report = asyncio.run(run(args, mix))
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as baseline_file:
+            report["comparison"] = compare(json.load(baseline_file), report, args.tolerance)
+
+    print(json.dumps({k: v for k, v in report.items() if k != "resources"}, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if any(c["regressed"] for c in report.get("comparison", {}).values()):
+        print("Regression detected against the baseline")
+        sys.exit(1)
@@ -0,0 +1,65 @@
+import os
+import resource
+import threading
+import time
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def read_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as stat_file:
+        # The command name may contain spaces, so split after its closing parenthesis
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def read_rss_bytes(pid):
+    with open(f"/proc/{pid}/statm", "r", encoding="utf-8") as statm_file:
+        return int(statm_file.read().split()[1]) * PAGE_SIZE
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ProcessSampler:
+    """Samples CPU utilisation and RSS of a process (this one by default) on a background thread."""
+
+    def __init__(self, pid=None, interval=0.5):
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        started = last_time = time.perf_counter()
+        last_cpu = read_cpu_seconds(self.pid)
+        while not self.stopped.wait(self.interval):
+            now = time.perf_counter()
+            cpu = read_cpu_seconds(self.pid)
+            self.samples.append({
+                "t": round(now - started, 3),
+                "cpu_percent": round((cpu - last_cpu) / (now - last_time) * 100, 1),
+                "rss_mb": round(read_rss_bytes(self.pid) / 2 ** 20, 1),
+            })
+            last_time, last_cpu = now, cpu
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return {"samples": []}
+        return {
+            "mean_cpu_percent": round(sum(s["cpu_percent"] for s in self.samples) / len(self.samples), 1),
+            "peak_rss_mb": max(s["rss_mb"] for s in self.samples),
+            "samples": self.samples,
+        }
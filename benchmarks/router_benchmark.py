@@ -0,0 +1,93 @@
+import argparse
+import json
+import time
+
+import chromadb
+
+from benchmarks.corpus import read_csv, seed_index
+from benchmarks.stats import latency_summary
+from category_router import EmbeddingRouter, GenerativeRouter, make_chooser
+from markdown_loader import query_category
+
+
+def build_router(strategy, chroma_client, args):
+    if strategy == "embedding":
+        return EmbeddingRouter(chroma_client)
+    if strategy == "generative":
+        return GenerativeRouter(make_chooser(args.chooser, args.model, args.device), args.categories)
+    raise ValueError(f"Unknown routing strategy {strategy}")
+
+
+def run_strategy(router, chroma_client, questions, k, warmup):
+    # Warm up on the first questions so model loading is not counted as routing latency
+    for row in questions[:warmup]:
+        router.route(row["Question"], k)
+
+    routing_seconds = []
+    end_to_end_seconds = []
+    top1 = topk = hits = with_expected = 0
+
+    started = time.perf_counter()
+    for row in questions:
+        start = time.perf_counter()
+        categories = router.route(row["Question"], k)
+        routed = time.perf_counter()
+
+        answer = ""
+        if categories:
+            result = query_category(chroma_client, categories[0], row["Question"])
+            answer = result["documents"][0][0] if result["documents"][0] else ""
+        end = time.perf_counter()
+
+        routing_seconds.append(routed - start)
+        end_to_end_seconds.append(end - start)
+        top1 += int(bool(categories) and categories[0] == row["Category"])
+        topk += int(row["Category"] in categories)
+        if row.get("Expected"):
+            with_expected += 1
+            hits += int(row["Expected"].lower() in answer.lower())
+    wall_seconds = time.perf_counter() - started
+
+    return {
+        "strategy": router.name,
+        "questions": len(questions),
+        "top1_accuracy": round(top1 / len(questions), 4),
+        f"top{k}_accuracy": round(topk / len(questions), 4),
+        "retrieval_hit_rate": round(hits / with_expected, 4) if with_expected else None,
+        "routing": latency_summary(routing_seconds),
+        "end_to_end": latency_summary(end_to_end_seconds, wall_seconds),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark embedding against generative category routing")
+    parser.add_argument("--questions", default="benchmarks/data/router_questions.csv",
+                        help="CSV of Question,Category[,Expected] rows")
+    parser.add_argument("--categories", default="benchmarks/data/categories.csv")
+    parser.add_argument("--sections", default="benchmarks/data/sections.csv",
+                        help="CSV of Category,Content rows used to seed an in-memory index")
+    parser.add_argument("--db", help="Use an existing chroma index at this path instead of seeding one")
+    parser.add_argument("--strategies", default="embedding,generative")
+    parser.add_argument("--chooser", choices=["keyword", "scoring", "outlines"], default="keyword",
+                        help="keyword is a deterministic offline stand-in for the generative model")
+    parser.add_argument("--model", default="Qwen/Qwen1.5-0.5B-Chat")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.db:
+        client = chromadb.PersistentClient(path=args.db)
+    else:
+        client = chromadb.EphemeralClient()
+        seed_index(client, read_csv(args.categories), read_csv(args.sections))
+
+    labelled = read_csv(args.questions)
+    results = [run_strategy(build_router(s, client, args), client, labelled, args.k, args.warmup)
+               for s in args.strategies.split(",")]
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import generate_corpus
+
+# Modules only document loading or the generative router need. Importing the service must not load them
+LAZY_MODULES = (
+    "langchain.document_loaders",
+    "langchain.text_splitter",
+    "langchain.vectorstores",
+    "unstructured",
+    "outlines",
+    "transformers",
+    "tiktoken",
+    "fitz",
+    "codaio",
+)
+
+# Run in a fresh interpreter so nothing the benchmark itself imported is counted
+FIRST_REQUEST = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+
+import httpx
+from benchmarks.resources import peak_rss_bytes, read_rss_bytes
+
+async def send():
+    transport = httpx.ASGITransport(app={module}.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://startup") as client:
+        response = await client.post("/query/", json={{"input": {question!r}, "collection_name": "default"}})
+        return response.status_code
+
+status = asyncio.run(send())
+answered = time.perf_counter()
+print(json.dumps({{
+    "import_seconds": imported - started,
+    "first_request_seconds": answered - started,
+    "status": status,
+    "rss_bytes": read_rss_bytes("self"),
+    "peak_rss_bytes": peak_rss_bytes(),
+    "lazy_modules_loaded": sorted(m for m in {lazy!r} if m in sys.modules),
+}}))
+"""
+
+
+def loaded_after_import(modules, watched=LAZY_MODULES, env=None):
+    """Imports modules in a fresh interpreter and returns which of the watched modules that loaded."""
+    code = (f"import sys, json; import {', '.join(modules)}; "
+            f"print(json.dumps(sorted(m for m in {tuple(watched)!r} if m in sys.modules)))")
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True, env=env)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def import_times(module, env=None, top=15):
+    """Parses `python -X importtime` output into the total and the slowest direct imports of module."""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                            text=True, env=env)
+    rows = []
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append({"module": name.strip(), "depth": (len(name) - len(name.lstrip(" ")) - 1) // 2,
+                     "self_ms": round(int(self_us) / 1000, 3), "cumulative_ms": round(int(cumulative_us) / 1000, 3)})
+    total = next((r["cumulative_ms"] for r in rows if r["module"] == module), None)
+    # Depth 1 are the imports module makes itself, so their cumulative times add up to most of its import time
+    direct = sorted((r for r in rows if r["depth"] == 1), key=lambda r: r["cumulative_ms"], reverse=True)
+    return {"module": module, "total_ms": total, "slowest": direct[:top],
+            "error": output.stderr[-2000:] if output.returncode else None}
+
+
+def first_request(module, question, env=None):
+    code = FIRST_REQUEST.format(module=module, question=question, lazy=LAZY_MODULES)
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+    if output.returncode:
+        raise RuntimeError(f"First request failed:\n{output.stderr[-2000:]}")
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    # Includes interpreter start up, which the in-process timings cannot see
+    result["process_seconds"] = time.perf_counter() - started
+    return result
+
+
+def check(report, args):
+    failures = []
+    if report["lazy_modules_loaded"]:
+        failures.append(f"Lazy modules loaded at startup: {', '.join(report['lazy_modules_loaded'])}")
+    limits = [("import_seconds", args.max_import_seconds), ("first_request_seconds", args.max_first_request_seconds)]
+    for name, limit in limits:
+        if limit and report[name] > limit:
+            failures.append(f"{name} {report[name]:.2f} is over {limit:.2f}")
+    if args.max_rss_mb and report["rss_bytes"] > args.max_rss_mb * 1024 * 1024:
+        failures.append(f"RSS {report['rss_bytes'] / 1024 / 1024:.0f} MB is over {args.max_rss_mb:.0f} MB")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure service import time, time to first request and RSS")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--db", help="Existing chroma index to serve; a synthetic one is seeded if unset")
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--sections-per-category", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-import-seconds", type=float)
+    parser.add_argument("--max-first-request-seconds", type=float)
+    parser.add_argument("--max-rss-mb", type=float)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    _, _, questions = generate_corpus(args.categories, args.sections_per_category, seed=args.seed)
+    if args.db is None:
+        # Imported here: seeding loads chroma and the embedding model into this process, not the measured one
+        from benchmarks.load_test import seed_local_index
+        args.db = tempfile.mkdtemp(prefix="eight-ball-startup-")
+        seed_local_index(args.db, args)
+
+    env = dict(os.environ, CHROMA_DB_PATH=args.db, PRELOAD_DOCUMENTS="0", INDEX_REBUILD_INTERVAL="0")
+    report = first_request(args.module, questions[0]["Question"], env)
+    report["imports"] = import_times(args.module, env)
+    report["failures"] = check(report, args)
+
+    print(json.dumps({k: v for k, v in report.items() if k != "imports"}, indent=2))
+    print(json.dumps(report["imports"]["slowest"], indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if report["failures"]:
+        print("\n".join(report["failures"]))
+        sys.exit(1)
@@ -0,0 +1,22 @@
+import math
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile, so p99 of a small sample is an observed value rather than an interpolation
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(seconds, wall_seconds=None):
+    total = wall_seconds if wall_seconds is not None else sum(seconds)
+    return {
+        "count": len(seconds),
+        "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+        "p95_ms": round(percentile(seconds, 95) * 1000, 3),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+        "max_ms": round(max(seconds) * 1000, 3) if seconds else 0.0,
+        "throughput_per_s": round(len(seconds) / total, 3) if total else 0.0,
+    }
@@ -0,0 +1,203 @@
+import csv
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+
+from embeddings import embed_documents
+
+CATEGORIES_CSV = os.environ.get("CATEGORIES_CSV", "metadata/dougs_guide_categories.csv")
+# "scoring" ranks every category in one batched forward pass, "outlines" constrains generation to a category,
+# "keyword" is the offline stand-in
+ROUTER_CHOOSER = os.environ.get("ROUTER_CHOOSER", "scoring")
+ROUTER_MODEL = os.environ.get("ROUTER_MODEL", "Qwen/Qwen1.5-0.5B-Chat")
+ROUTER_DEVICE = os.environ.get("ROUTER_DEVICE", "cpu")
+
+PROMPT = "Which one of these items is most relevant to this question: {question}"
+# The categories are listed before the question so the KV cache for everything up to the question can be reused
+SCORING_PREFIX = "Here are the topics of a guide:\n{choices}\nPick the topic most relevant to a question.\n"
+SCORING_QUESTION = "Question: {question}\nTopic:"
+
+
+@lru_cache(maxsize=None)
+def load_categories(csv_location=CATEGORIES_CSV):
+    with open(csv_location, "r", encoding="utf-8") as csv_file:
+        return tuple({key: row[key] for key in row.keys()} for row in csv.DictReader(csv_file))
+
+
+class EmbeddingRouter:
+    """Picks categories by similarity search over the "categories" collection."""
+
+    name = "embedding"
+
+    def __init__(self, chroma_client):
+        self.chroma_client = chroma_client
+
+    def route(self, text, k=1, query_embedding=None):
+        try:
+            collection = self.chroma_client.get_collection(name="categories")
+        except ValueError:
+            # An index of watched files alone has no categories, only the default collection
+            return []
+        if query_embedding is None:
+            query_embedding = embed_documents([text])[0]
+        results = collection.query(query_embeddings=[list(query_embedding)], n_results=k)
+        return [m['category'] for m in results["metadatas"][0]]
+
+
+class OutlinesChooser:
+    """Constrains a transformers model to answer with one of the choices."""
+
+    def __init__(self, model_name=ROUTER_MODEL, device=ROUTER_DEVICE):
+        self.model_name = model_name
+        self.device = device
+        self.model = None
+
+    def choose(self, question, choices, k=1):
+        import outlines.models as models
+        import outlines.text.generate as generate
+
+        if self.model is None:
+            self.model = models.transformers(self.model_name, device=self.device)
+        return [generate.choice(model=self.model, choices=list(choices))(PROMPT.format(question=question))]
+
+
+class ScoringChooser:
+    """
+    Ranks the choices by the length-normalised log-likelihood a causal language model gives each one as the
+    answer. The instruction and choice list are a fixed prefix whose KV cache is computed once, so a query only
+    runs the question tokens and then all choices together in one batched forward pass.
+    """
+
+    def __init__(self, model_name=ROUTER_MODEL, device=ROUTER_DEVICE):
+        self.model_name = model_name
+        self.device = device
+        self.model = None
+        self.tokenizer = None
+        self.prefixes = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        with self.lock:
+            if self.model is None:
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                model = AutoModelForCausalLM.from_pretrained(self.model_name)
+                self.model = model.to(self.device).eval()
+
+    def prefix(self, choices):
+        """KV cache of the shared prompt prefix and the padded choice token ids, computed once per choice list."""
+        import torch
+
+        key = tuple(choices)
+        with self.lock:
+            if key in self.prefixes:
+                return self.prefixes[key]
+
+            listing = "\n".join(f"- {c}" for c in choices)
+            prefix_ids = self.tokenizer(SCORING_PREFIX.format(choices=listing), return_tensors="pt").input_ids
+            with torch.inference_mode():
+                past = self.model(prefix_ids.to(self.device), use_cache=True).past_key_values
+
+            choice_ids = [self.tokenizer(" " + c, add_special_tokens=False).input_ids for c in choices]
+            lengths = torch.tensor([len(ids) for ids in choice_ids])
+            # Right padding: causal attention keeps the real tokens from ever seeing the pad tokens after them
+            padded = torch.zeros((len(choices), int(lengths.max())), dtype=torch.long)
+            for i, ids in enumerate(choice_ids):
+                padded[i, :len(ids)] = torch.tensor(ids)
+
+            self.prefixes[key] = (_legacy_cache(past), padded.to(self.device), lengths.to(self.device))
+            return self.prefixes[key]
+
+    def scores(self, question, choices):
+        import torch
+
+        if self.model is None:
+            self.load()
+        past, choice_ids, lengths = self.prefix(choices)
+        question_ids = self.tokenizer(SCORING_QUESTION.format(question=question), add_special_tokens=False,
+                                      return_tensors="pt").input_ids.to(self.device)
+
+        with torch.inference_mode():
+            output = self.model(question_ids, past_key_values=self._cache(past), use_cache=True)
+            context = _legacy_cache(output.past_key_values)
+            # The question's last position predicts every choice's first token
+            first = torch.log_softmax(output.logits[0, -1], dim=-1)[choice_ids[:, 0]]
+
+            batch = choice_ids.shape[0]
+            expanded = tuple(tuple(t.expand(batch, *t.shape[1:]) for t in layer) for layer in context)
+            logits = self.model(choice_ids, past_key_values=self._cache(expanded)).logits
+
+            # Position j predicts token j + 1 of each choice; pad positions are masked out of the sum
+            rest = torch.log_softmax(logits[:, :-1], dim=-1).gather(2, choice_ids[:, 1:, None]).squeeze(2)
+            mask = torch.arange(rest.shape[1], device=self.device)[None, :] < (lengths[:, None] - 1)
+            total = first + (rest * mask).sum(dim=1)
+        return (total / lengths).tolist()
+
+    def choose(self, question, choices, k=1):
+        scores = self.scores(question, list(choices))
+        ranked = sorted(range(len(choices)), key=lambda i: scores[i], reverse=True)
+        return [choices[i] for i in ranked[:k]]
+
+    def _cache(self, legacy):
+        # transformers 4.36+ models take a Cache object; older ones take the tuples directly.
+        # A fresh cache per call, since the model appends to it and the prefix must stay untouched
+        try:
+            from transformers import DynamicCache
+        except ImportError:
+            return legacy
+        return DynamicCache.from_legacy_cache(legacy)
+
+
+class KeywordChooser:
+    """
+    Deterministic stand-in for a generative model: ranks choices by word overlap with the question.
+    Lets the generative routing path be exercised offline and on CPU-only machines.
+    """
+
+    def choose(self, question, choices, k=1):
+        question_words = _words(question)
+        scores = [(len(question_words & _words(choice)), -i) for i, choice in enumerate(choices)]
+        ranked = sorted(range(len(choices)), key=lambda i: scores[i], reverse=True)
+        return [choices[i] for i in ranked[:k]]
+
+
+class GenerativeRouter:
+    """Asks a chooser (a generative model or a stub) which category description best fits the question."""
+
+    name = "generative"
+
+    def __init__(self, chooser=None, csv_location=CATEGORIES_CSV):
+        self.chooser = chooser if chooser is not None else make_chooser()
+        self.csv_location = csv_location
+        # When a question was last routed, so an idle model can be unloaded to save memory
+        self.last_used = None
+
+    def route(self, text, k=1, query_embedding=None):
+        self.last_used = time.monotonic()
+        categories = load_categories(self.csv_location)
+        descriptions = [d["Description"] for d in categories]
+        chosen = self.chooser.choose(text, descriptions, k)
+
+        by_description = {d["Description"]: d["Category"] for d in categories}
+        return [by_description[c] for c in chosen if c in by_description]
+
+
+def make_chooser(name=ROUTER_CHOOSER, model_name=ROUTER_MODEL, device=ROUTER_DEVICE):
+    if name == "scoring":
+        return ScoringChooser(model_name, device)
+    if name == "outlines":
+        return OutlinesChooser(model_name, device)
+    if name == "keyword":
+        return KeywordChooser()
+    raise ValueError(f"Unknown router chooser {name}")
+
+
+def _legacy_cache(past):
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def _words(text):
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
@@ -14,6 +14,12 @@ class CodaIngester:
     def list_document_sections(self, id):
         return self.get_document(id).list_sections()
 
+    def sync(self, chroma_client, id, profiler=None):
+        """Brings the index in line with a doc, fetching only the pages changed since the last sync."""
+        from coda_sync import CodaSync
+
+        return CodaSync(id, api_key=os.environ.get("CODA_API_KEY")).sync(chroma_client, profiler)
+
 
 def extract_sections(filePath, start_keywords):
     pdf = fitz.open(filePath)
@@ -0,0 +1,274 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from context import adjacency_metadata
+from file_loaders import markdown_sections
+from ingest_profile import IngestionProfiler, add_to_collection
+from markdown_loader import CHUNK_OVERLAP, CHUNK_SIZE, make_valid_collection_name
+
+CODA_API_URL = os.environ.get("CODA_API_URL", "https://coda.io/apis/v1")
+CODA_DOC_ID = os.environ.get("CODA_DOC_ID", "")
+# Pages exported at once; also the size of the connection pool
+CODA_CONCURRENCY = int(os.environ.get("CODA_CONCURRENCY", "8"))
+# Pages per listing request, at most 100
+CODA_PAGE_LIMIT = int(os.environ.get("CODA_PAGE_LIMIT", "100"))
+CODA_EXPORT_TIMEOUT = float(os.environ.get("CODA_EXPORT_TIMEOUT", "120"))
+EXPORT_POLL_SECONDS = 0.5
+REQUEST_TIMEOUT = 30
+
+# Metadata keys every chunk from Coda carries; the per-page sync state lives in the index itself, and is copied into
+# each new index generation with it
+DOC_KEY = "coda_doc"
+PAGE_KEY = "coda_page"
+UPDATED_KEY = "coda_updated_at"
+# Metadata key of each Coda category: JSON of page id -> updatedAt for its pages as last synced, empty ones included
+PAGES_KEY = "coda_pages"
+
+
+def make_session(api_key, concurrency=CODA_CONCURRENCY):
+    """A pooled session that retries rate limited (429) and failed requests, honouring Retry-After."""
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET", "POST"), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if api_key:
+        session.headers["Authorization"] = f"Bearer {api_key}"
+    return session
+
+
+class CodaSync:
+    """
+    Syncs a Coda doc into the index through the Coda API. Each top level page is a category: its name and subtitle
+    go into the "categories" collection, and the markdown of it and every page under it into that category's section
+    collection, split at headings. Pages whose updatedAt has not changed since they were stored are not fetched.
+    """
+
+    def __init__(self, doc_id=CODA_DOC_ID, api_key=None, api_url=CODA_API_URL, concurrency=CODA_CONCURRENCY,
+                 descriptions=None):
+        if not doc_id:
+            raise ValueError("A Coda doc id is needed, see CODA_DOC_ID")
+        self.doc_id = doc_id
+        self.api_url = api_url.rstrip("/")
+        self.concurrency = concurrency
+        # Category name -> description, e.g. from the categories CSV; otherwise the page subtitle is used
+        self.descriptions = descriptions or {}
+        # The connection pool is thread safe, so the export threads share one session
+        self.session = make_session(api_key if api_key is not None else os.environ.get("CODA_API_KEY"),
+                                    concurrency)
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        response = self.session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def list_pages(self):
+        pages = []
+        params = {"limit": CODA_PAGE_LIMIT}
+        while True:
+            body = self.request("GET", f"{self.api_url}/docs/{self.doc_id}/pages", params=params).json()
+            pages.extend(body.get("items", []))
+            if not body.get("nextPageToken"):
+                return pages
+            params = {"limit": CODA_PAGE_LIMIT, "pageToken": body["nextPageToken"]}
+
+    def export_page(self, page_id):
+        """The page as markdown. Exports are asynchronous: one request starts it, then it is polled until ready."""
+        url = f"{self.api_url}/docs/{self.doc_id}/pages/{page_id}/export"
+        export = self.request("POST", url, json={"outputFormat": "markdown"}).json()
+        deadline = time.monotonic() + CODA_EXPORT_TIMEOUT
+        while export.get("status") != "complete":
+            if export.get("status") == "failed":
+                raise RuntimeError(f"Export of page {page_id} failed. {export.get('error')}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Export of page {page_id} did not finish in {CODA_EXPORT_TIMEOUT} seconds")
+            time.sleep(EXPORT_POLL_SECONDS)
+            export = self.request("GET", f"{url}/{export['id']}").json()
+        # The download link is pre-signed, and storage services reject a second form of auth
+        return self.request("GET", export["downloadLink"], headers={"Authorization": None}).text
+
+    def stored_pages(self, client):
+        """Page id -> (updatedAt, collection) of every page of this doc in the index, from its categories' page maps."""
+        try:
+            categories = client.get_collection(name="categories")
+        except ValueError:
+            return {}
+        stored = {}
+        for metadata in categories.get(where={DOC_KEY: self.doc_id}, include=["metadatas"])["metadatas"]:
+            collection_name = make_valid_collection_name(metadata["category"])
+            for page_id, updated_at in json.loads(metadata.get(PAGES_KEY) or "{}").items():
+                stored[page_id] = (updated_at, collection_name)
+        return stored
+
+    def record_pages(self, client, roots, synced):
+        """Writes each category's page map; synced is page id -> updatedAt of the pages now in the index."""
+        maps = {f"coda:{root['id']}": {} for root in roots.values()}
+        for page_id, updated_at in synced.items():
+            maps[f"coda:{roots[page_id]['id']}"][page_id] = updated_at
+        if not maps:
+            return
+        categories = client.get_or_create_collection(name="categories")
+        stored = categories.get(ids=list(maps), include=["metadatas"])
+        categories.update(ids=stored["ids"], metadatas=[{**m, PAGES_KEY: json.dumps(maps[i], sort_keys=True)}
+                                                        for i, m in zip(stored["ids"], stored["metadatas"])])
+
+    @staticmethod
+    def categories(pages):
+        """Page id -> its top level page."""
+        by_id = {p["id"]: p for p in pages}
+        roots = {}
+        for page in pages:
+            root = page
+            seen = set()
+            while (root.get("parent") or {}).get("id") in by_id and root["id"] not in seen:
+                seen.add(root["id"])
+                root = by_id[root["parent"]["id"]]
+            roots[page["id"]] = root
+        return roots
+
+    @staticmethod
+    def chunks(markdown):
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        return [(heading, chunk) for heading, _, section in markdown_sections(markdown)
+                for chunk in splitter.split_text(section)]
+
+    def store_page(self, client, page, collection_name, markdown, profile):
+        collection = client.get_or_create_collection(name=collection_name)
+        # Replaces whatever is stored for the page, including chunks its page map does not know about
+        collection.delete(where={PAGE_KEY: page["id"]})
+        chunks = self.chunks(markdown)
+        if not chunks:
+            return 0
+        ids = [f"{page['id']}:{i}" for i in range(len(chunks))]
+        # A page's chunks link to each other; pages are synced independently, so not across pages
+        metadatas = [{**adjacency, DOC_KEY: self.doc_id, PAGE_KEY: page["id"], UPDATED_KEY: page["updatedAt"],
+                      "page": page.get("name", ""), "heading": heading}
+                     for adjacency, (heading, _) in zip(adjacency_metadata([(collection_name, i) for i in ids]),
+                                                        chunks)]
+        add_to_collection(collection, profile, [c for _, c in chunks], ids, metadatas)
+        return len(chunks)
+
+    @staticmethod
+    def delete_page(client, page_id, collection_name):
+        try:
+            client.get_collection(name=collection_name).delete(where={PAGE_KEY: page_id})
+        except ValueError:
+            pass
+
+    def sync_categories(self, client, roots, profile):
+        categories = client.get_or_create_collection(name="categories")
+        stored = categories.get(where={DOC_KEY: self.doc_id}, include=["documents", "metadatas"])
+        stored = {i: (d, m["category"]) for i, d, m in zip(stored["ids"], stored["documents"], stored["metadatas"])}
+        wanted = {}
+        for root in roots:
+            description = (self.descriptions.get(root["name"]) or
+                           ". ".join(t for t in (root.get("name"), root.get("subtitle")) if t))
+            wanted[f"coda:{root['id']}"] = (description, root["name"])
+        # Only renamed or redescribed categories are embedded again
+        changed = [i for i, entry in wanted.items() if stored.get(i) != entry]
+        if changed:
+            categories.delete(ids=changed)
+            add_to_collection(categories, profile, [wanted[i][0] for i in changed], changed,
+                              [{"category": wanted[i][1], DOC_KEY: self.doc_id} for i in changed])
+        removed = [i for i in stored if i not in wanted]
+        if removed:
+            categories.delete(ids=removed)
+        return len(changed) + len(removed)
+
+    def sync(self, client, profiler=None, job=None):
+        """Brings the index in line with the doc. Returns counts of what changed."""
+        owns_profiler = profiler is None
+        if owns_profiler:
+            profiler = IngestionProfiler("coda")
+        started = time.perf_counter()
+        requests_before = self.requests
+
+        with profiler.file(f"coda:{self.doc_id}") as profile:
+            with profile.stage("list"):
+                pages = [p for p in self.list_pages() if p.get("contentType", "canvas") == "canvas"]
+            roots = self.categories(pages)
+            with profile.stage("state"):
+                stored = self.stored_pages(client)
+            categories_changed = self.sync_categories(
+                client, {r["id"]: r for r in roots.values()}.values(), profile)
+
+        targets = {p["id"]: make_valid_collection_name(roots[p["id"]]["name"]) for p in pages}
+        changed = [p for p in pages if stored.get(p["id"]) != (p.get("updatedAt"), targets[p["id"]])]
+        changed_ids = {p["id"] for p in changed}
+        removed = [(page_id, name) for page_id, (_, name) in stored.items() if page_id not in targets]
+        if job is not None:
+            job.set_total(files=len(changed) + len(removed))
+
+        # Removed first: they are only known from the page maps, which are rewritten below
+        for page_id, collection_name in removed:
+            self.delete_page(client, page_id, collection_name)
+            if job is not None:
+                job.advance(files=1)
+
+        synced = {p["id"]: p["updatedAt"] for p in pages if p["id"] not in changed_ids}
+        chunks = 0
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            exports = {executor.submit(self.export_page, p["id"]): p for p in changed}
+            # Pages are written as their exports finish, on this thread, while the rest are still downloading
+            for future in concurrent.futures.as_completed(exports):
+                page = exports[future]
+                if job is not None:
+                    job.raise_if_cancelled()
+                with profiler.file(f"coda:{self.doc_id}/{page['id']}") as profile:
+                    markdown = future.result()
+                    profile.bytes_in = len(markdown.encode("utf-8"))
+                    previous = stored.get(page["id"])
+                    if previous is not None and previous[1] != targets[page["id"]]:
+                        self.delete_page(client, page["id"], previous[1])
+                    page_chunks = self.store_page(client, page, targets[page["id"]], markdown, profile)
+                # Pages without any text are recorded too, so they are not exported again until they change
+                synced[page["id"]] = page["updatedAt"]
+                chunks += page_chunks
+                if job is not None:
+                    job.advance(files=1, chunks=page_chunks)
+        except BaseException:
+            # The pages stored before a cancel or failure are recorded too, without hiding what went wrong
+            try:
+                self.record_pages(client, roots, synced)
+            except Exception as e:
+                print(f"CodaSync: Recording the synced pages failed. {e}")
+            raise
+        else:
+            self.record_pages(client, roots, synced)
+        finally:
+            # A cancelled or failed sync drops the exports not started yet instead of waiting for them
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if owns_profiler:
+            profiler.write()
+        return {"pages": len(pages), "changed": len(changed), "removed": len(removed),
+                "unchanged": len(pages) - len(changed), "categories_changed": categories_changed,
+                "collections": sorted({targets[p["id"]] for p in changed}),
+                "chunks": chunks, "requests": self.requests - requests_before,
+                "seconds": round(time.perf_counter() - started, 3)}
+
+
+if __name__ == "__main__":
+    import chromadb
+
+    parser = argparse.ArgumentParser(description="Sync a Coda doc into a chroma index")
+    parser.add_argument("--doc", default=CODA_DOC_ID)
+    parser.add_argument("--db", default="db", help="Path of the chroma index, e.g. db/generations/<generation>")
+    parser.add_argument("--api-url", default=CODA_API_URL)
+    args = parser.parse_args()
+
+    result = CodaSync(args.doc, api_url=args.api_url).sync(chromadb.PersistentClient(path=args.db))
+    print(json.dumps(result, indent=2))
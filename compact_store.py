@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# "int8" or "float16" to answer section queries from quantized in-memory vectors instead of chroma, "" to disable
+COMPACT_VECTORS = os.environ.get("COMPACT_VECTORS", "")
+# Nearest candidates from the quantized search that are rescored with the full precision vectors
+COMPACT_RESCORE_CANDIDATES = int(os.environ.get("COMPACT_RESCORE_CANDIDATES", "32"))
+
+# Collections the section stage never queries
+SKIPPED_COLLECTIONS = ("categories",)
+# Rows dequantized at a time, so a search never holds a float32 copy of a whole collection
+SEARCH_BLOCK_ROWS = 4096
+PAGE_SIZE = 1000
+
+
+def signature(ids, documents, metadatas):
+    """A hash of a collection's rows in id order; it changes when any document or its metadata is edited."""
+    digest = hashlib.sha256()
+    for row in sorted(zip(ids, documents, metadatas), key=lambda r: r[0]):
+        digest.update(json.dumps(row, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class CompactIndex:
+    """
+    The vectors of one collection quantized into a contiguous array, and their ids. Full precision vectors are kept
+    in an .npy file next to it and memory mapped, so only the rows of rescored candidates are ever read back. The
+    text and metadata stay in chroma; the signature of the rows it was built from tells when they were edited.
+    """
+
+    def __init__(self, ids, vectors, dtype, full_path, signature=""):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.ids = list(ids)
+        self.dtype = dtype
+        self.signature = signature
+
+        np.save(full_path, vectors)
+        self.full = np.load(full_path, mmap_mode="r")
+        self.norms = np.einsum("ij,ij->i", vectors, vectors)
+
+        if dtype == "int8":
+            # Symmetric per-vector scale: each row uses the whole int8 range whatever its magnitude
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self.codes = np.round(vectors / scales[:, None]).astype(np.int8)
+            self.scales = scales.astype(np.float32)
+        elif dtype == "float16":
+            self.codes = vectors.astype(np.float16)
+            self.scales = None
+        else:
+            raise ValueError(f"Unknown compact vector type {dtype}, expected int8 or float16")
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.norms.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def approximate_distances(self, query):
+        dots = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+            block = self.codes[start:start + SEARCH_BLOCK_ROWS].astype(np.float32)
+            dots[start:start + len(block)] = block @ query
+        if self.scales is not None:
+            dots *= self.scales
+        # Squared L2 like chroma's default space, without the |q|^2 term every candidate shares
+        return self.norms - 2 * dots
+
+    def query(self, query, n_results=1, candidates=COMPACT_RESCORE_CANDIDATES):
+        """The (distance, id) of the n_results closest rows, closest first."""
+        query = np.asarray(query, dtype=np.float32).ravel()
+        n_results = min(n_results, len(self))
+        if n_results == 0:
+            return []
+
+        approximate = self.approximate_distances(query)
+        count = min(len(self), max(candidates, n_results))
+        shortlist = np.argpartition(approximate, count - 1)[:count] if count < len(self) else np.arange(len(self))
+        # Sorted so the memory mapped rows are read in file order
+        shortlist.sort()
+
+        differences = np.asarray(self.full[shortlist]) - query
+        exact = np.einsum("ij,ij->i", differences, differences)
+        order = np.argsort(exact)[:n_results]
+        return [(float(exact[i]), self.ids[shortlist[i]]) for i in order]
+
+
+class CompactStore:
+    """
+    Serves the section stage from compact copies of the chroma section collections. Call sync after the index
+    changes; collections whose rows changed are rebuilt and swapped in one at a time.
+    """
+
+    def __init__(self, directory, dtype=COMPACT_VECTORS or "int8", candidates=COMPACT_RESCORE_CANDIDATES):
+        self.directory = directory
+        self.dtype = dtype
+        self.candidates = candidates
+        self.indexes = {}
+        self.client = None
+        self.builds = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Full precision files left by a previous process are rebuilt by the first sync
+        for name in os.listdir(directory):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(directory, name))
+
+    def sync(self, client, collections=None):
+        """
+        Brings the indexes in line with the client's collections. collections names the ones written to since the
+        last sync: only their rows are read again to find edits, the others are rebuilt when their count changed.
+        None reads every collection.
+        """
+        with self.lock:
+            indexes = {}
+            for collection in client.list_collections():
+                count = collection.count()
+                if collection.name in SKIPPED_COLLECTIONS or count == 0:
+                    continue
+                index = self.indexes.get(collection.name)
+                # Edited rows keep the count, so an index of the right size that was written to is compared row by row
+                written = collections is None or collection.name in collections
+                if (index is None or len(index) != count or
+                        (written and index.signature != signature(*self.read(collection)))):
+                    index = self.build(collection)
+                indexes[collection.name] = index
+            # Swapped in whole, so queries and stats never see a dict that is being changed
+            previous, self.indexes, self.client = self.indexes, indexes, client
+            for name, index in previous.items():
+                if indexes.get(name) is not index:
+                    self.remove(index)
+
+    @staticmethod
+    def read(collection, embeddings=False):
+        """The ids, documents and metadatas of a collection, and its embeddings when asked, a page at a time."""
+        include = ["documents", "metadatas"] + (["embeddings"] if embeddings else [])
+        ids, documents, metadatas, vectors = [], [], [], []
+        offset = 0
+        while True:
+            page = collection.get(include=include, limit=PAGE_SIZE, offset=offset)
+            if not page["ids"]:
+                break
+            ids.extend(page["ids"])
+            documents.extend(page["documents"])
+            metadatas.extend(page["metadatas"])
+            if embeddings:
+                vectors.extend(page["embeddings"])
+            offset += len(page["ids"])
+        return (ids, documents, metadatas, vectors) if embeddings else (ids, documents, metadatas)
+
+    def build(self, collection):
+        ids, documents, metadatas, vectors = self.read(collection, embeddings=True)
+        # A new file per build: the previous index may still be memory mapping its own while queries finish
+        self.builds += 1
+        full_path = os.path.join(self.directory, f"{collection.name}-{self.builds}.npy")
+        return CompactIndex(ids, vectors, self.dtype, full_path, signature(ids, documents, metadatas))
+
+    @staticmethod
+    def remove(index):
+        # Unlinking is safe while the file is still mapped; the pages stay readable until the map is dropped
+        os.remove(index.full.filename)
+
+    def query_collections(self, names, query_embeddings, n_results=1):
+        """
+        Same contract as ShardedClient.query_collections: the n_results closest documents across names. Only the
+        documents and metadatas of those are read from chroma.
+        """
+        indexes, client = self.indexes, self.client
+        hits = sorted((distance, name, row_id) for name in names if name in indexes
+                      for distance, row_id in indexes[name].query(query_embeddings[0], n_results, self.candidates))
+        hits = hits[:n_results]
+        rows = {}
+        for name in dict.fromkeys(name for _, name, _ in hits):
+            stored = client.get_collection(name=name).get(ids=[i for _, n, i in hits if n == name],
+                                                          include=["documents", "metadatas"])
+            rows.update(((name, i), (d, m)) for i, d, m in zip(stored["ids"], stored["documents"], stored["metadatas"]))
+        # A row deleted since the last sync is left out rather than answered without its text
+        hits = [(distance, row_id, rows[name, row_id]) for distance, name, row_id in hits if (name, row_id) in rows]
+        return {
+            "ids": [[row_id for _, row_id, _ in hits]],
+            "distances": [[distance for distance, _, _ in hits]],
+            "documents": [[row[0] for _, _, row in hits]],
+            "metadatas": [[row[1] for _, _, row in hits]],
+        }
+
+    def stats(self):
+        indexes = list(self.indexes.values())
+        compact_bytes = sum(i.nbytes for i in indexes)
+        float32_bytes = sum(i.full.nbytes for i in indexes)
+        return {
+            "dtype": self.dtype,
+            "collections": len(indexes),
+            "vectors": sum(len(i) for i in indexes),
+            "bytes": compact_bytes,
+            "float32_bytes": float32_bytes,
+            "compression": round(float32_bytes / compact_bytes, 2) if compact_bytes else None,
+        }
@@ -0,0 +1,230 @@
+import os
+from functools import lru_cache
+
+# Largest answer, in characters, that expanding a hit with its neighbours or section may build
+CONTEXT_MAX_CHARS = int(os.environ.get("CONTEXT_MAX_CHARS", "4000"))
+# Siblings added on each side of the hit when expanding with "neighbours"
+CONTEXT_WINDOW = int(os.environ.get("CONTEXT_WINDOW", "1"))
+
+# Tokenizers whose token counts are computed at ingestion and stored with every chunk, separated by ",".
+# tiktoken encoding names or Hugging Face tokenizer names; "" skips counting
+CONTEXT_TOKENIZERS = tuple(t.strip() for t in os.environ.get("CONTEXT_TOKENIZERS", "cl100k_base").split(",")
+                           if t.strip())
+CONTEXT_TOKENIZER = CONTEXT_TOKENIZERS[0] if CONTEXT_TOKENIZERS else "cl100k_base"
+# The tokenizers a query may ask for; any other name is refused rather than loaded on the request path
+QUERY_TOKENIZERS = CONTEXT_TOKENIZERS or (CONTEXT_TOKENIZER,)
+# Ranked hits retrieved per question, the passages a token budget is packed from
+CONTEXT_CANDIDATES = int(os.environ.get("CONTEXT_CANDIDATES", "5"))
+
+EXPAND_MODES = ("neighbours", "section")
+
+# The splitters repeat up to CHUNK_OVERLAP characters between consecutive chunks; shorter matches are coincidence
+MAX_OVERLAP = 400
+MIN_OVERLAP = 20
+
+
+def adjacency_metadata(locations):
+    """
+    Takes the (section collection, id) of each chunk in document order and returns the metadata to store with each
+    chunk: its position, its parent section and where its previous and next siblings live. Stored with the chunks,
+    this is the adjacency index; expanding a hit needs no separate lookup table.
+    """
+    metadatas = []
+    for position, (section, _) in enumerate(locations):
+        prev_section, prev_id = locations[position - 1] if position > 0 else ("", "")
+        next_section, next_id = locations[position + 1] if position + 1 < len(locations) else ("", "")
+        metadatas.append({"section": section, "position": position, "prev_section": prev_section,
+                          "prev_id": prev_id, "next_section": next_section, "next_id": next_id})
+    return metadatas
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(name):
+    """Returns a function counting the tokens of a text. Raises ValueError for a tokenizer that cannot be loaded."""
+    try:
+        import tiktoken
+
+        if name in tiktoken.list_encoding_names():
+            encoding = tiktoken.get_encoding(name)
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(name)
+    except Exception as e:
+        raise ValueError(f"Tokenizer {name} is not available. {e}") from e
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+@lru_cache(maxsize=None)
+def ingest_counters(tokenizers):
+    # A tokenizer that cannot be loaded (e.g. no network for its vocabulary) should not stop ingestion,
+    # and is reported once rather than retried for every chunk
+    counters = []
+    for name in tokenizers:
+        try:
+            counters.append((tokens_key(name), load_tokenizer(name)))
+        except ValueError as e:
+            print(f"ingest_counters: Not storing token counts. {e}")
+    return tuple(counters)
+
+
+def tokens_key(tokenizer):
+    return f"tokens:{tokenizer}"
+
+
+def token_metadata(texts, tokenizers=CONTEXT_TOKENIZERS):
+    """The token count of each text under each tokenizer, as chunk metadata."""
+    counters = ingest_counters(tuple(tokenizers))
+    return [{key: count(text) for key, count in counters} for text in texts]
+
+
+def ranked_hits(result):
+    """Flattens a single query chroma result into hits, closest first."""
+    if not result or not result["ids"] or not result["ids"][0]:
+        return []
+    metadatas = result.get("metadatas") or [[None] * len(result["ids"][0])]
+    distances = result.get("distances") or [[None] * len(result["ids"][0])]
+    return [{"id": chunk_id, "text": result["documents"][0][i], "metadata": metadatas[0][i] or {},
+             "distance": distances[0][i]} for i, chunk_id in enumerate(result["ids"][0])]
+
+
+def chunk_chars(chunk):
+    return len(chunk["text"])
+
+
+def tokenizer_counter(name):
+    """
+    The token counter of one of the QUERY_TOKENIZERS, loaded at most once per process. Raises ValueError for any
+    other name, or for one that could not be loaded.
+    """
+    if name not in QUERY_TOKENIZERS:
+        raise ValueError(f"tokenizer must be one of {list(QUERY_TOKENIZERS)}")
+    # A failed load is remembered by ingest_counters, so it is not retried for every request
+    counter = dict(ingest_counters(QUERY_TOKENIZERS)).get(tokens_key(name))
+    if counter is None:
+        raise ValueError(f"Tokenizer {name} is not available")
+    return counter
+
+
+def chunk_tokens(chunk, tokenizer=CONTEXT_TOKENIZER):
+    # Precomputed at ingestion; only chunks stored before counting existed are counted here
+    tokens = chunk["metadata"].get(tokens_key(tokenizer))
+    return tokens if tokens is not None else tokenizer_counter(tokenizer)(chunk["text"])
+
+
+def fetch_chunk(chroma_client, section, chunk_id):
+    try:
+        page = chroma_client.get_collection(name=section).get(ids=[chunk_id], include=["documents", "metadatas"])
+    except ValueError:
+        return None
+    if not page["ids"]:
+        return None
+    return {"id": chunk_id, "text": page["documents"][0], "metadata": page["metadatas"][0] or {}}
+
+
+def expand_neighbours(chroma_client, hit, budget, cost=chunk_chars, window=CONTEXT_WINDOW):
+    """The hit with up to `window` siblings on each side, taken alternately while they fit in the budget."""
+    before, after = [], []
+    used = cost(hit)
+    open_sides = ["prev", "next"] if window > 0 else []
+    while open_sides:
+        for side in list(open_sides):
+            chain = before if side == "prev" else after
+            edge = chain[-1] if chain else hit
+            section = edge["metadata"].get(f"{side}_section")
+            chunk = fetch_chunk(chroma_client, section, edge["metadata"][f"{side}_id"]) if section else None
+            if chunk is None or used + cost(chunk) > budget:
+                open_sides.remove(side)
+                continue
+            chain.append(chunk)
+            used += cost(chunk)
+            if len(chain) >= window:
+                open_sides.remove(side)
+    return list(reversed(before)) + [hit] + after
+
+
+def expand_section(chroma_client, hit, budget, cost=chunk_chars):
+    """As much of the hit's parent section as fits in the budget, growing outwards from the hit."""
+    section = hit["metadata"].get("section")
+    if not section:
+        return [hit]
+    # Ingested files all share one collection; a file chunk's section is the rest of its file
+    source = hit["metadata"].get("source")
+    try:
+        page = chroma_client.get_collection(name=section).get(where={"source": source} if source else None,
+                                                              include=["documents", "metadatas"])
+    except ValueError:
+        return [hit]
+    chunks = sorted(({"id": chunk_id, "text": page["documents"][i], "metadata": page["metadatas"][i] or {}}
+                     for i, chunk_id in enumerate(page["ids"])), key=lambda c: c["metadata"].get("position", 0))
+    centre = next((i for i, c in enumerate(chunks) if c["id"] == hit["id"]), None)
+    if centre is None:
+        return [hit]
+
+    first = last = centre
+    used = cost(hit)
+    grew = True
+    while grew:
+        grew = False
+        for candidate in (first - 1, last + 1):
+            if 0 <= candidate < len(chunks) and used + cost(chunks[candidate]) <= budget:
+                used += cost(chunks[candidate])
+                first, last = min(first, candidate), max(last, candidate)
+                grew = True
+    return chunks[first:centre] + [hit] + chunks[centre + 1:last + 1]
+
+
+def expand_hit(chroma_client, hit, mode, budget=CONTEXT_MAX_CHARS, cost=chunk_chars):
+    if mode == "neighbours":
+        return expand_neighbours(chroma_client, hit, budget, cost)
+    if mode == "section":
+        return expand_section(chroma_client, hit, budget, cost)
+    raise ValueError(f"Unknown expansion {mode}, expected one of {EXPAND_MODES}")
+
+
+def join_chunks(texts):
+    """Joins consecutive chunks, dropping the text a chunk repeats from the end of the one before it."""
+    joined = ""
+    for text in texts:
+        overlap = _overlap(joined, text)
+        joined += text[overlap:] if overlap else ("\n\n" if joined else "") + text
+    return joined
+
+
+def _overlap(previous, text):
+    for size in range(min(len(previous), len(text), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if previous.endswith(text[:size]):
+            return size
+    return 0
+
+
+def pack(chroma_client, hits, budget, tokenizer=CONTEXT_TOKENIZER, expand=None):
+    """
+    Greedily packs the ranked hits, each expanded when asked, into passages that together fit in `budget` tokens.
+    A passage that does not fit is skipped so smaller, lower ranked ones can still use the space.
+    """
+    def cost(chunk):
+        return chunk_tokens(chunk, tokenizer)
+
+    passages = []
+    used = 0
+    seen = set()
+    for rank, hit in enumerate(hits):
+        key = (hit["metadata"].get("section"), hit["id"])
+        if key in seen or used + cost(hit) > budget:
+            continue
+        chunks = expand_hit(chroma_client, hit, expand, budget - used, cost) if expand else [hit]
+        # An earlier passage may already hold part of this one's expansion
+        chunks = [c for c in chunks if (c["metadata"].get("section"), c["id"]) not in seen]
+        tokens = sum(cost(c) for c in chunks)
+        seen.update((c["metadata"].get("section"), c["id"]) for c in chunks)
+        used += tokens
+        passages.append({
+            "rank": rank,
+            "distance": hit["distance"],
+            "tokens": tokens,
+            "text": join_chunks([c["text"] for c in chunks]),
+            "chunks": [{"section": c["metadata"].get("section"), "id": c["id"]} for c in chunks],
+        })
+    return passages, used
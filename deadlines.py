@@ -0,0 +1,146 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+from metrics import QUERY_STAGE_TIMEOUTS
+
+# Time a /query/ may take when the client does not send DEADLINE_HEADER; 0 for no deadline
+QUERY_DEADLINE_MS = float(os.environ.get("QUERY_DEADLINE_MS", "2000"))
+# Longer deadlines asked for by clients are cut to this
+QUERY_DEADLINE_MAX_MS = float(os.environ.get("QUERY_DEADLINE_MAX_MS", "30000"))
+# Threads running query stages under a deadline. A stage that overruns keeps its thread until it returns; once
+# abandoned stages hold all of them, new stages are rejected at once rather than queued behind a stalled chroma or model
+QUERY_STAGE_WORKERS = int(os.environ.get("QUERY_STAGE_WORKERS", "8"))
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+_executor = None
+_abandoned = 0
+_abandoned_lock = threading.Lock()
+
+
+class StageTimeout(Exception):
+    """A stage was skipped or abandoned because the deadline passed; the caller falls back."""
+
+
+def stage_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(QUERY_STAGE_WORKERS, thread_name_prefix="query-stage")
+    return _executor
+
+
+def abandoned_stages():
+    """Stages given up on at their deadline that are still running."""
+    return _abandoned
+
+
+def abandon(future):
+    global _abandoned
+    with _abandoned_lock:
+        _abandoned += 1
+    future.add_done_callback(finished_abandoned)
+
+
+def finished_abandoned(future):
+    global _abandoned
+    with _abandoned_lock:
+        _abandoned -= 1
+
+
+class Deadline:
+    """
+    The time left for one query. Stages run through run(), which gives up on a stage once the deadline passes and
+    records how long every stage took and how it ended, for the response and for tuning.
+    Without a budget stages run inline on the calling thread and are only timed.
+    """
+
+    def __init__(self, seconds=None):
+        self.started = time.perf_counter()
+        self.seconds = seconds
+        self.expires_at = None if seconds is None else self.started + seconds
+        self.stages = []
+        self.fallbacks = []
+
+    @classmethod
+    def from_header(cls, value, default_ms=QUERY_DEADLINE_MS, max_ms=QUERY_DEADLINE_MAX_MS):
+        """A deadline from the DEADLINE_HEADER value in milliseconds, or the default when there is none."""
+        if value is None or value == "":
+            milliseconds = default_ms
+        else:
+            try:
+                milliseconds = float(value)
+            except ValueError:
+                raise ValueError(f"{DEADLINE_HEADER} must be a number of milliseconds, not {value!r}")
+            if milliseconds <= 0:
+                raise ValueError(f"{DEADLINE_HEADER} must be positive")
+        if milliseconds <= 0:
+            return cls()
+        return cls(min(milliseconds, max_ms) / 1000)
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.perf_counter())
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and time.perf_counter() >= self.expires_at
+
+    def record(self, stage, status, seconds=0.0):
+        self.stages.append({"stage": stage, "status": status, "ms": round(seconds * 1000, 3)})
+
+    @property
+    def degraded(self):
+        return bool(self.fallbacks)
+
+    def run(self, stage, fn, *args, share=1.0, **kwargs):
+        """
+        fn(*args, **kwargs), or StageTimeout when it cannot finish before the deadline. A share below 1 gives the
+        stage only that fraction of the time left, keeping the rest for a fallback that still needs a stage after it.
+        """
+        started = time.perf_counter()
+        if self.expires_at is None:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self.record(stage, "error", time.perf_counter() - started)
+                raise
+            self.record(stage, "ok", time.perf_counter() - started)
+            return result
+
+        if self.expired or abandoned_stages() >= QUERY_STAGE_WORKERS:
+            # Past the deadline, or every stage thread is still busy with a stage some query gave up on
+            status = "skipped" if self.expired else "rejected"
+            self.record(stage, status)
+            QUERY_STAGE_TIMEOUTS.labels(stage, status).inc()
+            raise StageTimeout(stage)
+        future = stage_executor().submit(fn, *args, **kwargs)
+        try:
+            result = future.result(timeout=self.remaining() * share)
+        except concurrent.futures.TimeoutError:
+            # Only a stage still queued can be cancelled; a running one is left to finish and its result dropped
+            status = "cancelled" if future.cancel() else "timeout"
+            if status == "timeout":
+                abandon(future)
+            self.record(stage, status, time.perf_counter() - started)
+            QUERY_STAGE_TIMEOUTS.labels(stage, status).inc()
+            raise StageTimeout(stage)
+        except Exception:
+            self.record(stage, "error", time.perf_counter() - started)
+            raise
+        self.record(stage, "ok", time.perf_counter() - started)
+        return result
+
+    def degrade(self, fallback):
+        """Notes a fallback taken in place of a stage that ran out of time."""
+        self.fallbacks.append(fallback)
+
+    def report(self):
+        return {
+            "deadline_ms": None if self.seconds is None else round(self.seconds * 1000, 3),
+            "elapsed_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "degraded": self.degraded,
+            "fallbacks": self.fallbacks,
+            "stages": self.stages,
+        }
@@ -1,18 +1,57 @@
+import os
+import tempfile
+import threading
+import time
+
 import chromadb
-from langchain.embeddings.sentence_transformer import \
-    SentenceTransformerEmbeddings
-from langchain.vectorstores import Chroma
 
 import ingest
-from markdown_loader import load_markdown_data, query_with_doug
+from category_router import KeywordChooser
+from coda_sync import DOC_KEY
+from compact_store import COMPACT_VECTORS, CompactStore
+from context import (CONTEXT_CANDIDATES, CONTEXT_MAX_CHARS, CONTEXT_TOKENIZER,
+                     expand_hit, join_chunks, pack, ranked_hits)
+from deadlines import Deadline, StageTimeout
+from embeddings import get_embedder
+from index_generations import IndexGenerations
+from markdown_loader import (DOCS_KEY, DOCS_PATH, delete_docs, docs_namespace, load_markdown_data, narrowed_query,
+                             query_with_doug, route_categories)
+from memory import chroma_settings
+from metrics import QUERY_CACHE_LOOKUPS, QUERY_STAGE_SECONDS
+from query_cache import SemanticQueryCache
+from sharding import CHROMA_SHARDS, ShardedClient
+
+CHROMA_DB_PATH = os.environ.get("CHROMA_DB_PATH", "db")
+INDEX_GENERATIONS_TO_KEEP = int(os.environ.get("INDEX_GENERATIONS_TO_KEEP", "2"))
+# Questions every new index generation has to answer before it is swapped in, separated by ";"
+INDEX_SMOKE_QUERIES = [q for q in os.environ.get(
+    "INDEX_SMOKE_QUERIES", "What is continuous delivery?;How do I get started?").split(";") if q.strip()]
+# Number of categories the router picks; above 1 the best chunk across all of them is returned
+ROUTING_TOP_K = int(os.environ.get("ROUTING_TOP_K", "1"))
+# Fraction of a query's remaining time routing may use, so the lookup still runs after falling back to keywords
+ROUTING_DEADLINE_SHARE = 0.5
+# Rows copied between generations at a time, see carry_over
+CARRY_OVER_BATCH = 1000
 
 
 class DocumentStore:
-    def __init__(self):
+    def __init__(self, db_path=CHROMA_DB_PATH, shards=CHROMA_SHARDS):
         self.index_name = "default"
-        self.client = chromadb.PersistentClient(path="db")
-        self.collection = self.client.get_or_create_collection(name="default")
-        self.ingestor = ingest.Ingest(self.index_name, self.client, self.collection)
+        self.sharded = bool(shards)
+        self.generations = None
+        self.generation = None
+        if not self.sharded:
+            # Each rebuild of the index goes into its own generation directory, see rebuild_index
+            self.generations = IndexGenerations(db_path, keep=INDEX_GENERATIONS_TO_KEEP)
+            self.generation = self.generations.current()
+            if self.generation is None:
+                self.generation = self.generations.create()
+                self.generations.promote(self.generation)
+        self.rebuild_lock = threading.Lock()
+        # Held by everything that writes to the live index, and by a rebuild while it copies the live index and swaps
+        # the new one in, so no write lands in a generation after it was copied
+        self.write_lock = threading.RLock()
+        self.last_rebuild = None
         # For the sliding window
         self.chunk_size = 200
         self.overlap_size = 50
@@ -22,14 +61,37 @@ class DocumentStore:
         self.path_to_directory = "content/en/docs"
         self.url = f"https://api.github.com/repos/{self.username}/{self.repository}/contents/"
 
-        self.embedding_function = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-        self.chroma_db = Chroma(embedding_function=self.embedding_function, collection_name="default",
-                                client=self.client)
+        # Questions are embedded with the same backend as ingestion, see EMBEDDING_BACKEND
+        self.embedding_function = get_embedder()
+        if self.sharded:
+            self.bind(ShardedClient(shards))
+        else:
+            path = self.generations.path(self.generation)
+            self.bind(chromadb.PersistentClient(path=path, settings=chroma_settings()), path)
+
+        # Recent query embeddings -> answers, so paraphrased questions skip the two stage retrieval
+        self.query_cache = SemanticQueryCache()
+
+    def bind(self, client, path=None):
+        collection = client.get_or_create_collection(name="default")
+        self.ingestor = ingest.Ingest(self.index_name, client, collection)
+        self.collection = collection
+        # Quantized copies of the section collections, kept next to the generation they were built from
+        self.section_store = None
+        if COMPACT_VECTORS and path is not None:
+            section_store = CompactStore(os.path.join(path, "compact"), COMPACT_VECTORS)
+            section_store.sync(client)
+            self.section_store = section_store
+        # Category -> description, kept in memory so a query out of time can still be routed and answered
+        self.category_descriptions = load_category_descriptions(client)
+        self.file_collections = file_collections(collection)
+        # Assigned last: queries read self.client once, so in-flight ones finish on the generation they started on
+        self.client = client
 
     # Try catch fails if collection cannot be found
-    def does_collection_exist(self, collection_name):
+    def does_collection_exist(self, collection_name, client=None):
         try:
-            collection = self.client.get_collection(name=collection_name)
+            collection = (client or self.client).get_collection(name=collection_name)
             if collection.count() > 0:
                 return True
         except ValueError:
@@ -38,16 +100,296 @@ class DocumentStore:
         return False
 
     def query_langchain(self, query_text):
-        docs = self.chroma_db.similarity_search(query_text)
+        # Only used by tests, so the langchain vector store is not imported at startup
+        from langchain.vectorstores import Chroma
+
+        chroma_db = Chroma(embedding_function=self.embedding_function, collection_name="default", client=self.client)
+        docs = chroma_db.similarity_search(query_text)
         return docs
 
+    def embed_question(self, query_text):
+        with QUERY_STAGE_SECONDS.time("embedding"):
+            return self.embedding_function.embed_query(query_text)
+
+    def retrieve(self, query_text, deadline=None):
+        """
+        The ranked hits for a question, from the semantic cache when a similar question was asked recently. Ingested
+        files are searched alongside the sections of the routed categories.
+        Under a deadline, a stage that runs out of time is given up on and the hits come from the best fallback left:
+        the cached answer to the same question, routing on keywords, or the description of the routed category.
+        """
+        deadline = deadline or Deadline()
+        client, section_store = self.client, self.section_store
+        descriptions, files = self.category_descriptions, self.file_collections
+        try:
+            query_embedding = deadline.run("embedding", self.embed_question, query_text)
+        except StageTimeout:
+            cached = self.query_cache.get_question(query_text)
+            if cached is not None:
+                deadline.degrade("cached_answer")
+                return cached
+            deadline.degrade("category_description")
+            return category_hits(keyword_categories(descriptions, query_text), descriptions)
+
+        started = time.perf_counter()
+        with QUERY_STAGE_SECONDS.time("cache"):
+            generation = self.query_cache.generation
+            cached = self.query_cache.get(query_embedding)
+        deadline.record("cache", "hit" if cached is not None else "miss", time.perf_counter() - started)
+        if cached is not None:
+            QUERY_CACHE_LOOKUPS.labels("hit").inc()
+            return cached
+        QUERY_CACHE_LOOKUPS.labels("miss").inc()
+
+        try:
+            categories = deadline.run("routing", route_categories, client, query_text,
+                                      query_embedding=query_embedding, k=ROUTING_TOP_K, share=ROUTING_DEADLINE_SHARE)
+        except StageTimeout:
+            deadline.degrade("keyword_routing")
+            categories = keyword_categories(descriptions, query_text)
+        try:
+            result = deadline.run("narrowed_query", narrowed_query, client, categories, query_text, query_embedding,
+                                  ROUTING_TOP_K, section_store, CONTEXT_CANDIDATES, files)
+        except StageTimeout:
+            deadline.degrade("category_description")
+            return category_hits(categories, descriptions)
+        hits = ranked_hits(result)
+        # Hits found by a fallback are not worth keeping around, nor is finding nothing in an index still being loaded
+        if hits and not deadline.degraded:
+            self.query_cache.put(query_embedding, hits, generation, question=query_text)
+        return hits
+
     def query_with_doug(self, query_text):
-        result = query_with_doug(self.client, query_text)
-        return result['documents'][0][0]
+        hits = self.retrieve(query_text)
+        return hits[0]["text"] if hits else ""
 
-    def load_pdf(self, path):
-        self.ingestor.load_data(path)
+    def query_context(self, query_text, expand=None, max_chars=CONTEXT_MAX_CHARS, token_budget=None,
+                      tokenizer=CONTEXT_TOKENIZER, deadline=None):
+        """
+        The best chunk for a question. With expand, also its "neighbours" (previous and next chunks) or its whole
+        parent "section", as far as they fit in max_chars. With a token budget, the ranked hits (each expanded when
+        asked) are instead packed into passages that together fit in token_budget tokens of the given tokenizer.
+        Expansion is dropped when the deadline leaves no time for it, or the hits already come from a fallback.
+        """
+        deadline = deadline or Deadline()
+        client = self.client
+        hits = self.retrieve(query_text, deadline)
+        if deadline.degraded:
+            expand = None
+        if token_budget is not None:
+            try:
+                # Only expansion reads chroma; packing the hits alone is quick
+                passages, used = (deadline.run("expansion", pack, client, hits, token_budget, tokenizer, expand)
+                                  if expand else pack(client, hits, token_budget, tokenizer))
+            except StageTimeout:
+                deadline.degrade("unexpanded")
+                passages, used = pack(client, hits, token_budget, tokenizer)
+            return {
+                "results": "\n\n".join(p["text"] for p in passages),
+                "passages": passages,
+                "tokens_used": used,
+                "token_budget": token_budget,
+                "tokenizer": tokenizer,
+            }
+
+        chunks = hits[:1]
+        if expand and hits:
+            try:
+                chunks = deadline.run("expansion", expand_hit, client, hits[0], expand, max_chars)
+            except StageTimeout:
+                deadline.degrade("unexpanded")
+        return {
+            "results": join_chunks([c["text"] for c in chunks]),
+            "chunks": [{"section": c["metadata"].get("section"), "id": c["id"]} for c in chunks],
+        }
+
+    def cache_stats(self):
+        return self.query_cache.stats()
 
+    def collection_sizes(self):
+        # One count() per collection, so only call this at scrape time rather than per query
+        return {c.name: c.count() for c in self.client.list_collections()}
+
+    def index_changed(self, collections=None):
+        """
+        Call after documents are added to the live index so nothing keeps serving the old contents. collections names
+        the collections written to, when known, so the compact store only reads those again, see CompactStore.sync.
+        """
+        self.query_cache.invalidate()
+        self.category_descriptions = load_category_descriptions(self.client)
+        self.file_collections = file_collections(self.collection)
+        if self.section_store is not None:
+            self.section_store.sync(self.client, collections)
+
+    def load_pdf(self, path):
+        with self.write_lock:
+            self.ingestor.load_data(path)
+            self.index_changed([self.collection.name])
 
     def load_doug_date(self):
-        load_markdown_data(self.client, self.url)
+        with self.write_lock:
+            self.index_changed(load_markdown_data(self.client, self.url))
+
+    def validate_index(self, client):
+        if not self.does_collection_exist("categories", client):
+            raise ValueError("The categories collection is empty")
+        for query_text in INDEX_SMOKE_QUERIES:
+            result = query_with_doug(client, query_text)
+            if not result['documents'] or not result['documents'][0]:
+                raise ValueError(f"Smoke query '{query_text}' returned no documents")
+
+    def rebuild_index(self):
+        """
+        Builds a new index generation while the current one keeps serving, validates it with smoke queries and
+        swaps it in. A failed build is discarded and the current generation stays live. Only the markdown docs are
+        loaded again; files, Coda pages and docs loaded from other repos are copied across from the current generation,
+        see carry_over. Writers are held off from the copy until the swap, see write_lock.
+        Sharded stores have no generations, see rebuild_shards.
+        """
+        if not self.rebuild_lock.acquire(blocking=False):
+            raise RuntimeError("An index rebuild is already running")
+        try:
+            if self.sharded:
+                return self.rebuild_shards()
+            started = time.time()
+            name = self.generations.create()
+            print(f"Building index generation {name}")
+            try:
+                client = chromadb.PersistentClient(path=self.generations.path(name), settings=chroma_settings())
+                load_markdown_data(client, self.url)
+            except Exception as e:
+                self.discard_generation(name, e)
+                raise
+            with self.write_lock:
+                try:
+                    copied = carry_over(self.client, client, rebuilt=[docs_namespace(self.url, DOCS_PATH)])
+                    print(f"Copied {copied} file, Coda and other repo chunks into index generation {name}")
+                    self.validate_index(client)
+                except Exception as e:
+                    self.discard_generation(name, e)
+                    raise
+                self.generations.promote(name)
+                previous = self.generation
+                self.bind(client, self.generations.path(name))
+                self.generation = name
+                self.query_cache.invalidate()
+
+            # Keep the previous generation around for requests that started before the swap
+            for removed in self.generations.collect_garbage(protected=[previous]):
+                release_client(self.generations.path(removed))
+
+            self.last_rebuild = {"generation": name, "error": None, "finished_at": time.time(),
+                                 "seconds": round(time.time() - started, 3)}
+            print(f"Index generation {name} is live")
+            return name
+        finally:
+            self.rebuild_lock.release()
+
+    def discard_generation(self, name, error):
+        self.generations.discard(name)
+        release_client(self.generations.path(name))
+        self.last_rebuild = {"generation": name, "error": str(error), "finished_at": time.time()}
+
+    def rebuild_shards(self):
+        """
+        The shards own their storage, so the markdown docs are built and validated in a generation on local disk
+        instead, then copied onto the shards in place of the docs loaded before. A failed build leaves the shards as
+        they were.
+        """
+        started = time.time()
+        with tempfile.TemporaryDirectory() as path:
+            try:
+                client = chromadb.PersistentClient(path=path, settings=chroma_settings())
+                load_markdown_data(client, self.url)
+                self.validate_index(client)
+                with self.write_lock:
+                    delete_docs(self.client, docs_namespace(self.url, DOCS_PATH))
+                    copied = carry_over(client, self.client)
+                    self.index_changed()
+            except Exception as e:
+                self.last_rebuild = {"generation": None, "error": str(e), "finished_at": time.time()}
+                raise
+            finally:
+                release_client(path)
+        self.last_rebuild = {"generation": None, "error": None, "finished_at": time.time(),
+                             "seconds": round(time.time() - started, 3)}
+        print(f"Copied {copied} markdown chunks onto the shards")
+        return None
+
+    def index_status(self):
+        return {
+            "sharded": self.sharded,
+            "generation": self.generation,
+            "generations": self.generations.list() if self.generations else [],
+            "rebuild_running": self.rebuild_lock.locked(),
+            "last_rebuild": self.last_rebuild,
+            "section_store": self.section_store.stats() if self.section_store is not None else None,
+        }
+
+
+def load_category_descriptions(client):
+    try:
+        stored = client.get_collection(name="categories").get(include=["documents", "metadatas"])
+    except Exception:
+        return {}
+    return {m["category"]: d for d, m in zip(stored["documents"], stored["metadatas"]) if m and m.get("category")}
+
+
+def file_collections(collection):
+    # Files are not routed: the default collection they go into is searched with every question, once it has any
+    return (collection.name,) if collection.count() else ()
+
+
+def keyword_categories(descriptions, query_text, k=ROUTING_TOP_K):
+    """Routes without the embedding model or chroma, by word overlap with the category descriptions."""
+    if not descriptions:
+        return []
+    categories = list(descriptions)
+    chosen = KeywordChooser().choose(query_text, [f"{c} {descriptions[c]}" for c in categories], k)
+    by_choice = {f"{c} {descriptions[c]}": c for c in categories}
+    return [by_choice[c] for c in chosen]
+
+
+def category_hits(categories, descriptions):
+    """Hits made of the routed categories' descriptions, the answer of last resort."""
+    return [{"id": f"category:{c}", "text": descriptions.get(c, c), "metadata": {"category": c}, "distance": None}
+            for c in categories]
+
+
+def carry_over(source, target, rebuilt=(), batch_size=CARRY_OVER_BATCH):
+    """
+    Copies what a rebuild does not load again from one generation to the next: the files in the default collection,
+    and the Coda pages and the markdown docs of any repo other than the `rebuilt` ones, categories included, wherever
+    they are. Embeddings are copied, not computed again. Returns the number of rows copied.
+    """
+    def kept(metadata):
+        # Markdown rows without a namespace date from before there were github jobs, so are the rebuilt docs too
+        return DOC_KEY in metadata or (DOCS_KEY in metadata and metadata[DOCS_KEY] not in rebuilt)
+
+    copied = 0
+    for collection in source.list_collections():
+        stored = collection.get(include=["metadatas"])
+        ids = [i for i, m in zip(stored["ids"], stored["metadatas"])
+               if collection.name == "default" or (m and kept(m))]
+        if not ids:
+            continue
+        copy = target.get_or_create_collection(name=collection.name, metadata=collection.metadata)
+        for start in range(0, len(ids), batch_size):
+            rows = collection.get(ids=ids[start:start + batch_size],
+                                  include=["embeddings", "documents", "metadatas"])
+            copy.upsert(ids=rows["ids"], embeddings=rows["embeddings"], documents=rows["documents"],
+                        metadatas=rows["metadatas"])
+        copied += len(ids)
+    return copied
+
+
+def release_client(path):
+    # chroma caches one system per persist directory for the life of the process; drop the one for a deleted
+    # generation so its sqlite handle and loaded indexes are freed
+    try:
+        from chromadb.api.client import SharedSystemClient
+        system = SharedSystemClient._identifer_to_system.pop(path, None)
+        if system is not None:
+            system.stop()
+    except Exception as e:
+        print(f"release_client: Could not release chroma client for {path}. {e}")
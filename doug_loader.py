@@ -1,10 +1,12 @@
 from coda_ingester import extract_sections
 import csv
 import ipaddress
+import os
 import re
 
-import outlines.models as models
-import outlines.text.generate as generate
+from context import adjacency_metadata
+from embeddings import embed_documents
+from ingest_profile import FileProfile, IngestionProfiler, add_to_collection
 
 model = None
 
@@ -50,24 +52,39 @@ def make_valid_collection_name(s):
     return s
 
 
-def load_doug_data(chroma_client, csv_location, doc_location):
-    doug_categories = load_csv_into_iterable_map(csv_location)
+def load_doug_data(chroma_client, csv_location, doc_location, profiler=None):
+    owns_profiler = profiler is None
+    if owns_profiler:
+        profiler = IngestionProfiler("doug")
 
-    for idx, row in enumerate(doug_categories):
-        row_metadata = create_header_metadata(row)
-        row_description = row['Description']
-        store_text_with_header(
-            chroma_client, row_description, row_metadata, str(idx))
+    with profiler.file(csv_location) as profile:
+        profile.bytes_in = os.path.getsize(csv_location)
+        with profile.stage("load"):
+            doug_categories = load_csv_into_iterable_map(csv_location)
 
-    categories_list = [d["Category"] for d in doug_categories]
-    sections = extract_sections(doc_location, categories_list)
+        for idx, row in enumerate(doug_categories):
+            row_metadata = create_header_metadata(row)
+            row_description = row['Description']
+            store_text_with_header(
+                chroma_client, row_description, row_metadata, str(idx), profile)
 
-    for keyword, content_list in sections.items():
-        valid_keyword = make_valid_collection_name(keyword)
-        section_collection = chroma_client.get_or_create_collection(
-            name=valid_keyword)
-        for i, content in enumerate(content_list):
-            section_collection.add(documents=[content], ids=str(i))
+    with profiler.file(doc_location) as profile:
+        profile.bytes_in = os.path.getsize(doc_location)
+        categories_list = [d["Category"] for d in doug_categories]
+        with profile.stage("extract"):
+            sections = extract_sections(doc_location, categories_list)
+
+        for keyword, content_list in sections.items():
+            valid_keyword = make_valid_collection_name(keyword)
+            section_collection = chroma_client.get_or_create_collection(
+                name=valid_keyword)
+            # Pages are numbered within their category, so a page's siblings are the pages either side of it
+            adjacency = adjacency_metadata([(valid_keyword, str(i)) for i in range(len(content_list))])
+            for i, content in enumerate(content_list):
+                add_to_collection(section_collection, profile, [content], [str(i)], [adjacency[i]])
+
+    if owns_profiler:
+        profiler.write()
 
 
 def create_header_metadata(doug_row):
@@ -76,7 +93,7 @@ def create_header_metadata(doug_row):
     }
 
 
-def store_text_with_header(chroma_client, text, header_metadata, doc_id):
+def store_text_with_header(chroma_client, text, header_metadata, doc_id, profile=None):
     category_collection = chroma_client.get_or_create_collection(
         name="categories")
 
@@ -84,13 +101,13 @@ def store_text_with_header(chroma_client, text, header_metadata, doc_id):
     header_metadatas = [header_metadata]
     doc_ids = [doc_id]
 
-    chroma_id = category_collection.add(
-        documents=descriptions, metadatas=header_metadatas, ids=doc_ids)
-
-    return chroma_id
+    add_to_collection(category_collection, profile or FileProfile("categories"),
+                      descriptions, doc_ids, header_metadatas)
 
 
 def find_most_similar(input_string, string_list):
+    import outlines.text.generate as generate
+
     result = generate.choice(model=model, choices=string_list)(
         f"Which one of these items is most relevant to this question: {input_string}")
     print(result)
@@ -100,10 +117,15 @@ def find_most_similar(input_string, string_list):
 def query_with_doug(chroma_client, text, generative=False):
     global model
     category = ""
+    # Embedded once with the configured backend, the one the documents were stored with, rather than chroma's own
+    query_embeddings = [list(embed_documents([text])[0])]
 
     # Use a generative model like Synthia-7b
     if generative:
         if model is None:
+            # Imported here so loading documents does not pull in outlines, transformers and torch
+            import outlines.models as models
+
             model = models.transformers(
                 "TheBloke/SynthIA-7B-v2.0-GPTQ", device="cuda:0")
 
@@ -119,11 +141,11 @@ def query_with_doug(chroma_client, text, generative=False):
     # Use similarity search using an embedding model like "sentence-transformers/all-MiniLM-L6-v2"
     else:
         collection = chroma_client.get_collection(name="categories")
-        results = collection.query(query_texts=[text], n_results=1)
+        results = collection.query(query_embeddings=query_embeddings, n_results=1)
         category = results["metadatas"][0][0]['category']
 
     valid_category = make_valid_collection_name(category)
     collection = chroma_client.get_collection(name=valid_category)
-    narrowed_result = collection.query(query_texts=[text], n_results=1)
+    narrowed_result = collection.query(query_embeddings=query_embeddings, n_results=1)
 
     return narrowed_result
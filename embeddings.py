@@ -0,0 +1,169 @@
+import argparse
+import os
+import shutil
+import threading
+from functools import lru_cache
+
+import numpy as np
+from chromadb.utils import embedding_functions
+
+# "onnx" runs chroma's ONNX export of all-MiniLM-L6-v2, "onnx-int8" the same model with int8 weights and
+# "sentence-transformers" the PyTorch model. Ingestion and queries share the backend so stored and query vectors match
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "onnx")
+# Intra-op threads of the ONNX session, 0 lets onnxruntime use one per physical core
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", "0"))
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# The full precision export chroma downloads on first use
+ONNX_MODEL_DIR = os.path.join(embedding_functions.ONNXMiniLM_L6_V2.DOWNLOAD_PATH,
+                              embedding_functions.ONNXMiniLM_L6_V2.EXTRACTED_FOLDER_NAME)
+# Where the quantized model is written the first time the int8 backend is used, see quantize_model
+ONNX_INT8_DIR = os.environ.get("EMBEDDING_INT8_DIR", os.path.join(
+    embedding_functions.ONNXMiniLM_L6_V2.DOWNLOAD_PATH, "onnx-int8"))
+
+BACKENDS = ("onnx", "onnx-int8", "sentence-transformers")
+# Same limit as sentence-transformers uses for this model
+MAX_SEQUENCE_LENGTH = 256
+BATCH_SIZE = 32
+MODEL_FILE = "model.onnx"
+
+
+class OnnxEmbeddings:
+    """
+    all-MiniLM-L6-v2 on onnxruntime: mean pooled over the attention mask and L2 normalised, as sentence-transformers
+    does. Batches are padded to their longest text rather than to MAX_SEQUENCE_LENGTH, so a short question runs a
+    few dozen positions instead of 256.
+    """
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, threads=EMBEDDING_THREADS):
+        self.model_dir = model_dir
+        self.threads = threads
+        self.session = None
+        self.tokenizer = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.session is not None:
+                return
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+
+            model_path = os.path.join(self.model_dir, MODEL_FILE)
+            if not os.path.exists(model_path):
+                if self.model_dir != ONNX_MODEL_DIR:
+                    raise ValueError(f"No embedding model at {model_path}")
+                download_model()
+
+            tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=MAX_SEQUENCE_LENGTH)
+            tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+            options = ort.SessionOptions()
+            options.log_severity_level = 3
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            # One operator at a time, each split across the intra-op threads: the graph is a straight chain of layers
+            options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            options.intra_op_num_threads = self.threads
+            options.inter_op_num_threads = 1
+            session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+            self.inputs = {i.name for i in session.get_inputs()}
+            self.tokenizer = tokenizer
+            # Assigned last: other threads check it without the lock
+            self.session = session
+
+    def embed(self, texts):
+        if self.session is None:
+            self.load()
+        batches = []
+        for start in range(0, len(texts), BATCH_SIZE):
+            encoded = self.tokenizer.encode_batch(list(texts[start:start + BATCH_SIZE]))
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+            feed = {"input_ids": input_ids, "attention_mask": attention_mask,
+                    "token_type_ids": np.zeros_like(input_ids)}
+            last_hidden_state = self.session.run(None, {k: v for k, v in feed.items() if k in self.inputs})[0]
+            batches.append(mean_pool(last_hidden_state, attention_mask))
+        return np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts):
+        return self.embed(texts).tolist()
+
+    def embed_query(self, text):
+        return self.embed([text])[0].tolist()
+
+    def __call__(self, input):
+        # Chroma's embedding function interface
+        return self.embed_documents(input)
+
+
+def mean_pool(last_hidden_state, attention_mask):
+    mask = attention_mask[:, :, None].astype(np.float32)
+    pooled = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+    norms[norms == 0] = 1e-12
+    return (pooled / norms).astype(np.float32)
+
+
+def download_model():
+    # Chroma only downloads its export lazily from inside its own embedding function
+    embedding_functions.ONNXMiniLM_L6_V2()._download_model_if_not_exists()
+
+
+def quantize_model(source_dir=ONNX_MODEL_DIR, output_dir=ONNX_INT8_DIR):
+    """
+    Writes an int8 copy of the ONNX model with dynamic quantization: weights are stored as int8 per output channel
+    and activations are quantized on the fly, so no calibration set is needed. The tokenizer files are copied over.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    if source_dir == ONNX_MODEL_DIR and not os.path.exists(os.path.join(source_dir, MODEL_FILE)):
+        download_model()
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(source_dir):
+        if name != MODEL_FILE and os.path.isfile(os.path.join(source_dir, name)):
+            shutil.copy2(os.path.join(source_dir, name), os.path.join(output_dir, name))
+    # Written under a temporary name and renamed, so another process never loads a half written model
+    partial = os.path.join(output_dir, f"{MODEL_FILE}.{os.getpid()}.partial")
+    quantize_dynamic(os.path.join(source_dir, MODEL_FILE), partial, per_channel=True, weight_type=QuantType.QInt8)
+    os.replace(partial, os.path.join(output_dir, MODEL_FILE))
+    return os.path.join(output_dir, MODEL_FILE)
+
+
+def make_embedder(backend=EMBEDDING_BACKEND, threads=EMBEDDING_THREADS):
+    if backend == "onnx":
+        return OnnxEmbeddings(ONNX_MODEL_DIR, threads)
+    if backend == "onnx-int8":
+        if not os.path.exists(os.path.join(ONNX_INT8_DIR, MODEL_FILE)):
+            quantize_model(ONNX_MODEL_DIR, ONNX_INT8_DIR)
+        return OnnxEmbeddings(ONNX_INT8_DIR, threads)
+    if backend == "sentence-transformers":
+        from langchain.embeddings.sentence_transformer import \
+            SentenceTransformerEmbeddings
+
+        return SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL)
+    raise ValueError(f"Unknown embedding backend {backend}, expected one of {BACKENDS}")
+
+
+@lru_cache(maxsize=None)
+def get_embedder(backend=EMBEDDING_BACKEND, threads=EMBEDDING_THREADS):
+    """The shared embedder of a backend. Models load on the first text embedded, not here."""
+    return make_embedder(backend, threads)
+
+
+def embed_documents(documents):
+    return get_embedder().embed_documents(documents)
+
+
+def embed_query(text):
+    return get_embedder().embed_query(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare the embedding models")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    quantize_parser = subparsers.add_parser("quantize", help="Write the int8 model the onnx-int8 backend loads")
+    quantize_parser.add_argument("--source", default=ONNX_MODEL_DIR)
+    quantize_parser.add_argument("--output", default=ONNX_INT8_DIR)
+    args = parser.parse_args()
+
+    print(f"Wrote {quantize_model(args.source, args.output)}")
@@ -0,0 +1,206 @@
+import csv
+import hashlib
+import importlib
+import os
+import re
+from html.parser import HTMLParser
+
+# Bumped when the records a parser yields change, so files ingested by the old version are parsed again
+PARSER_VERSION = 1
+# Text files are yielded in blocks of about this many characters rather than read whole
+TEXT_BLOCK_CHARS = 8000
+HASH_BLOCK_BYTES = 1024 * 1024
+
+HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+FRONT_MATTER = re.compile(r"\A---\n.*?\n---\n", re.DOTALL)
+
+
+def record(text, **metadata):
+    """A page or section of a file: its text and the metadata stored with every chunk cut from it."""
+    return {"text": text, "metadata": metadata}
+
+
+def parse_pdf(file_path):
+    import fitz
+
+    with fitz.open(file_path) as pdf:
+        for number, page in enumerate(pdf, start=1):
+            yield record(page.get_text("text"), page=number)
+
+
+def markdown_sections(text):
+    """Splits markdown at its headings into (heading, level, text) sections, each text starting with its heading."""
+    heading, level, lines = "", 0, []
+    for line in text.splitlines():
+        match = HEADING.match(line)
+        if match:
+            if "".join(lines).strip():
+                yield heading, level, "\n".join(lines).strip()
+            heading, level, lines = match.group(2), len(match.group(1)), [line]
+        else:
+            lines.append(line)
+    if "".join(lines).strip():
+        yield heading, level, "\n".join(lines).strip()
+
+
+def parse_markdown(file_path):
+    with open(file_path, "r", encoding="utf-8", errors="replace") as md_file:
+        text = FRONT_MATTER.sub("", md_file.read(), count=1)
+    for heading, level, section in markdown_sections(text):
+        yield record(section, heading=heading, level=level)
+
+
+def parse_text(file_path):
+    block, size, number = [], 0, 0
+    with open(file_path, "r", encoding="utf-8", errors="replace") as text_file:
+        for line in text_file:
+            block.append(line)
+            size += len(line)
+            # Blocks end on a blank line, so paragraphs are not cut in two
+            if size >= TEXT_BLOCK_CHARS and not line.strip():
+                yield record("".join(block).strip(), block=number)
+                block, size, number = [], 0, number + 1
+    if "".join(block).strip():
+        yield record("".join(block).strip(), block=number)
+
+
+class SectionHTMLParser(HTMLParser):
+    """Collects the visible text of a page, starting a new section at every h1-h6."""
+
+    HEADINGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+    SKIPPED = ("script", "style", "noscript", "template")
+    BLOCKS = ("p", "div", "li", "tr", "br", "section", "article", "pre", "table", "ul", "ol") + HEADINGS
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.sections = []
+        self.heading = ""
+        self.parts = []
+        self.heading_parts = None
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self.skipping += 1
+        elif tag in self.HEADINGS:
+            self.flush()
+            self.heading_parts = []
+        if tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.HEADINGS and self.heading_parts is not None:
+            self.heading = " ".join("".join(self.heading_parts).split())
+            self.heading_parts = None
+        if tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        self.parts.append(data)
+        if self.heading_parts is not None:
+            self.heading_parts.append(data)
+
+    def flush(self):
+        text = re.sub(r"\n\s*\n+", "\n\n", "".join(self.parts)).strip()
+        if text:
+            self.sections.append(record(text, heading=self.heading))
+        self.parts = []
+
+
+def parse_html(file_path):
+    parser = SectionHTMLParser()
+    with open(file_path, "r", encoding="utf-8", errors="replace") as html_file:
+        while True:
+            data = html_file.read(64 * 1024)
+            if not data:
+                break
+            parser.feed(data)
+            # Sections completed so far are handed on while the rest of the file is still being read
+            yield from parser.sections
+            parser.sections = []
+    parser.close()
+    parser.flush()
+    yield from parser.sections
+
+
+def parse_csv(file_path):
+    with open(file_path, "r", newline="", encoding="utf-8", errors="replace") as csv_file:
+        for number, row in enumerate(csv.DictReader(csv_file), start=1):
+            text = "\n".join(f"{key}: {value}" for key, value in row.items() if key and value)
+            if text:
+                yield record(text, row=number)
+
+
+def parse_with_loader(file_path, loader):
+    """Formats without a parser of their own go through a langchain document loader, imported on first use."""
+    if isinstance(loader, str):
+        loader = getattr(importlib.import_module("langchain.document_loaders"), loader)
+    instance = loader(file_path)
+    try:
+        documents = instance.lazy_load()
+    except NotImplementedError:
+        documents = instance.load()
+    for document in documents:
+        # Chroma metadata values have to be scalars
+        metadata = {k: v for k, v in document.metadata.items()
+                    if isinstance(v, (str, int, float, bool)) and k != "source"}
+        yield record(document.page_content, **metadata)
+
+
+PARSERS = {
+    ".pdf": parse_pdf,
+    ".md": parse_markdown,
+    ".txt": parse_text,
+    ".html": parse_html,
+    ".htm": parse_html,
+    ".csv": parse_csv,
+}
+# Loader class for each extension without a parser, by name in langchain.document_loaders or as a class
+LOADERS = {
+    ".pptx": "UnstructuredPowerPointLoader",
+    ".docx": "Docx2txtLoader",
+}
+DEFAULT_LOADER = "UnstructuredFileLoader"
+
+
+def register_parser(extension, parser):
+    """parser(file_path) yields record()s."""
+    LOADERS.pop(extension.lower(), None)
+    PARSERS[extension.lower()] = parser
+
+
+def register_loader(extension, loader):
+    PARSERS.pop(extension.lower(), None)
+    LOADERS[extension.lower()] = loader
+
+
+def parser_for(file_path):
+    """Returns (name, parser) for a file. The name is stored with its chunks, so a changed parser re-ingests it."""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in PARSERS:
+        parser = PARSERS[extension]
+        return f"{parser.__name__}:{PARSER_VERSION}", parser
+    loader = LOADERS.get(extension, DEFAULT_LOADER)
+    name = loader if isinstance(loader, str) else loader.__name__
+    return f"{name}:{PARSER_VERSION}", lambda path: parse_with_loader(path, loader)
+
+
+def parse_file(file_path):
+    """Parses a file once, yielding its pages or sections as they are read."""
+    extension = os.path.splitext(file_path)[1].lower()
+    _, parser = parser_for(file_path)
+    for item in parser(file_path):
+        item["metadata"] = {"source": file_path, "format": extension.lstrip("."), **item["metadata"]}
+        yield item
+
+
+def sha256_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as data:
+        for block in iter(lambda: data.read(HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
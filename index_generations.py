@@ -0,0 +1,77 @@
+import os
+import shutil
+import time
+
+GENERATIONS_DIR = "generations"
+CURRENT_FILE = "CURRENT"
+NAME_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class IndexGenerations:
+    """
+    Keeps each build of the index in its own directory under <root>/generations and records the live one in
+    <root>/CURRENT. Promoting a generation rewrites CURRENT with an atomic rename, so a crash mid-swap leaves
+    either the old or the new generation live, never neither.
+    """
+
+    def __init__(self, root, keep=2):
+        self.root = root
+        self.keep = keep
+        self.generations_path = os.path.join(root, GENERATIONS_DIR)
+        os.makedirs(self.generations_path, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.generations_path, name)
+
+    def list(self):
+        # Generations oldest first
+        return sorted((n for n in os.listdir(self.generations_path) if os.path.isdir(self.path(n))), key=age)
+
+    def current(self):
+        try:
+            with open(os.path.join(self.root, CURRENT_FILE), "r", encoding="utf-8") as current_file:
+                name = current_file.read().strip()
+        except FileNotFoundError:
+            return None
+        return name if name and os.path.isdir(self.path(name)) else None
+
+    def create(self):
+        name = time.strftime(NAME_FORMAT)
+        suffix = 0
+        while os.path.exists(self.path(name if not suffix else f"{name}-{suffix}")):
+            suffix += 1
+        if suffix:
+            name = f"{name}-{suffix}"
+        os.makedirs(self.path(name))
+        return name
+
+    def promote(self, name):
+        if not os.path.isdir(self.path(name)):
+            raise ValueError(f"Index generation {name} does not exist")
+        current_path = os.path.join(self.root, CURRENT_FILE)
+        tmp_path = current_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+            tmp_file.write(name)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, current_path)
+
+    def discard(self, name):
+        shutil.rmtree(self.path(name), ignore_errors=True)
+
+    def collect_garbage(self, protected=()):
+        """Removes all but the newest `keep` generations. The live generation and `protected` ones always stay."""
+        current = self.current()
+        names = self.list()
+        keep = set(names[-self.keep:]) | {current} | set(protected)
+        removed = [n for n in names if n not in keep]
+        for name in removed:
+            self.discard(name)
+        return removed
+
+
+def age(name):
+    """Sort key of a generation name: its timestamp, then the suffix create() adds to tell same-second ones apart."""
+    parts = name.split("-")
+    suffix = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
+    return "-".join(parts[:2]), suffix, name
@@ -1,17 +1,13 @@
 import concurrent.futures
 import os
-import time
-from typing import List
 
-from langchain.docstore.document import Document
-from langchain.document_loaders import (CSVLoader, Docx2txtLoader, PyPDFLoader,
-                                        UnstructuredFileLoader,
-                                        UnstructuredHTMLLoader,
-                                        UnstructuredMarkdownLoader,
-                                        UnstructuredPowerPointLoader)
-from langchain.text_splitter import TokenTextSplitter
+from file_loaders import parse_file, parser_for, sha256_file
+from ingest_profile import IngestionProfiler, add_to_collection
 
-from coda_ingester import extract_sections
+# Chunks written to chroma at a time while a file is still being parsed
+WRITE_BATCH_CHUNKS = 64
+# File types load_data and the directory watcher ingest
+INGEST_EXTENSIONS = ('.pdf', '.md', '.txt', '.html', '.pptx', '.docx')
 
 
 # Chroma
@@ -37,51 +33,134 @@ class Ingest:
         percentage = (count_char / total_chars) * 100
         return percentage
 
-    def load_file(self, file_path) -> List[Document]:
-        _, file_extension = os.path.splitext(file_path)
-        data: List[Document]
-        if file_extension.lower() == '.html':
-            loader = UnstructuredHTMLLoader(file_path)
-            return loader.load()
-        elif file_extension.lower() == '.pdf':
-            loader = PyPDFLoader(file_path)
-            return loader.load()
-        elif file_extension.lower() == '.md':
-            loader = UnstructuredMarkdownLoader(file_path)
-            return loader.load()
-        elif file_extension.lower() == '.csv':
-            loader = CSVLoader(file_path)
-            return loader.load()
-        elif file_extension.lower() == '.pptx':
-            loader = UnstructuredPowerPointLoader(file_path)
-            return loader.load()
-        elif file_extension.lower() == '.docx':
-            loader = Docx2txtLoader(file_path)
-            return loader.load()
-        else:
-            # Perform action for other files or skip
-            return UnstructuredFileLoader(file_path).load()
-
-    def process_file(self, file_path, chunk_size=1000, chunk_overlap=400):
-        # text_splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    def load_file(self, file_path):
+        return parse_file(file_path)
+
+    def make_splitter(self, chunk_size, chunk_overlap):
+        from langchain.text_splitter import TokenTextSplitter
+
+        return TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    def fingerprint(self, file_path, chunk_size, chunk_overlap):
+        stat = os.stat(file_path)
+        return {"mtime": stat.st_mtime, "size": stat.st_size, "parser": parser_for(file_path)[0],
+                "chunking": f"{chunk_size}/{chunk_overlap}"}
+
+    def unchanged(self, file_path, fingerprint):
+        """
+        Whether the chunks stored for a file were cut from its current contents by the current parser. The mtime and
+        size are compared first; only when they differ is the file hashed, and a file that was merely touched has its
+        stored mtime updated rather than being parsed again. Sets fingerprint["sha256"] when it hashed the file.
+        """
+        stored = self.collection.get(where={"source": file_path}, include=["metadatas"])
+        # Chunks left by a parse that never finished are not marked complete, so the file is parsed again
+        if not stored["ids"] or not all(m.get("complete") for m in stored["metadatas"]):
+            return False
+        metadata = stored["metadatas"][0]
+        if any(metadata.get(k) != fingerprint[k] for k in ("parser", "chunking")):
+            return False
+        if metadata.get("mtime") == fingerprint["mtime"] and metadata.get("size") == fingerprint["size"]:
+            return True
+        fingerprint["sha256"] = sha256_file(file_path)
+        if metadata.get("sha256") != fingerprint["sha256"]:
+            return False
+        self.collection.update(ids=stored["ids"], metadatas=[{**m, "mtime": fingerprint["mtime"]}
+                                                             for m in stored["metadatas"]])
+        return True
+
+    def process_file(self, file_path, chunk_size=1000, chunk_overlap=400, profiler=None):
+        """
+        Parses the file once and chunks its pages or sections as they are read, replacing any chunks stored for it
+        before. Files whose chunks are up to date are skipped. The chunks are marked complete once the last batch is
+        written, and a file that fails part way has the chunks written so far removed. Returns the number of chunks
+        written.
+        """
+        if profiler is None:
+            profiler = IngestionProfiler(self.index_name)
+        # Stored as the source of each chunk, so the same file reached by another path is not ingested twice
+        file_path = os.path.abspath(file_path)
         try:
-            data = self.load_file(file_path=file_path)
-            # texts = text_splitter.split_documents(data)
-            texts = extract_sections(file_path)
-            for idx, t in enumerate(texts):
-                if self.percentage_of_char(t.page_content, ' ') > 25:
-                    print(f"Cleaning page {idx + 1}")
-                    clean = self.clean_string(t.page_content)
-                    t.page_content = clean
-            contents = [d.page_content for d in texts]
-            metadatas = [d.metadata for d in texts]
-            ids = [str(idx) for idx, d in enumerate(texts)]
-            self.collection.add(documents=contents, metadatas=metadatas, ids=ids)
-            # split and load into vector db
-            print(f"Found {len(data)} parts in file {file_path}")
+            with profiler.file(file_path) as profile:
+                profile.bytes_in = os.path.getsize(file_path)
+                fingerprint = self.fingerprint(file_path, chunk_size, chunk_overlap)
+                with profile.stage("fingerprint"):
+                    if self.unchanged(file_path, fingerprint):
+                        profile.skipped = True
+                        return 0
+                    if "sha256" not in fingerprint:
+                        fingerprint["sha256"] = sha256_file(file_path)
+                text_splitter = self.make_splitter(chunk_size, chunk_overlap)
+                self.collection.delete(where={"source": file_path})
+
+                records = iter(self.load_file(file_path))
+                parts = 0
+                contents, metadatas = [], []
+                while True:
+                    with profile.stage("parse"):
+                        item = next(records, None)
+                    if item is None:
+                        break
+                    parts += 1
+                    text = item["text"]
+                    if not text.strip():
+                        continue
+                    with profile.stage("clean"):
+                        if self.percentage_of_char(text, ' ') > 25:
+                            print(f"Cleaning part {parts} of {file_path}")
+                            text = self.clean_string(text)
+                    with profile.stage("split"):
+                        chunks = text_splitter.split_text(text)
+                    contents.extend(chunks)
+                    metadatas.extend({**item["metadata"], **fingerprint, "complete": False} for _ in chunks)
+                    if len(contents) >= WRITE_BATCH_CHUNKS:
+                        self.write_chunks(profile, file_path, contents, metadatas)
+                        contents, metadatas = [], []
+                if contents:
+                    self.write_chunks(profile, file_path, contents, metadatas)
+                self.mark_complete(file_path)
+                print(f"Found {parts} parts in file {file_path}")
+                return profile.chunks_out
         except Exception as e:
             print(f"process_file: Error parsing file {file_path}.  {e}")
+            try:
+                self.remove_file(file_path)
+            except Exception as cleanup_error:
+                print(f"process_file: Could not remove partial chunks of {file_path}.  {cleanup_error}")
+        return 0
+
+    def mark_complete(self, file_path):
+        stored = self.collection.get(where={"source": file_path}, include=["metadatas"])
+        if stored["ids"]:
+            self.collection.update(ids=stored["ids"], metadatas=[{**m, "complete": True}
+                                                                 for m in stored["metadatas"]])
+
+    def remove_file(self, file_path):
+        """Deletes the chunks stored for a file, e.g. once it is deleted. Returns how many there were."""
+        stored = self.collection.get(where={"source": os.path.abspath(file_path)}, include=[])
+        if stored["ids"]:
+            self.collection.delete(ids=stored["ids"])
+        return len(stored["ids"])
+
+    def stored_sources(self, folder_path):
+        """The files under folder_path that have chunks in the collection."""
+        prefix = os.path.join(os.path.abspath(folder_path), "")
+        metadatas = self.collection.get(include=["metadatas"])["metadatas"]
+        return {m["source"] for m in metadatas if m and str(m.get("source", "")).startswith(prefix)}
+
+    def write_chunks(self, profile, file_path, contents, metadatas):
+        # Ids are unique across files and stable, so re-ingesting a file replaces exactly its own chunks
+        first = profile.chunks_out
+        ids = [f"{file_path}:{first + i}" for i in range(len(contents))]
+        section = self.collection.name
+        for i, metadata in enumerate(metadatas):
+            chunk = first + i
+            metadata["chunk"] = chunk
+            # The collection is the chunk's section, as for the markdown loader, and its position orders the file's
+            # chunks for section expansion. The links lead to its neighbours; the last chunk's next one never exists
+            metadata.update(section=section, position=chunk, prev_section=section if chunk else "",
+                            prev_id=f"{file_path}:{chunk - 1}" if chunk else "", next_section=section,
+                            next_id=f"{file_path}:{chunk + 1}")
+        add_to_collection(self.collection, profile, contents, ids, metadatas)
 
     def process_directory(self, folder_path):
         for root, _, files in os.walk(folder_path):
@@ -97,10 +176,10 @@ class Ingest:
         self.process_file(item)
         # Add your processing logic here
 
-    def process_items(self, items):
+    def process_items(self, items, profiler=None):
         print(f"Processing items: {items}")
         for i in items:
-            self.process_file(i)
+            self.process_file(i, profiler=profiler)
 
     def worker(self, queue):
         while True:
@@ -110,28 +189,30 @@ class Ingest:
             self.process_item(item)
             queue.task_done()
 
-    def process(self, item_queue, total_items):
+    def process(self, item_queue, total_items, profiler=None):
         max_threads = 24
-        starttime = time.time()
+        owns_profiler = profiler is None
+        if owns_profiler:
+            profiler = IngestionProfiler(self.index_name)
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-            executor.map(self.process_items, item_queue)
-        print('That took {} seconds'.format(time.time() - starttime))
+            executor.map(lambda items: self.process_items(items, profiler), item_queue)
         print(f"processing a total of {total_items} of files")
+        if owns_profiler:
+            profiler.write()
 
-    def load_data(self, folder_path):
-        item_queue = []
-        total_items = 0
-
-        # Add items to the queue
+    def list_files(self, folder_path):
+        file_paths = []
         for root, _, files in os.walk(folder_path):
             for file in files:
-                group = []
                 file_path = os.path.join(root, file)
                 _, file_extension = os.path.splitext(file_path)
                 # only do file types we want to process
-                if file_extension.lower() in ('.pdf', '.md', '.txt', '.html', '.pptx', '.docx'):
-                    group.append(file_path)
-                    total_items = total_items + 1
-                item_queue.append(group)
+                if file_extension.lower() in INGEST_EXTENSIONS:
+                    file_paths.append(file_path)
+        return file_paths
+
+    def load_data(self, folder_path, profiler=None):
+        # Add items to the queue
+        item_queue = [[file_path] for file_path in self.list_files(folder_path)]
 
-        self.process(item_queue, total_items)
+        self.process(item_queue, len(item_queue), profiler)
@@ -0,0 +1,232 @@
+import concurrent.futures
+import os
+import threading
+import time
+import uuid
+
+from coda_sync import CODA_DOC_ID, CodaSync
+from ingest_profile import IngestionProfiler
+from markdown_loader import DOCS_PATH, delete_docs, docs_namespace, load_markdown_data
+
+# Ingestion runs on a small pool of low priority threads so it never starves the query path
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+INGEST_NICE = int(os.environ.get("INGEST_NICE", "10"))
+# Fraction of wall time a worker may spend ingesting; it sleeps in proportion to the work it just did.
+# This bounds GIL contention with queries, which thread priority alone does not
+INGEST_CPU_SHARE = float(os.environ.get("INGEST_CPU_SHARE", "0.5"))
+# Finished jobs are forgotten after this many seconds, and beyond this many, oldest first
+INGEST_JOB_TTL_SECONDS = float(os.environ.get("INGEST_JOB_TTL_SECONDS", "3600"))
+INGEST_JOBS_KEPT = int(os.environ.get("INGEST_JOBS_KEPT", "100"))
+
+JOB_KINDS = ("pdf", "directory", "github", "coda")
+
+
+def lower_thread_priority(nice=INGEST_NICE):
+    # On Linux a thread id is a valid PRIO_PROCESS target, so this only deprioritises the calling thread
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+    except (AttributeError, OSError) as e:
+        print(f"lower_thread_priority: Could not lower ingest thread priority. {e}")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class IngestJob:
+    def __init__(self, kind, path, repo=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.path = path
+        self.repo = repo
+        self.state = "queued"
+        self.error = None
+        self.files_total = None
+        self.files_done = 0
+        self.chunks_total = None
+        self.chunks_done = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    def set_total(self, files=None, chunks=None):
+        if files is not None:
+            self.files_total = files
+        if chunks is not None:
+            self.chunks_total = chunks
+
+    def advance(self, files=0, chunks=0):
+        self.files_done += files
+        self.chunks_done += chunks
+
+    def raise_if_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def eta_seconds(self, elapsed):
+        # Prefer chunk progress when the loader knows how many chunks remain, otherwise go by files
+        for done, total in ((self.chunks_done, self.chunks_total), (self.files_done, self.files_total)):
+            if total and done:
+                return round(elapsed / done * (total - done), 1)
+        return None
+
+    def to_dict(self):
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "path": self.path,
+            "repo": self.repo,
+            "state": self.state,
+            "error": self.error,
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "chunks_total": self.chunks_total,
+            "chunks_done": self.chunks_done,
+            "elapsed_seconds": round(elapsed, 3) if elapsed is not None else None,
+            "files_per_second": round(self.files_done / elapsed, 3) if elapsed else None,
+            "chunks_per_second": round(self.chunks_done / elapsed, 3) if elapsed else None,
+            "eta_seconds": self.eta_seconds(elapsed) if self.state == "running" else None,
+        }
+
+
+def github_url(repo):
+    return f"https://api.github.com/repos/{repo}/contents/"
+
+
+class IngestJobManager:
+    def __init__(self, doc_store, workers=INGEST_WORKERS, nice=INGEST_NICE, cpu_share=INGEST_CPU_SHARE,
+                 ttl=INGEST_JOB_TTL_SECONDS, kept=INGEST_JOBS_KEPT):
+        self.doc_store = doc_store
+        self.nice = nice
+        self.cpu_share = cpu_share
+        self.ttl = ttl
+        self.kept = kept
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ingest", initializer=self.lower_priority)
+
+    def lower_priority(self):
+        lower_thread_priority(self.nice)
+
+    def submit(self, kind, path, repo=None):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown ingest job kind {kind}, expected one of {JOB_KINDS}")
+        if kind == "github" and not repo:
+            raise ValueError("github jobs need a repo in owner/name form")
+        if kind in ("pdf", "directory") and not os.path.exists(path):
+            raise ValueError(f"{path} does not exist")
+        if kind == "coda" and not (path or CODA_DOC_ID):
+            raise ValueError("coda jobs need the doc id as their path, or CODA_DOC_ID")
+
+        job = IngestJob(kind, path, repo)
+        self.prune()
+        with self.jobs_lock:
+            self.jobs[job.id] = job
+        job.future = self.executor.submit(self.run, job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        self.prune()
+        return sorted(list(self.jobs.values()), key=lambda j: j.submitted_at)
+
+    def prune(self):
+        """
+        Forgets finished jobs older than the ttl, and the oldest ones beyond the kept count. Queued and running jobs
+        are always kept.
+        """
+        now = time.time()
+        with self.jobs_lock:
+            finished = sorted((j for j in self.jobs.values() if j.finished_at is not None),
+                              key=lambda j: j.finished_at, reverse=True)
+            for i, job in enumerate(finished):
+                if i >= self.kept or now - job.finished_at > self.ttl:
+                    del self.jobs[job.id]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.future.cancel():
+            job.state = "cancelled"
+            job.finished_at = time.time()
+        return job
+
+    def run(self, job):
+        job.state = "running"
+        job.started_at = time.time()
+        profiler = IngestionProfiler(f"job-{job.id}")
+        # The collections written to, when the job got far enough to know them
+        written = None
+        try:
+            if job.kind == "github":
+                with self.doc_store.write_lock:
+                    written = load_markdown_data(self.doc_store.client, github_url(job.repo), profiler,
+                                                 path=job.path or DOCS_PATH, job=job)
+            elif job.kind == "coda":
+                with self.doc_store.write_lock:
+                    result = CodaSync(job.path or CODA_DOC_ID).sync(self.doc_store.client, profiler, job)
+                written = result["collections"]
+            else:
+                self.ingest_files(job, profiler)
+                written = [self.doc_store.collection.name]
+            job.state = "succeeded"
+        except JobCancelled:
+            job.state = "cancelled"
+            self.remove_partial(job)
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e)
+            print(f"IngestJobManager: Job {job.id} failed. {e}")
+            self.remove_partial(job)
+        finally:
+            job.finished_at = time.time()
+            if job.files_done or job.chunks_done:
+                self.doc_store.index_changed(written)
+            profiler.write()
+
+    def remove_partial(self, job):
+        # A github job replaces the repo's rows before writing its own, so one stopped after it started writing leaves
+        # only some of them; they are removed, as Ingest.process_file removes a file's partial chunks. Files and Coda
+        # pages are each replaced whole, so other jobs leave nothing partial behind
+        if job.kind != "github" or not job.chunks_done:
+            return
+        try:
+            with self.doc_store.write_lock:
+                delete_docs(self.doc_store.client, docs_namespace(github_url(job.repo), job.path or DOCS_PATH))
+        except Exception as e:
+            print(f"IngestJobManager: Removing the rows of job {job.id} failed. {e}")
+
+    def ingest_files(self, job, profiler):
+        ingestor = self.doc_store.ingestor
+        file_paths = [job.path] if job.kind == "pdf" else ingestor.list_files(job.path)
+        job.set_total(files=len(file_paths))
+
+        for file_path in file_paths:
+            job.raise_if_cancelled()
+            started = time.perf_counter()
+            # One file at a time, so a rebuild is not held off for the whole job; the ingestor is read again each
+            # time in case a new index generation was swapped in meanwhile
+            with self.doc_store.write_lock:
+                chunks = self.doc_store.ingestor.process_file(file_path, profiler=profiler)
+            job.advance(files=1, chunks=chunks)
+            self.throttle(job, time.perf_counter() - started)
+
+    def throttle(self, job, busy_seconds):
+        if 0 < self.cpu_share < 1:
+            # Waiting on the cancel event rather than sleeping lets a cancel interrupt the pause
+            job.cancel_event.wait(busy_seconds * (1 - self.cpu_share) / self.cpu_share)
+
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            job.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from context import CONTEXT_TOKENIZERS, token_metadata
+from embeddings import embed_documents
+
+INGEST_REPORT_DIR = os.environ.get("INGEST_REPORT_DIR", "reports")
+
+
+class FileProfile:
+    def __init__(self, path):
+        self.path = path
+        self.bytes_in = 0
+        self.chunks_out = 0
+        # Set when the file was already ingested unchanged
+        self.skipped = False
+        self.stages = {}
+        self.error = None
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "seconds": round(self.seconds, 6),
+            "bytes_in": self.bytes_in,
+            "chunks_out": self.chunks_out,
+            "skipped": self.skipped,
+            "stages": {k: round(v, 6) for k, v in self.stages.items()},
+            "error": self.error,
+        }
+
+
+class IngestionProfiler:
+    """
+    Collects per-file, per-stage timings for one ingestion run and writes them out as a JSON report.
+    Files may be profiled from several worker threads at once.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.files = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def file(self, path):
+        profile = FileProfile(path)
+        with self.lock:
+            self.files.append(profile)
+        try:
+            yield profile
+        except Exception as e:
+            profile.error = str(e)
+            raise
+        finally:
+            profile.finish()
+
+    def report(self, slowest=10):
+        with self.lock:
+            files = [f.to_dict() for f in self.files]
+
+        stages = {}
+        for f in files:
+            for name, seconds in f["stages"].items():
+                stages[name] = round(stages.get(name, 0.0) + seconds, 6)
+
+        wall_seconds = time.perf_counter() - self.started
+        chunks_out = sum(f["chunks_out"] for f in files)
+        return {
+            "name": self.name,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "wall_seconds": round(wall_seconds, 6),
+            "totals": {
+                "files": len(files),
+                "errors": sum(1 for f in files if f["error"]),
+                "skipped": sum(1 for f in files if f["skipped"]),
+                "bytes_in": sum(f["bytes_in"] for f in files),
+                "chunks_out": chunks_out,
+                "chunks_per_second": round(chunks_out / wall_seconds, 3) if wall_seconds else 0.0,
+                "stages": stages,
+            },
+            "slowest_files": [f["path"] for f in sorted(files, key=lambda f: f["seconds"], reverse=True)[:slowest]],
+            "files": sorted(files, key=lambda f: str(f["path"])),
+        }
+
+    def write(self, directory=None):
+        directory = directory or INGEST_REPORT_DIR
+        report = self.report()
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, f"ingest-{self.name}-{self.started_at.strftime('%Y%m%d-%H%M%S')}")
+        # Reports started in the same second get a -N suffix instead of overwriting each other
+        suffix = 0
+        while True:
+            path = f"{stem}-{suffix}.json" if suffix else f"{stem}.json"
+            try:
+                report_file = open(path, "x", encoding="utf-8")
+            except FileExistsError:
+                suffix += 1
+                continue
+            with report_file:
+                json.dump(report, report_file, indent=2)
+            break
+
+        totals = report["totals"]
+        print(f"Ingested {totals['files']} files ({totals['bytes_in']} bytes, {totals['chunks_out']} chunks) "
+              f"in {report['wall_seconds']:.2f} seconds. Report written to {path}")
+        return path
+
+
+def add_to_collection(collection, profile, documents, ids, metadatas=None):
+    # Token counts are stored with each chunk so packing a context to a token budget never tokenizes at query time
+    if CONTEXT_TOKENIZERS:
+        with profile.stage("tokens"):
+            counts = token_metadata(documents)
+        if any(counts):
+            metadatas = [{**(m or {}), **c} for m, c in zip(metadatas or [None] * len(documents), counts)]
+    # Embed explicitly rather than inside collection.add so embedding and chroma write time are reported separately
+    with profile.stage("embed"):
+        embeddings = embed_documents(documents)
+    with profile.stage("write"):
+        collection.add(documents=documents, embeddings=embeddings, metadatas=metadatas, ids=ids)
+    profile.chunks_out += len(documents)
+
+
+def diff_reports(old, new):
+    old_files = {f["path"]: f for f in old["files"]}
+    new_files = {f["path"]: f for f in new["files"]}
+
+    stage_names = sorted(set(old["totals"]["stages"]) | set(new["totals"]["stages"]))
+    stages = {
+        name: {
+            "old": old["totals"]["stages"].get(name, 0.0),
+            "new": new["totals"]["stages"].get(name, 0.0),
+            "delta": round(new["totals"]["stages"].get(name, 0.0) - old["totals"]["stages"].get(name, 0.0), 6),
+        }
+        for name in stage_names
+    }
+
+    files = []
+    for path in sorted(set(old_files) & set(new_files), key=str):
+        delta = new_files[path]["seconds"] - old_files[path]["seconds"]
+        files.append({"path": path, "old": old_files[path]["seconds"], "new": new_files[path]["seconds"],
+                      "delta": round(delta, 6)})
+    files.sort(key=lambda f: abs(f["delta"]), reverse=True)
+
+    return {
+        "wall_seconds": {"old": old["wall_seconds"], "new": new["wall_seconds"],
+                         "delta": round(new["wall_seconds"] - old["wall_seconds"], 6)},
+        "stages": stages,
+        "files": files,
+        "added_files": sorted(set(new_files) - set(old_files), key=str),
+        "removed_files": sorted(set(old_files) - set(new_files), key=str),
+    }
+
+
+def load_report(path):
+    with open(path, "r", encoding="utf-8") as report_file:
+        return json.load(report_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect ingestion run reports")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show_parser = subparsers.add_parser("show", help="Print the slowest files of a report")
+    show_parser.add_argument("report")
+    diff_parser = subparsers.add_parser("diff", help="Compare two reports")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        report = load_report(args.report)
+        print(json.dumps({k: report[k] for k in ("name", "wall_seconds", "totals", "slowest_files")}, indent=2))
+    else:
+        print(json.dumps(diff_reports(load_report(args.old), load_report(args.new)), indent=2))
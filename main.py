@@ -1,18 +1,63 @@
+import os
 import sys
+import threading
+import time
+from typing import Optional
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 
+import metrics
+from query_log import QueryLog, load_warm_queries, warm
+from context import (CONTEXT_MAX_CHARS, CONTEXT_TOKENIZER, EXPAND_MODES,
+                     QUERY_TOKENIZERS)
+from deadlines import DEADLINE_HEADER, Deadline
 from document_store import DocumentStore
+from ingest_jobs import IngestJobManager
+from memory import MEMORY_TRACEMALLOC, MemoryGovernor, rss_bytes, start_tracing
+from watcher import WATCH_DIRS, DirectoryWatcher
 
-debugIt = False
+# Also enabled by running "python main.py debug"
+debugIt = os.environ.get("EIGHT_BALL_DEBUG") == "1"
 
 app = FastAPI()
 
+# Seconds between scheduled index rebuilds, 0 to only rebuild through /admin/rebuild/
+INDEX_REBUILD_INTERVAL = float(os.environ.get("INDEX_REBUILD_INTERVAL", "0"))
+
+# Traced from here, so the startup report covers the index and models loading
+if MEMORY_TRACEMALLOC:
+    start_tracing()
+
 doc_store = DocumentStore()
-doc_store.load_doug_date()
+# The live index generation survives restarts, so documents are only loaded when it is empty.
+# Set PRELOAD_DOCUMENTS=0 to serve an index that is already on disk, e.g. one seeded by a benchmark
+if os.environ.get("PRELOAD_DOCUMENTS", "1") == "1" and not doc_store.does_collection_exist("categories"):
+    doc_store.rebuild_index()
+
+ingest_jobs = IngestJobManager(doc_store)
+query_log = QueryLog()
+# Keeps the WATCH_DIRS directories indexed as files in them are added, changed or removed
+watcher = DirectoryWatcher(doc_store, WATCH_DIRS).start() if WATCH_DIRS else None
+# Accounts for resident memory and, with MEMORY_BUDGET_MB set, evicts caches and idle models to stay under it
+memory_governor = MemoryGovernor(doc_store).start()
+
+# Set once the most asked questions have been run against the loaded index; /ready/ answers 503 until then
+warm_status = None
+
+
+def warm_on_startup():
+    global warm_status
+    warm_status = warm(doc_store, load_warm_queries())
+    print(f"warm_on_startup: Warmed with {warm_status['queries']} queries in {warm_status['seconds']} seconds")
+    # Taken once the models and the indexes the warm queries touch are loaded
+    memory_governor.record_startup()
+
+
+threading.Thread(target=warm_on_startup, daemon=True).start()
 
 origins = [
     "http://localhost",
@@ -32,14 +77,173 @@ app.add_middleware(
 class QueryModel(BaseModel):
     input: str
     collection_name: str
+    # "neighbours" or "section" to return the best chunk with the text around it, up to max_chars
+    expand: Optional[str] = None
+    max_chars: Optional[int] = None
+    # Pack the best passages into at most this many tokens of the tokenizer (default CONTEXT_TOKENIZER)
+    token_budget: Optional[int] = None
+    tokenizer: Optional[str] = None
+
+
+class IngestModel(BaseModel):
+    # "pdf" or "directory" for a local path, "github" for a markdown path in a GitHub repo, "coda" for a Coda doc id
+    kind: str
+    path: str
+    repo: Optional[str] = None
+
+
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "eight_ball_collection_documents", "Documents stored in each chroma collection.", ["collection"],
+    doc_store.collection_sizes))
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "eight_ball_query_cache_hit_ratio", "Semantic query cache hit ratio at each probed similarity threshold.",
+    ["threshold"], lambda: doc_store.cache_stats()["hit_rate_by_threshold"]))
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "eight_ball_resident_memory_bytes", "Resident memory of the process.", [], lambda: {(): rss_bytes()}))
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "eight_ball_memory_component_bytes", "Estimated memory held by each component.", ["component"],
+    memory_governor.components))
 
 
 @app.post("/query/")
-def query(query_data: QueryModel):
+def query(query_data: QueryModel, deadline_ms: Optional[str] = Header(None, alias=DEADLINE_HEADER)):
     debug("Query received")
-    outside_context = doc_store.query_with_doug(query_data.input)
-    debug("The returned context is: " + outside_context)
-    return {"results": outside_context}
+    # Started before anything else so validation counts against it too
+    try:
+        deadline = Deadline.from_header(deadline_ms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if query_data.expand is not None and query_data.expand not in EXPAND_MODES:
+        raise HTTPException(status_code=400, detail=f"expand must be one of {EXPAND_MODES}")
+    if query_data.token_budget is not None:
+        if query_data.token_budget <= 0:
+            raise HTTPException(status_code=400, detail="token_budget must be positive")
+        # Counts for the ingestion tokenizers are stored with the chunks; loading any other one per request is refused
+        if query_data.tokenizer and query_data.tokenizer not in QUERY_TOKENIZERS:
+            raise HTTPException(status_code=400, detail=f"tokenizer must be one of {list(QUERY_TOKENIZERS)}")
+    started = time.perf_counter()
+    with metrics.QUERIES_IN_FLIGHT.track():
+        try:
+            outside_context = doc_store.query_context(query_data.input, query_data.expand,
+                                                      query_data.max_chars or CONTEXT_MAX_CHARS,
+                                                      query_data.token_budget,
+                                                      query_data.tokenizer or CONTEXT_TOKENIZER, deadline)
+            # Which stages ran, how long each took, and the fallbacks taken for any that ran out of time
+            outside_context["execution"] = deadline.report()
+            debug("The returned context is: " + outside_context["results"])
+            with metrics.QUERY_STAGE_SECONDS.time("serialization"):
+                response = JSONResponse(outside_context)
+        except Exception:
+            metrics.QUERIES_TOTAL.labels("error").inc()
+            query_log.record(query_data.input, time.perf_counter() - started, ok=False)
+            raise
+    metrics.QUERIES_TOTAL.labels("degraded" if deadline.degraded else "ok").inc()
+    query_log.record(query_data.input, time.perf_counter() - started)
+    return response
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/cache/stats/", status_code=200)
+def cache_stats():
+    return doc_store.cache_stats()
+
+
+@app.post("/admin/rebuild/", status_code=202)
+def rebuild_index():
+    if doc_store.rebuild_lock.locked():
+        return JSONResponse({"error": "An index rebuild is already running"}, status_code=409)
+    threading.Thread(target=run_rebuild, daemon=True).start()
+    return doc_store.index_status()
+
+
+@app.get("/admin/index/", status_code=200)
+def index_status():
+    return doc_store.index_status()
+
+
+@app.get("/admin/memory/", status_code=200)
+def memory_report(top: int = 20):
+    report = memory_governor.report(top)
+    report["startup"] = memory_governor.startup_report
+    return report
+
+
+@app.get("/admin/memory/tracemalloc/", status_code=200)
+def memory_snapshot(top: int = 20):
+    return memory_governor.snapshot(top)
+
+
+@app.delete("/admin/memory/tracemalloc/", status_code=200)
+def stop_memory_tracing():
+    memory_governor.stop_tracing()
+    return {"tracing": False}
+
+
+def run_rebuild():
+    try:
+        doc_store.rebuild_index()
+    except Exception as e:
+        print(f"run_rebuild: Index rebuild failed. {e}")
+
+
+def rebuild_on_schedule():
+    while True:
+        time.sleep(INDEX_REBUILD_INTERVAL)
+        run_rebuild()
+
+
+if INDEX_REBUILD_INTERVAL > 0:
+    threading.Thread(target=rebuild_on_schedule, daemon=True).start()
+
+
+@app.post("/ingest/", status_code=202)
+def submit_ingest_job(ingest_data: IngestModel):
+    try:
+        job = ingest_jobs.submit(ingest_data.kind, ingest_data.path, ingest_data.repo)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return job.to_dict()
+
+
+@app.get("/ingest/", status_code=200)
+def list_ingest_jobs():
+    return [job.to_dict() for job in ingest_jobs.list()]
+
+
+@app.get("/ingest/watch/", status_code=200)
+def watch_status():
+    if watcher is None:
+        raise HTTPException(status_code=404, detail="No directories are watched, see WATCH_DIRS")
+    return watcher.status()
+
+
+@app.get("/ingest/{job_id}", status_code=200)
+def get_ingest_job(job_id: str):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No ingest job {job_id}")
+    return job.to_dict()
+
+
+@app.delete("/ingest/{job_id}", status_code=200)
+def cancel_ingest_job(job_id: str):
+    job = ingest_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No ingest job {job_id}")
+    return job.to_dict()
+
+
+@app.on_event("shutdown")
+def stop_background_work():
+    if watcher is not None:
+        watcher.stop()
+    memory_governor.stop()
+    ingest_jobs.shutdown()
+    query_log.close()
 
 
 @app.get("/health/", status_code=200)
@@ -47,6 +251,13 @@ def health():
     return {}
 
 
+@app.get("/ready/", status_code=200)
+def ready():
+    if warm_status is None:
+        return JSONResponse({"ready": False}, status_code=503)
+    return {"ready": True, "warmed": warm_status}
+
+
 def debug(message):
     if debugIt:
         print(message)
@@ -56,7 +267,9 @@ if __name__ == '__main__':
     args = sys.argv[1:]
 
     if len(args) > 0 and args[0] == "debug":
-        debug = True
+        debugIt = True
 
-    uvicorn.run("main:app", host="0.0.0.0", port=8002,
+    # Serve this module's app rather than "main:app", which would import the module, its DocumentStore and
+    # its rebuild schedule a second time
+    uvicorn.run(app, host="0.0.0.0", port=8002,
                 reload=False, log_level="debug")
@@ -2,18 +2,25 @@ import ipaddress
 import os
 import re
 
-import outlines.models as models
-import outlines.text.generate as generate
 import requests
-from langchain.text_splitter import (MarkdownHeaderTextSplitter,
-                                     RecursiveCharacterTextSplitter)
+
+from category_router import EmbeddingRouter, GenerativeRouter
+from context import adjacency_metadata
+from embeddings import embed_documents
+from ingest_profile import FileProfile, IngestionProfiler, add_to_collection
+from metrics import QUERY_STAGE_SECONDS
+from sharding import merge_results
 
 GH_PA_TOKEN = os.environ.get("GH_PA_TOKEN")
 HEADERS = {'Authorization': f'token {GH_PA_TOKEN}'}
-model = None
+generative_router = None
+
+DOCS_PATH = "content/en/docs"
 
 CHUNK_SIZE = 2000
 CHUNK_OVERLAP = 150
+# Metadata key holding the repo and docs path every markdown row was loaded from, see docs_namespace
+DOCS_KEY = "docs"
 
 
 def make_valid_collection_name(description):
@@ -49,6 +56,15 @@ def make_valid_collection_name(description):
     return description
 
 
+def docs_namespace(url, path=DOCS_PATH):
+    """
+    The repo and docs path that prefix the ids of the rows loaded from them, e.g. "owner/name:content/en/docs", so
+    docs from several repos can share the categories and section collections without their ids colliding.
+    """
+    match = re.search(r"/repos/([^/]+/[^/]+)", url)
+    return f"{match.group(1) if match else url.rstrip('/')}:{path}"
+
+
 def fetch_markdown(url, path=''):
 
     response = requests.get(url + path, timeout=5, headers=HEADERS)
@@ -104,15 +120,29 @@ def extract_title_from_hugo_frontmatter(markdown_content):
         return ""
 
 
-def load_markdown_data(chroma_client, url):
+def load_markdown_data(chroma_client, url, profiler=None, path=DOCS_PATH, job=None):
+    owns_profiler = profiler is None
+    if owns_profiler:
+        profiler = IngestionProfiler("markdown")
 
     history_raw_text = ""
 
-    files = fetch_markdown(url, "content/en/docs")
+    with profiler.file(url) as profile:
+        with profile.stage("fetch"):
+            files = fetch_markdown(url, path)
+    if job is not None:
+        job.set_total(files=len(files))
 
     for file in files:
-        content = read_file(file)
+        if job is not None:
+            job.raise_if_cancelled()
+        with profiler.file(file['path']) as profile:
+            with profile.stage("fetch"):
+                content = read_file(file)
+            profile.bytes_in = len(content)
         history_raw_text = history_raw_text + content.decode('utf-8')
+        if job is not None:
+            job.advance(files=1)
 
     headers_to_split_on = [
         ("#", "Header 1"),
@@ -121,43 +151,92 @@ def load_markdown_data(chroma_client, url):
         ("####", "Header 4"),
     ]
 
-    md_splitter = MarkdownHeaderTextSplitter(
-        headers_to_split_on=headers_to_split_on)
-
-    data = md_splitter.split_text(history_raw_text)
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-    docs = text_splitter.split_documents(data)
-
-    for idx, row in enumerate(docs):
-        metadata = row.metadata
-
-        h1 = ""
-        if "Header 1" not in metadata:
-            h1 = {"Header 1": extract_title_from_hugo_frontmatter(
-                row.page_content)}
-            metadata = {**h1, **metadata}
-
-        row_number = str(idx)
-
-        row_description = create_description(metadata)
-        valid_keyword = make_valid_collection_name(row_description)
-
-        category = ""
-        for value in metadata.values():
-            category = category + " " + (value if value is not None else "")
-
-        metadata["category"] = category
-
-        store_text_with_header(
-            chroma_client, row_description, metadata, row_number)
-        section_collection = chroma_client.get_or_create_collection(
-            name=valid_keyword)
-        section_collection.add(documents=[row.page_content], ids=str(idx))
-
-
-def store_text_with_header(chroma_client, text, header_metadata, doc_id):
+    # langchain is only needed to load documents, so serving queries does not import it
+    from langchain.text_splitter import (MarkdownHeaderTextSplitter,
+                                         RecursiveCharacterTextSplitter)
+
+    # The files are split as one concatenated document, so splitting and storing is profiled as a single entry
+    with profiler.file(url + path) as profile:
+        with profile.stage("split"):
+            md_splitter = MarkdownHeaderTextSplitter(
+                headers_to_split_on=headers_to_split_on)
+
+            data = md_splitter.split_text(history_raw_text)
+
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+            docs = text_splitter.split_documents(data)
+        if job is not None:
+            job.set_total(chunks=len(docs))
+
+        chunks = []
+        for idx, row in enumerate(docs):
+            metadata = row.metadata
+
+            h1 = ""
+            if "Header 1" not in metadata:
+                h1 = {"Header 1": extract_title_from_hugo_frontmatter(
+                    row.page_content)}
+                metadata = {**h1, **metadata}
+
+            row_description = create_description(metadata)
+            valid_keyword = make_valid_collection_name(row_description)
+
+            category = ""
+            for value in metadata.values():
+                category = category + " " + (value if value is not None else "")
+
+            metadata["category"] = category
+            chunks.append((row, metadata, row_description, valid_keyword))
+
+        # A reload replaces the rows loaded from the same repo and path before: add() skips ids that already exist,
+        # and a shorter document would leave its old tail behind. Nothing fetched most likely means the fetch failed
+        namespace = docs_namespace(url, path)
+        if chunks:
+            delete_docs(chroma_client, namespace)
+
+        # Chunks are numbered in document order, so each one can point at its neighbours before any is stored
+        row_ids = [f"{namespace}:{idx}" for idx in range(len(chunks))]
+        adjacency = adjacency_metadata([(chunk[3], row_ids[idx]) for idx, chunk in enumerate(chunks)])
+        for idx, (row, metadata, row_description, valid_keyword) in enumerate(chunks):
+            if job is not None:
+                job.raise_if_cancelled()
+            row_id = row_ids[idx]
+
+            store_text_with_header(
+                chroma_client, row_description, {**metadata, DOCS_KEY: namespace}, row_id, profile)
+            section_collection = chroma_client.get_or_create_collection(
+                name=valid_keyword)
+            add_to_collection(section_collection, profile, [row.page_content], [row_id],
+                              [{**adjacency[idx], DOCS_KEY: namespace}])
+            if job is not None:
+                job.advance(chunks=1)
+
+    if owns_profiler:
+        profiler.write()
+    # The section collections written to; the ones that only lost rows to delete_docs changed their count instead
+    return sorted({chunk[3] for chunk in chunks})
+
+
+def delete_docs(chroma_client, namespace):
+    """Deletes the category and section rows loaded from a repo and docs path. Returns how many categories it had."""
+    try:
+        categories = chroma_client.get_collection(name="categories")
+    except ValueError:
+        return 0
+    stored = categories.get(where={DOCS_KEY: namespace}, include=["documents"])
+    # Each row's section collection is named after its category description
+    for name in {make_valid_collection_name(d) for d in stored["documents"]}:
+        try:
+            chroma_client.get_collection(name=name).delete(where={DOCS_KEY: namespace})
+        except ValueError:
+            pass
+    if stored["ids"]:
+        categories.delete(ids=stored["ids"])
+    return len(stored["ids"])
+
+
+def store_text_with_header(chroma_client, text, header_metadata, doc_id, profile=None):
     category_collection = chroma_client.get_or_create_collection(
         name="categories")
 
@@ -165,46 +244,77 @@ def store_text_with_header(chroma_client, text, header_metadata, doc_id):
     header_metadatas = [header_metadata]
     doc_ids = [doc_id]
 
-    chroma_id = category_collection.add(
-        documents=descriptions, metadatas=header_metadatas, ids=doc_ids)
-
-    return chroma_id
+    add_to_collection(category_collection, profile or FileProfile("categories"),
+                      descriptions, doc_ids, header_metadatas)
 
 
-def find_most_similar(input_string, string_list):
-    result = generate.choice(model=model, choices=string_list)(
-        f"Which one of these items is most relevant to this question: {input_string}")
-    return result
+def query_args(text, query_embedding=None):
+    # Reuse an embedding the caller already computed; otherwise embed with the configured backend, not chroma's own
+    if query_embedding is None:
+        query_embedding = embed_documents([text])[0]
+    return {"query_embeddings": [list(query_embedding)]}
 
 
-def query_with_doug(chroma_client, text, generative=False):
-    global model
-    category = ""
+def route_categories(chroma_client, text, generative=False, query_embedding=None, k=1):
+    global generative_router
 
-    # Use a generative model like Synthia-7b
-    if generative:
-        if model is None:
-            model = models.transformers(
-                "TheBloke/SynthIA-7B-v2.0-GPTQ", device="cuda:0")
+    with QUERY_STAGE_SECONDS.time("routing"):
+        # Use a generative model like Synthia-7b
+        if generative:
+            if generative_router is None:
+                generative_router = GenerativeRouter()
+            return generative_router.route(text, k)
+        # Use similarity search using an embedding model like "sentence-transformers/all-MiniLM-L6-v2"
+        return EmbeddingRouter(chroma_client).route(text, k, query_embedding=query_embedding)
 
-        doug_categories = load_csv_into_iterable_map(
-            "metadata/dougs_guide_categories.csv")
-        descriptions = [d["Description"] for d in doug_categories]
-        description = find_most_similar(text, descriptions)
 
-        for d in doug_categories:
+def route_category(chroma_client, text, generative=False, query_embedding=None):
+    categories = route_categories(chroma_client, text, generative, query_embedding)
+    return categories[0] if categories else ""
 
-            if d["Description"] == description:
-                category = d["Category"]
-    # Use similarity search using an embedding model like "sentence-transformers/all-MiniLM-L6-v2"
-    else:
-        collection = chroma_client.get_collection(name="categories")
-
-        results = collection.query(query_texts=[text], n_results=1)
-        category = results["metadatas"][0][0]['category']
 
+def query_category(chroma_client, category, text, query_embedding=None, n_results=1):
     valid_category = make_valid_collection_name(category)
     collection = chroma_client.get_collection(name=valid_category)
-    narrowed_result = collection.query(query_texts=[text], n_results=1)
+    return collection.query(**query_args(text, query_embedding), n_results=n_results)
+
+
+def query_categories(chroma_client, categories, text, query_embedding=None, n_results=1, section_store=None):
+    names = list(dict.fromkeys(make_valid_collection_name(c) for c in categories))
+    if query_embedding is None:
+        query_embedding = embed_documents([text])[0]
 
-    return narrowed_result
+    # A compact section store answers from quantized vectors; a sharded client fans out to its shards in parallel
+    for source in (section_store, chroma_client):
+        if hasattr(source, "query_collections"):
+            return source.query_collections(names, [list(query_embedding)], n_results)
+
+    results = []
+    for name in names:
+        try:
+            results.append(chroma_client.get_collection(name=name).query(
+                query_embeddings=[list(query_embedding)], n_results=n_results))
+        except ValueError:
+            pass
+    return merge_results(results, n_results)
+
+
+def query_with_doug(chroma_client, text, generative=False, query_embedding=None, top_k=1, section_store=None,
+                    n_results=1):
+    categories = route_categories(chroma_client, text, generative, query_embedding, top_k)
+    return narrowed_query(chroma_client, categories, text, query_embedding, top_k, section_store, n_results)
+
+
+def narrowed_query(chroma_client, categories, text, query_embedding=None, top_k=1, section_store=None, n_results=1,
+                   collections=()):
+    """
+    The chunks closest to the question within the categories it was routed to, and the `collections` searched
+    whatever the routing, such as the files in "default". None when there is nowhere to look.
+    """
+    with QUERY_STAGE_SECONDS.time("narrowed_query"):
+        if not categories and not collections:
+            return merge_results([], n_results)
+        if top_k > 1 or section_store is not None or collections:
+            return query_categories(chroma_client, list(categories) + list(collections), text, query_embedding,
+                                    n_results, section_store=section_store)
+        return query_category(chroma_client, categories[0], text, query_embedding, n_results)
@@ -0,0 +1,345 @@
+import ctypes
+import ctypes.util
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+from metrics import MEMORY_EVICTIONS
+
+# Resident memory the process tries to stay under, evicting caches and idle models past it; 0 disables the check
+MEMORY_BUDGET_MB = float(os.environ.get("MEMORY_BUDGET_MB", "0"))
+MEMORY_CHECK_INTERVAL = float(os.environ.get("MEMORY_CHECK_INTERVAL", "10"))
+# The router model is only unloaded to meet the budget once it has gone unused this long; reloading it is slow
+MEMORY_IDLE_SECONDS = float(os.environ.get("MEMORY_IDLE_SECONDS", "300"))
+# chroma keeps every vector index it has loaded for the life of the process. Above 0 it keeps the most recently
+# used ones, up to this many megabytes of index files, and unloads the rest
+CHROMA_MEMORY_LIMIT_MB = float(os.environ.get("CHROMA_MEMORY_LIMIT_MB", "0"))
+# Set to 1 to trace Python allocations from startup; otherwise tracing starts with the first snapshot asked for
+MEMORY_TRACEMALLOC = os.environ.get("MEMORY_TRACEMALLOC", "0") == "1"
+TRACEMALLOC_FRAMES = int(os.environ.get("TRACEMALLOC_FRAMES", "1"))
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# Always loaded: every query is routed through the categories and searches the files in default
+PINNED_COLLECTIONS = ("categories", "default")
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as statm_file:
+            return int(statm_file.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def chroma_settings():
+    """Settings for every local chroma client; chroma refuses two clients of one directory with different settings."""
+    from chromadb.config import Settings
+
+    if CHROMA_MEMORY_LIMIT_MB > 0:
+        # Older chroma releases have no LRU segment cache and reject its settings
+        if "chroma_segment_cache_policy" not in getattr(Settings, "__fields__", {}):
+            print("chroma_settings: This chroma has no segment cache policy, CHROMA_MEMORY_LIMIT_MB is ignored")
+            return Settings()
+        return Settings(chroma_segment_cache_policy="LRU",
+                        chroma_memory_limit_bytes=int(CHROMA_MEMORY_LIMIT_MB * 2 ** 20))
+    return Settings()
+
+
+def release_memory():
+    """Collects garbage and hands freed heap pages back to the OS, which glibc otherwise keeps for reuse."""
+    gc.collect()
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        libc.malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def start_tracing(frames=TRACEMALLOC_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def segment_manager(client):
+    # Only a local client has segments in this process; an HTTP client's indexes live in the chroma server
+    manager = getattr(getattr(client, "_server", None), "_manager", None)
+    return manager if hasattr(manager, "_instances") else None
+
+
+def vector_segment_cache(manager):
+    """The cache of loaded vector segments, or None on chroma releases that keep them elsewhere."""
+    from chromadb.types import SegmentScope
+
+    segment_cache = getattr(manager, "segment_cache", None)
+    return segment_cache.get(SegmentScope.VECTOR) if isinstance(segment_cache, dict) else None
+
+
+def vector_index_bytes(instance):
+    """Estimated memory of a loaded HNSW segment: the index, the buffer of vectors not yet indexed, and the id maps."""
+    total = 0
+    index = getattr(instance, "_index", None)
+    if index is not None:
+        # hnswlib allocates its bottom layer for max_elements up front: each element's vector, 2 * M neighbour ids,
+        # a neighbour count and its label
+        total += index.max_elements * (index.dim * 4 + 2 * index.M * 4 + 4 + 8)
+    brute_force = getattr(instance, "_brute_force_index", None)
+    vectors = getattr(brute_force, "vectors", None)
+    if vectors is not None:
+        total += vectors.nbytes
+    # Python dict entries with a short string key, roughly
+    entries = sum(len(getattr(instance, name, {})) for name in ("_id_to_label", "_label_to_id", "_id_to_seq_id"))
+    return total + entries * 100
+
+
+def loaded_vector_indexes(client):
+    """The vector indexes chroma has loaded, least recently used first, as {"collection", "id", "elements", "bytes"}."""
+    manager = segment_manager(client)
+    cache = vector_segment_cache(manager) if manager is not None else None
+    if cache is None:
+        return []
+    names = {c.id: c.name for c in client.list_collections()}
+    # The LRU policy keeps a use order; otherwise the cache is in load order
+    order = [k for k in getattr(cache, "history", []) if k in cache.cache] or list(cache.cache)
+    indexes = []
+    for collection_id in order:
+        segment = cache.cache.get(collection_id)
+        instance = manager._instances.get(segment["id"]) if segment is not None else None
+        if instance is None:
+            continue
+        # Vectors added since the index was last built wait in a brute force buffer, and are counted too
+        indexes.append({"collection": names.get(collection_id, str(collection_id)), "id": collection_id,
+                        "elements": instance.count(), "bytes": vector_index_bytes(instance)})
+    return indexes
+
+
+def evict_vector_index(client, collection_id):
+    """Unloads a collection's vector index as chroma's own LRU policy does; the next query loads it again."""
+    manager = segment_manager(client)
+    cache = vector_segment_cache(manager) if manager is not None else None
+    if cache is None:
+        return False
+    with manager._lock:
+        segment = cache.pop(collection_id)
+        if segment is None:
+            return False
+        instance = manager._instances.pop(segment["id"], None)
+        # Persistent indexes are also held open in an LRU of file handles
+        handles = getattr(manager, "_vector_instances_file_handle_cache", None)
+        if handles is not None:
+            handles.cache.pop(collection_id, None)
+        if instance is not None:
+            instance.stop()
+    return True
+
+
+def torch_model_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def embedder_bytes(embedder):
+    """Memory of a loaded embedding model, 0 while it is not loaded."""
+    if getattr(embedder, "session", None) is not None:
+        # onnxruntime holds the weights once, as read from the model file
+        model_dir = getattr(embedder, "model_dir", "")
+        return sum(os.path.getsize(os.path.join(model_dir, f)) for f in os.listdir(model_dir) if f.endswith(".onnx"))
+    client = getattr(embedder, "client", None)
+    if hasattr(client, "parameters"):
+        return torch_model_bytes(client)
+    return 0
+
+
+def generative_chooser():
+    # Only looked up, never imported: the query path does not load the router unless generative routing is used
+    router = getattr(sys.modules.get("markdown_loader"), "generative_router", None)
+    return router, getattr(router, "chooser", None)
+
+
+class MemoryGovernor:
+    """
+    Accounts for the process's resident memory by component and, given a budget, keeps it under that by evicting
+    in turn the query cache, the router model once idle, and the least recently used vector indexes.
+    The component sizes are estimates from the sizes of the structures behind them; the rest of RSS is reported as
+    unaccounted.
+    """
+
+    def __init__(self, doc_store, budget_mb=MEMORY_BUDGET_MB, interval=MEMORY_CHECK_INTERVAL,
+                 idle_seconds=MEMORY_IDLE_SECONDS):
+        self.doc_store = doc_store
+        self.budget = int(budget_mb * 2 ** 20) if budget_mb > 0 else None
+        self.interval = interval
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.startup_report = None
+        self.last_enforcement = None
+        self.enforcements = 0
+        self.previous_snapshot = None
+
+    def start(self):
+        if self.budget is not None:
+            self.thread = threading.Thread(target=self.run, name="memory", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.enforce()
+            except Exception as e:
+                print(f"MemoryGovernor: Enforcing the memory budget failed. {e}")
+
+    def components(self, indexes=None):
+        doc_store = self.doc_store
+        if indexes is None:
+            indexes = loaded_vector_indexes(doc_store.client)
+        _, chooser = generative_chooser()
+        model = getattr(chooser, "model", None)
+        section_store = getattr(doc_store, "section_store", None)
+        return {
+            "embedding_model": embedder_bytes(doc_store.embedding_function),
+            "generative_model": torch_model_bytes(model) if hasattr(model, "parameters") else 0,
+            "vector_indexes": sum(i["bytes"] for i in indexes),
+            "query_cache": doc_store.query_cache.nbytes(),
+            "compact_store": section_store.stats()["bytes"] if section_store is not None else 0,
+            "category_descriptions": sum(len(k) + len(v) for k, v in doc_store.category_descriptions.items()),
+        }
+
+    def report(self, top=20):
+        indexes = loaded_vector_indexes(self.doc_store.client)
+        components = self.components(indexes)
+        rss = rss_bytes()
+        return {
+            "rss_bytes": rss,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "budget_bytes": self.budget,
+            "components": components,
+            # The interpreter, imported modules, native libraries and anything not estimated above
+            "unaccounted_bytes": max(0, rss - sum(components.values())),
+            "vector_indexes": {
+                "loaded": len(indexes),
+                "largest": [{k: v for k, v in i.items() if k != "id"}
+                            for i in sorted(indexes, key=lambda i: i["bytes"], reverse=True)[:top]],
+            },
+            "tracemalloc": tracemalloc.is_tracing(),
+            "enforcements": self.enforcements,
+            "last_enforcement": self.last_enforcement,
+        }
+
+    def record_startup(self):
+        self.startup_report = self.report(top=5)
+        lines = [f"{name}={size / 2 ** 20:.1f}MB" for name, size in self.startup_report["components"].items()]
+        print(f"MemoryGovernor: RSS {self.startup_report['rss_bytes'] / 2 ** 20:.1f}MB at startup, " +
+              ", ".join(lines) + f", unaccounted={self.startup_report['unaccounted_bytes'] / 2 ** 20:.1f}MB")
+        return self.startup_report
+
+    def snapshot(self, top=20):
+        """
+        The lines allocating the most Python memory, and the most growth since the previous snapshot. Tracing starts
+        on the first call when MEMORY_TRACEMALLOC is off, so that one only reports it started.
+        """
+        if not tracemalloc.is_tracing():
+            start_tracing()
+            self.previous_snapshot = None
+            return {"tracing": True, "started": True, "top": [], "growth": []}
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "tracing": True,
+            "started": False,
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "top": [{"location": str(s.traceback), "bytes": s.size, "blocks": s.count}
+                    for s in snapshot.statistics("lineno")[:top]],
+            "growth": [],
+        }
+        if self.previous_snapshot is not None:
+            result["growth"] = [{"location": str(s.traceback), "bytes": s.size_diff, "blocks": s.count_diff}
+                                for s in snapshot.compare_to(self.previous_snapshot, "lineno")[:top]
+                                if s.size_diff > 0]
+        self.previous_snapshot = snapshot
+        return result
+
+    def stop_tracing(self):
+        self.previous_snapshot = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def enforce(self):
+        """Evicts until RSS is under the budget, cheapest to rebuild first. Returns what was evicted."""
+        if self.budget is None:
+            return []
+        with self.lock:
+            before = rss_bytes()
+            if before <= self.budget:
+                return []
+            actions = []
+            for step in (self.evict_query_cache, self.unload_idle_router, self.evict_vector_indexes):
+                actions.extend(step())
+                if rss_bytes() <= self.budget:
+                    break
+            self.enforcements += 1
+            self.last_enforcement = {"at": time.time(), "rss_before_bytes": before, "rss_after_bytes": rss_bytes(),
+                                     "budget_bytes": self.budget, "actions": actions}
+            print(f"MemoryGovernor: RSS {before / 2 ** 20:.1f}MB over the {self.budget / 2 ** 20:.1f}MB budget, "
+                  f"now {self.last_enforcement['rss_after_bytes'] / 2 ** 20:.1f}MB after {actions}")
+            return actions
+
+    def evict_query_cache(self):
+        if not self.doc_store.query_cache.stats()["entries"]:
+            return []
+        self.doc_store.query_cache.invalidate()
+        release_memory()
+        MEMORY_EVICTIONS.labels("query_cache").inc()
+        return ["query_cache"]
+
+    def unload_idle_router(self):
+        router, chooser = generative_chooser()
+        if getattr(chooser, "model", None) is None:
+            return []
+        last_used = getattr(router, "last_used", None)
+        if last_used is not None and time.monotonic() - last_used < self.idle_seconds:
+            return []
+        with getattr(chooser, "lock", threading.Lock()):
+            # Both choosers load their model again on the next question routed to them
+            chooser.model = None
+            if hasattr(chooser, "prefixes"):
+                chooser.prefixes = {}
+        release_memory()
+        MEMORY_EVICTIONS.labels("generative_model").inc()
+        return ["generative_model"]
+
+    def evict_vector_indexes(self):
+        client = self.doc_store.client
+        indexes = [i for i in loaded_vector_indexes(client) if i["collection"] not in PINNED_COLLECTIONS]
+        evicted = []
+        # A quarter at a time, least recently used first, measuring in between
+        batch = max(1, len(indexes) // 4)
+        for start in range(0, len(indexes), batch):
+            for index in indexes[start:start + batch]:
+                if evict_vector_index(client, index["id"]):
+                    evicted.append(index["collection"])
+                    MEMORY_EVICTIONS.labels("vector_index").inc()
+            release_memory()
+            if rss_bytes() <= self.budget:
+                break
+        return [f"vector_index:{name}" for name in evicted]
@@ -0,0 +1,250 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Chosen to cover a cached answer (sub millisecond) through a cold model load
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _ShardedValues:
+    """
+    A fixed size list of numbers where every thread writes to its own shard. Writers never take a lock (the lock
+    is only taken the first time a thread touches the metric), and a scrape sums the shards.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = [0] * self.size
+            with self.lock:
+                self.shards.append(values)
+            self.local.values = values
+            return values
+
+    def totals(self):
+        with self.lock:
+            shards = list(self.shards)
+        totals = [0] * self.size
+        for values in shards:
+            for i, value in enumerate(values):
+                totals[i] += value
+        return totals
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.values = _ShardedValues(1)
+
+    def inc(self, amount=1):
+        self.values.shard()[0] += amount
+
+    def dec(self, amount=1):
+        self.values.shard()[0] -= amount
+
+    def value(self):
+        return self.values.totals()[0]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return [f"{self.name}{self._label_text(k)} {_number(c.value())}" for k, c in list(self.children.items())]
+
+
+class Gauge(Counter):
+    """A gauge that is moved up and down, e.g. requests in flight."""
+
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    @contextmanager
+    def track(self, *labels):
+        child = self.labels(*labels)
+        child.inc()
+        try:
+            yield
+        finally:
+            child.dec()
+
+
+class CallbackGauge(_Metric):
+    """A gauge whose values are only computed at scrape time. The callback returns {label values tuple: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames, callback):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            print(f"metrics: Error collecting {self.name}. {e}")
+            return []
+        lines = []
+        for labels, value in values.items():
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            lines.append(f"{self.name}{self._label_text(labels)} {_number(value)}")
+        return lines
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket, one for +Inf, then the running sum
+        self.values = _ShardedValues(len(buckets) + 2)
+
+    def observe(self, value):
+        values = self.values.shard()
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self, *labels):
+        return self.labels(*labels).time()
+
+    def samples(self):
+        lines = []
+        for key, child in list(self.children.items()):
+            totals = child.values.totals()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), totals[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else _number(bound)
+                lines.append(f"{self.name}_bucket{self._label_text(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_number(totals[-1])}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+QUERY_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "eight_ball_query_stage_seconds", "Time spent in each stage of a /query/ request.", ["stage"]))
+QUERIES_TOTAL = REGISTRY.register(Counter(
+    "eight_ball_queries_total", "Queries handled, by outcome.", ["outcome"]))
+QUERIES_IN_FLIGHT = REGISTRY.register(Gauge(
+    "eight_ball_queries_in_flight", "Queries currently being handled."))
+QUERY_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "eight_ball_query_cache_lookups_total", "Semantic query cache lookups, by result.", ["result"]))
+QUERY_STAGE_TIMEOUTS = REGISTRY.register(Counter(
+    "eight_ball_query_stage_timeouts_total", "Query stages given up on at the request deadline, by how.",
+    ["stage", "outcome"]))
+MEMORY_EVICTIONS = REGISTRY.register(Counter(
+    "eight_ball_memory_evictions_total", "Caches and models evicted to keep resident memory under its budget.",
+    ["component"]))
+
+# Pre-create the label sets used on the hot path so a request never allocates a new child
+for _stage in ("embedding", "cache", "routing", "narrowed_query", "serialization"):
+    QUERY_STAGE_SECONDS.labels(_stage)
+for _outcome in ("ok", "degraded", "error"):
+    QUERIES_TOTAL.labels(_outcome)
+for _result in ("hit", "miss"):
+    QUERY_CACHE_LOOKUPS.labels(_result)
+QUERIES_IN_FLIGHT.labels()
@@ -0,0 +1,166 @@
+import os
+import threading
+
+import numpy as np
+
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "256"))
+QUERY_CACHE_THRESHOLD = float(os.environ.get("QUERY_CACHE_THRESHOLD", "0.92"))
+
+# Thresholds we report "would have hit" rates for, so the live threshold can be tuned from real traffic
+THRESHOLD_PROBES = (0.80, 0.85, 0.90, 0.92, 0.95, 0.98)
+
+
+class SemanticQueryCache:
+    """
+    Caches query results keyed on the query embedding. A lookup hits when the cosine similarity between the new
+    query and a cached one is at or above the threshold, so paraphrases of a recent question share one result.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, threshold=QUERY_CACHE_THRESHOLD, probes=THRESHOLD_PROBES):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.probes = tuple(probes)
+        self.lock = threading.Lock()
+
+        # The matrix is allocated on first insert, once we know the embedding dimension
+        self.matrix = None
+        self.values = [None] * max_entries
+        # The question each entry was stored for, so it can be found again without an embedding
+        self.questions = {}
+        self.last_used = np.zeros(max_entries, dtype=np.int64)
+        self.size = 0
+        self.clock = 0
+
+        # Bumped on every invalidation so results computed against an old index are not stored
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.probe_hits = [0] * len(self.probes)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return vector
+        return vector / norm
+
+    def get(self, embedding):
+        if not self.enabled:
+            return None
+
+        vector = self.normalize(embedding)
+        with self.lock:
+            best_idx, best_similarity = self._nearest(vector)
+
+            for i, probe in enumerate(self.probes):
+                if best_similarity >= probe:
+                    self.probe_hits[i] += 1
+
+            if best_idx is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.clock += 1
+            self.last_used[best_idx] = self.clock
+            return self.values[best_idx]
+
+    @staticmethod
+    def question_key(question):
+        return " ".join(question.lower().split())
+
+    def get_question(self, question):
+        """The entry stored for this exact question, for when there is no time to embed it. Not counted in stats."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            slot = self.questions.get(self.question_key(question))
+            if slot is None:
+                return None
+            self.clock += 1
+            self.last_used[slot] = self.clock
+            return self.values[slot]
+
+    def put(self, embedding, value, generation=None, question=None):
+        if not self.enabled:
+            return
+
+        vector = self.normalize(embedding)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            if self.matrix is None:
+                self.matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+            # Paraphrases that already hit an existing entry refresh it rather than taking a new slot
+            best_idx, best_similarity = self._nearest(vector)
+            if best_idx is not None and best_similarity >= self.threshold:
+                slot = best_idx
+            elif self.size < self.max_entries:
+                slot = self.size
+                self.size += 1
+            else:
+                slot = int(np.argmin(self.last_used[:self.size]))
+                self.evictions += 1
+                self.questions = {q: s for q, s in self.questions.items() if s != slot}
+
+            self.clock += 1
+            self.matrix[slot] = vector
+            self.values[slot] = value
+            if question is not None:
+                self.questions[self.question_key(question)] = slot
+            self.last_used[slot] = self.clock
+
+    def invalidate(self):
+        with self.lock:
+            self.size = 0
+            self.values = [None] * self.max_entries
+            self.questions = {}
+            self.last_used[:] = 0
+            self.generation += 1
+            self.invalidations += 1
+
+    def _nearest(self, vector):
+        if self.size == 0:
+            return None, -1.0
+        similarities = self.matrix[:self.size] @ vector
+        best_idx = int(np.argmax(similarities))
+        return best_idx, float(similarities[best_idx])
+
+    def nbytes(self):
+        """Roughly the memory held: the embedding matrix and the text of the cached hits."""
+        with self.lock:
+            matrix = self.matrix.nbytes if self.matrix is not None else 0
+            # Values are the ranked hits of a query
+            texts = sum(len(hit["text"]) if isinstance(hit, dict) else len(str(hit))
+                        for value in self.values[:self.size] if value is not None
+                        for hit in (value if isinstance(value, list) else [value]))
+            return matrix + self.last_used.nbytes + texts
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self.size,
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "lookups": lookups,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate_by_threshold": {
+                    str(probe): (count / lookups if lookups else 0.0)
+                    for probe, count in zip(self.probes, self.probe_hits)
+                },
+            }
@@ -0,0 +1,175 @@
+import argparse
+import glob
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter
+
+# Directory for the rotating query log. Off by default: the log holds users' questions verbatim
+QUERY_LOG_DIR = os.environ.get("QUERY_LOG_DIR", "")
+QUERY_LOG_MAX_BYTES = int(os.environ.get("QUERY_LOG_MAX_BYTES", str(16 * 1024 * 1024)))
+QUERY_LOG_BACKUPS = int(os.environ.get("QUERY_LOG_BACKUPS", "5"))
+# Questions run at startup to warm the models, index and query cache, written by "python query_log.py top"
+WARM_QUERIES = os.environ.get("WARM_QUERIES", os.path.join(QUERY_LOG_DIR or "logs", "top_queries.json"))
+
+LOG_FILE = "queries.jsonl"
+# Entries waiting for the writer beyond this are dropped rather than slowing down queries
+QUEUE_SIZE = 10000
+# Longest close() waits for the writer to finish the entries queued before it
+CLOSE_TIMEOUT = 5.0
+
+
+class QueryLog:
+    """
+    Appends one JSON line per query. record() only enqueues; a background thread batches the writes and rotates
+    the file once it passes max_bytes, keeping `backups` old files as queries.jsonl.1 (newest) and up.
+    """
+
+    def __init__(self, directory=QUERY_LOG_DIR, max_bytes=QUERY_LOG_MAX_BYTES, backups=QUERY_LOG_BACKUPS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.entries = queue.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
+        self.written = 0
+        # Entries lost because the file could not be written
+        self.errors = 0
+        self.thread = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, LOG_FILE)
+            self.thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+            self.thread.start()
+
+    @property
+    def enabled(self):
+        return self.thread is not None
+
+    def record(self, text, seconds, ok=True):
+        if not self.enabled:
+            return
+        try:
+            self.entries.put_nowait({"t": round(time.time(), 3), "q": text, "ms": round(seconds * 1000, 3), "ok": ok})
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        if self.enabled:
+            try:
+                self.entries.put(None, timeout=timeout)
+            except queue.Full:
+                print("QueryLog: The writer is not keeping up, closing without it")
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _run(self):
+        log_file = None
+        try:
+            while True:
+                batch = [self.entries.get()]
+                while not self.entries.empty() and len(batch) < 1000:
+                    batch.append(self.entries.get_nowait())
+                stop = None in batch
+                try:
+                    # Reopened after a failed write, so a full disk or a removed directory only costs those entries
+                    if log_file is None:
+                        log_file = open(self.path, "a", encoding="utf-8")
+                    lines = "".join(json.dumps(e) + "\n" for e in batch if e is not None)
+                    log_file.write(lines)
+                    log_file.flush()
+                    self.written += len(batch) - stop
+                    if log_file.tell() >= self.max_bytes:
+                        log_file.close()
+                        log_file = None
+                        self._rotate()
+                except Exception as e:
+                    self.errors += len(batch) - stop
+                    print(f"QueryLog: Writing {len(batch) - stop} entries to {self.path} failed. {e}")
+                    if log_file is not None:
+                        try:
+                            log_file.close()
+                        except OSError:
+                            pass
+                        log_file = None
+                if stop:
+                    return
+        finally:
+            if log_file is not None:
+                log_file.close()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+def normalize(text):
+    # Questions differing only in case, spacing or trailing punctuation count as one
+    return re.sub(r"\s+", " ", text.lower()).strip().rstrip("?!. ")
+
+
+def read_entries(directory=QUERY_LOG_DIR):
+    for path in sorted(glob.glob(os.path.join(directory, LOG_FILE + "*"))):
+        with open(path, "r", encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a log that was being written when the process died may be cut off
+                    continue
+
+
+def top_queries(entries, n=50):
+    """The n most asked questions, each as the wording it was most often asked in."""
+    counts = Counter()
+    wordings = {}
+    for entry in entries:
+        if not entry.get("ok", True):
+            continue
+        key = normalize(entry["q"])
+        counts[key] += 1
+        wordings.setdefault(key, Counter())[entry["q"]] += 1
+    return [{"query": wordings[key].most_common(1)[0][0], "count": count} for key, count in counts.most_common(n)]
+
+
+def load_warm_queries(path=WARM_QUERIES):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as warm_file:
+        return [q["query"] for q in json.load(warm_file)]
+
+
+def warm(doc_store, queries):
+    """Runs each question once, loading the models and index pages it touches and filling the query cache."""
+    started = time.perf_counter()
+    failed = 0
+    for text in queries:
+        try:
+            doc_store.query_with_doug(text)
+        except Exception as e:
+            failed += 1
+            print(f"warm: Warming query '{text}' failed. {e}")
+    return {"queries": len(queries), "failed": failed, "seconds": round(time.perf_counter() - started, 3)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise the query log")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    top_parser = subparsers.add_parser("top", help="Write the most asked questions for startup warming")
+    top_parser.add_argument("--dir", default=QUERY_LOG_DIR or "logs")
+    top_parser.add_argument("--n", type=int, default=50)
+    top_parser.add_argument("--output", default=WARM_QUERIES)
+    args = parser.parse_args()
+
+    top = top_queries(read_entries(args.dir), args.n)
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump(top, output_file, indent=2)
+    print(json.dumps(top[:10], indent=2))
+    print(f"Wrote {len(top)} questions to {args.output}")
@@ -0,0 +1,228 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import time
+import zlib
+
+import chromadb
+
+# Comma separated host:port list of chroma servers. When set, DocumentStore shards its collections across them
+CHROMA_SHARDS = os.environ.get("CHROMA_SHARDS", "")
+# Optional JSON file pinning collections to shard indexes, written by "python sharding.py rebalance --balance"
+SHARD_MAP = os.environ.get("SHARD_MAP", "")
+
+# Small collections every query touches stay together on the first shard
+PINNED_COLLECTIONS = ("categories", "default")
+
+REBALANCE_PAGE_SIZE = 500
+
+
+def parse_addresses(addresses):
+    parsed = []
+    for address in addresses.split(","):
+        if address.strip():
+            host, _, port = address.strip().rpartition(":")
+            parsed.append((host or "localhost", int(port)))
+    return parsed
+
+
+def load_shard_map(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as map_file:
+        return json.load(map_file)
+
+
+def shard_for(name, shard_count, shard_map=None):
+    if name in PINNED_COLLECTIONS:
+        return 0
+    if shard_map and name in shard_map and shard_map[name] < shard_count:
+        return shard_map[name]
+    # crc32 rather than hash() so every process agrees on the placement
+    return zlib.crc32(name.encode("utf-8")) % shard_count
+
+
+class ShardedClient:
+    """
+    Presents several chroma servers as one client. Each collection lives on exactly one shard, chosen by
+    shard_for, so ingestion code that calls get_or_create_collection is routed without knowing about shards.
+    Queries over several collections fan out to their shards in parallel and are merged by distance.
+    """
+
+    def __init__(self, addresses=CHROMA_SHARDS, shard_map_path=SHARD_MAP):
+        if isinstance(addresses, str):
+            addresses = parse_addresses(addresses)
+        self.addresses = list(addresses)
+        # chroma's HttpClient keeps a requests.Session per client, so connections to each shard are pooled
+        self.shards = [chromadb.HttpClient(host=host, port=port) for host, port in self.addresses]
+        self.shard_map = load_shard_map(shard_map_path)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(4, 2 * len(self.shards)),
+                                                              thread_name_prefix="shard")
+
+    def shard(self, name):
+        return self.shards[shard_for(name, len(self.shards), self.shard_map)]
+
+    def get_collection(self, name, **kwargs):
+        return self.shard(name).get_collection(name=name, **kwargs)
+
+    def get_or_create_collection(self, name, **kwargs):
+        return self.shard(name).get_or_create_collection(name=name, **kwargs)
+
+    def create_collection(self, name, **kwargs):
+        return self.shard(name).create_collection(name=name, **kwargs)
+
+    def delete_collection(self, name):
+        return self.shard(name).delete_collection(name=name)
+
+    def list_collections(self):
+        collections = []
+        for shard_collections in self.executor.map(lambda shard: shard.list_collections(), self.shards):
+            collections.extend(shard_collections)
+        return collections
+
+    def heartbeat(self):
+        return list(self.executor.map(lambda shard: shard.heartbeat(), self.shards))
+
+    def query_collections(self, names, query_embeddings, n_results=1):
+        """Queries each named collection on its shard in parallel and returns the n_results closest documents."""
+
+        def query_one(name):
+            try:
+                return self.get_collection(name).query(query_embeddings=query_embeddings, n_results=n_results)
+            except ValueError:
+                return None
+
+        return merge_results(list(self.executor.map(query_one, names)), n_results)
+
+
+def merge_results(results, n_results):
+    """Merges chroma query results for a single query by ascending distance."""
+    hits = []
+    for result in results:
+        if not result or not result["ids"] or not result["ids"][0]:
+            continue
+        for i in range(len(result["ids"][0])):
+            hits.append((result["distances"][0][i], result["ids"][0][i], result["documents"][0][i],
+                         result["metadatas"][0][i] if result.get("metadatas") else None))
+    hits.sort(key=lambda hit: hit[0])
+    hits = hits[:n_results]
+    return {
+        "ids": [[h[1] for h in hits]],
+        "distances": [[h[0] for h in hits]],
+        "documents": [[h[2] for h in hits]],
+        "metadatas": [[h[3] for h in hits]],
+    }
+
+
+def move_collection(source, target, name):
+    source_collection = source.get_collection(name=name)
+    target_collection = target.get_or_create_collection(name=name, metadata=source_collection.metadata)
+    offset = 0
+    while True:
+        page = source_collection.get(include=["embeddings", "documents", "metadatas"], limit=REBALANCE_PAGE_SIZE,
+                                     offset=offset)
+        if not page["ids"]:
+            break
+        target_collection.add(ids=page["ids"], embeddings=page["embeddings"], documents=page["documents"],
+                              metadatas=page["metadatas"])
+        offset += len(page["ids"])
+    source.delete_collection(name=name)
+    return offset
+
+
+def balanced_shard_map(sizes, shard_count):
+    # Greedy bin packing: largest collections first, each onto the currently lightest shard
+    loads = [0] * shard_count
+    shard_map = {}
+    for name in PINNED_COLLECTIONS:
+        if name in sizes:
+            loads[0] += sizes[name]
+    for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        if name in PINNED_COLLECTIONS:
+            continue
+        shard = loads.index(min(loads))
+        shard_map[name] = shard
+        loads[shard] += size
+    return shard_map
+
+
+def rebalance(from_addresses, to_addresses, balance=False, shard_map_path=SHARD_MAP):
+    """
+    Moves every collection that is not on its target shard for the new shard list. With balance, placement is
+    decided by collection size instead of by hash and written to shard_map_path for ShardedClient to load.
+    """
+    if balance and not shard_map_path:
+        raise ValueError("Set SHARD_MAP or --shard-map to store a balanced placement")
+
+    old = ShardedClient(from_addresses, shard_map_path)
+    new_shards = [chromadb.HttpClient(host=host, port=port) for host, port in parse_addresses(to_addresses)]
+    by_address = dict(zip(parse_addresses(to_addresses), new_shards))
+
+    located = {}
+    for address, shard in zip(old.addresses, old.shards):
+        for collection in shard.list_collections():
+            located[collection.name] = (address, shard, collection.count())
+
+    shard_map = {}
+    if balance:
+        shard_map = balanced_shard_map({n: size for n, (_, _, size) in located.items()}, len(new_shards))
+
+    moved = {}
+    for name, (address, source, _) in sorted(located.items()):
+        target_index = shard_for(name, len(new_shards), shard_map)
+        target = new_shards[target_index]
+        if by_address.get(address) is target:
+            continue
+        moved[name] = move_collection(source, target, name)
+        print(f"Moved {name} ({moved[name]} documents) to shard {target_index}")
+
+    # Without --balance placement is by hash again, so an old map is cleared rather than left to disagree
+    if shard_map_path:
+        with open(shard_map_path, "w", encoding="utf-8") as map_file:
+            json.dump(shard_map, map_file, indent=2)
+    return moved
+
+
+def serve(shards, base_port, path):
+    """Runs one local chroma server process per shard until interrupted."""
+    processes = []
+    for i in range(shards):
+        shard_path = os.path.join(path, f"shard-{i}")
+        os.makedirs(shard_path, exist_ok=True)
+        processes.append(subprocess.Popen(["chroma", "run", "--path", shard_path, "--port", str(base_port + i)]))
+    addresses = ",".join(f"localhost:{base_port + i}" for i in range(shards))
+    print(f"Serving {shards} shards. Start the service with CHROMA_SHARDS={addresses}")
+    try:
+        while all(p.poll() is None for p in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run and rebalance local chroma shards")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Start local chroma server processes")
+    serve_parser.add_argument("--shards", type=int, default=4)
+    serve_parser.add_argument("--base-port", type=int, default=8100)
+    serve_parser.add_argument("--path", default="db/shards")
+    rebalance_parser = subparsers.add_parser("rebalance", help="Move collections onto a new shard list")
+    rebalance_parser.add_argument("--from", dest="from_addresses", default=CHROMA_SHARDS, required=not CHROMA_SHARDS)
+    rebalance_parser.add_argument("--to", dest="to_addresses", required=True)
+    rebalance_parser.add_argument("--balance", action="store_true",
+                                  help="Place collections by size instead of by hash and write a shard map")
+    rebalance_parser.add_argument("--shard-map", default=SHARD_MAP)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.shards, args.base_port, args.path)
+    else:
+        moved = rebalance(args.from_addresses, args.to_addresses, args.balance, args.shard_map)
+        print(f"Moved {len(moved)} collections")
@@ -1,5 +1,5 @@
 
 # python -m venv venv  
-rm -rf db xx.log
+rm -rf xx.log
 source venv/bin/activate > /dev/null && pip install -r requirements.txt > /dev/null
 python main.py > xx.log
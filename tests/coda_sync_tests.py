@@ -0,0 +1,144 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import chromadb
+
+import coda_sync
+from benchmarks.coda_standin import CodaStandIn
+from coda_sync import CodaSync
+from ingest_jobs import IngestJob, JobCancelled
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), "coda_recordings")
+DOC = "dGuide01"
+
+
+def fake_embed(documents):
+    return [[float(len(d)), 1.0] for d in documents]
+
+
+@mock.patch("ingest_profile.embed_documents", fake_embed)
+@mock.patch.object(coda_sync, "EXPORT_POLL_SECONDS", 0.01)
+class CodaSyncTests(unittest.TestCase):
+    def setUp(self):
+        self.client = chromadb.EphemeralClient()
+        for collection in self.client.list_collections():
+            self.client.delete_collection(collection.name)
+        # Each sync writes an ingest report
+        self.folder = tempfile.TemporaryDirectory()
+        self.report_dir = mock.patch("ingest_profile.INGEST_REPORT_DIR", os.path.join(self.folder.name, "reports"))
+        self.report_dir.start()
+
+    def tearDown(self):
+        self.report_dir.stop()
+        self.folder.cleanup()
+
+    def sync(self, recording, concurrency=4, job=None):
+        path = recording if os.path.isabs(recording) else os.path.join(RECORDINGS, recording)
+        with CodaStandIn(path) as standin:
+            result = CodaSync(DOC, api_key="test-key", api_url=standin.api_url, concurrency=concurrency).sync(
+                self.client, job=job)
+        return result, standin
+
+    def pages(self, name):
+        stored = self.client.get_collection(name=name).get(include=["metadatas"])
+        return sorted({m["coda_page"] for m in stored["metadatas"]})
+
+    def test_first_sync_maps_pages_to_categories(self):
+        result, standin = self.sync("doc_v1.json")
+        self.assertEqual((result["pages"], result["changed"], result["removed"]), (4, 4, 0))
+        # The rate limited first listing request was retried, and the listing followed its next page token
+        self.assertEqual(standin.count(f"GET /docs/{DOC}/pages?"), 3)
+        self.assertEqual(standin.count("POST"), 4)
+
+        categories = self.client.get_collection(name="categories").get(include=["documents", "metadatas"])
+        self.assertEqual(sorted(m["category"] for m in categories["metadatas"]), ["Benefits", "Travel"])
+        self.assertIn("Benefits. Health, dental and retirement", categories["documents"])
+        self.assertEqual(self.pages("Benefits"), ["canvas-bnf", "canvas-dnt"])
+        self.assertEqual(self.pages("Travel"), ["canvas-exp", "canvas-trv"])
+
+        chunks = self.client.get_collection(name="Benefits").get(ids=["canvas-bnf:0", "canvas-bnf:1"],
+                                                                 include=["documents", "metadatas"])
+        self.assertEqual(chunks["metadatas"][1]["heading"], "Retirement")
+        self.assertEqual(chunks["metadatas"][0]["next_id"], "canvas-bnf:1")
+        self.assertEqual(chunks["metadatas"][0]["coda_updated_at"], "2024-01-08T10:00:00.000Z")
+
+    def test_unchanged_pages_are_not_fetched(self):
+        self.sync("doc_v1.json")
+        result, standin = self.sync("doc_v1.json")
+        self.assertEqual((result["changed"], result["unchanged"], result["chunks"]), (0, 4, 0))
+        self.assertEqual(result["categories_changed"], 0)
+        self.assertEqual(standin.count("POST"), 0)
+
+    def test_only_changed_pages_are_fetched(self):
+        self.sync("doc_v1.json")
+        result, standin = self.sync("doc_v2.json")
+        self.assertEqual((result["changed"], result["removed"], result["unchanged"]), (2, 1, 2))
+        self.assertEqual(standin.count("POST"), 2)
+        # Travel's subtitle changed, so only its category description is embedded again
+        self.assertEqual(result["categories_changed"], 1)
+
+        self.assertEqual(self.pages("Benefits"), ["canvas-bnf", "canvas-dnt", "canvas-lve"])
+        self.assertEqual(self.pages("Travel"), ["canvas-trv"])
+        dental = self.client.get_collection(name="Benefits").get(where={"coda_page": "canvas-dnt"})
+        self.assertEqual(len(dental["ids"]), 2)
+        self.assertTrue(all("new provider" in d or "Orthodontic" in d for d in dental["documents"]))
+
+    def test_sync_state_comes_from_the_page_maps(self):
+        self.sync("doc_v1.json")
+        stored = CodaSync(DOC, api_key="test-key").stored_pages(self.client)
+        self.assertEqual(stored["canvas-dnt"], ("2024-01-08T10:00:00.000Z", "Benefits"))
+        self.assertEqual(sorted(stored), ["canvas-bnf", "canvas-dnt", "canvas-exp", "canvas-trv"])
+        # The section collections are not scanned
+        with mock.patch.object(self.client, "list_collections", side_effect=AssertionError("scanned")):
+            result, _ = self.sync("doc_v1.json")
+        self.assertEqual(result["changed"], 0)
+
+    def test_empty_pages_are_not_exported_again(self):
+        with open(os.path.join(RECORDINGS, "doc_v1.json"), "r", encoding="utf-8") as recording_file:
+            recording = json.load(recording_file)
+        recording["GET /blobs/canvas-exp.md"] = [{"status": 200, "text": ""}]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "empty_page.json")
+            with open(path, "w", encoding="utf-8") as recording_file:
+                json.dump(recording, recording_file)
+            self.sync(path)
+            self.assertEqual(self.pages("Travel"), ["canvas-trv"])
+            result, standin = self.sync(path)
+        self.assertEqual((result["changed"], standin.count("POST")), (0, 0))
+
+    def test_cancelled_sync_does_not_wait_for_queued_exports(self):
+        export_page = CodaSync.export_page
+
+        def slow_export(sync, page_id):
+            time.sleep(0.3)
+            return export_page(sync, page_id)
+
+        job = IngestJob("coda", DOC)
+        job.cancel_event.set()
+        started = time.perf_counter()
+        with mock.patch.object(CodaSync, "export_page", slow_export):
+            with self.assertRaises(JobCancelled):
+                self.sync("doc_v1.json", concurrency=1, job=job)
+        self.assertLess(time.perf_counter() - started, 0.9)
+        # Nothing was stored, so the next sync exports every page
+        result, _ = self.sync("doc_v1.json")
+        self.assertEqual(result["changed"], 4)
+
+    def test_failed_sync_raises_its_own_error(self):
+        with mock.patch.object(CodaSync, "store_page", side_effect=RuntimeError("disk full")), \
+                mock.patch.object(CodaSync, "record_pages", side_effect=ValueError("index gone")) as record_pages:
+            with self.assertRaisesRegex(RuntimeError, "disk full"):
+                self.sync("doc_v1.json")
+        record_pages.assert_called_once()
+
+    def test_doc_id_is_required(self):
+        with self.assertRaises(ValueError):
+            CodaSync("")
+
+
+if __name__ == '__main__':
+    unittest.main()
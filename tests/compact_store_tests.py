@@ -0,0 +1,86 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import chromadb
+import numpy as np
+
+from compact_store import CompactStore
+
+
+def add_random(collection, count, seed, start=0):
+    vectors = np.random.default_rng(seed).normal(size=(count, 32)).astype(np.float32)
+    collection.add(ids=[str(start + i) for i in range(count)], embeddings=vectors.tolist(),
+                   documents=[f"section {start + i}" for i in range(count)])
+    return vectors
+
+
+class CompactStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.client = chromadb.EphemeralClient()
+        # The in-memory client is shared by every test in the process
+        for collection in self.client.list_collections():
+            self.client.delete_collection(collection.name)
+        self.collection = self.client.get_or_create_collection(name="compact_tests")
+        self.vectors = add_random(self.collection, 300, seed=1)
+
+    def tearDown(self):
+        self.client.delete_collection(name="compact_tests")
+        self.directory.cleanup()
+
+    def test_rescored_results_match_exact_search(self):
+        # Per-vector norms and scales cost more at 32 dimensions than at the 384 of the real embeddings
+        for dtype, compression in (("int8", 3.0), ("float16", 1.8)):
+            store = CompactStore(self.directory.name, dtype, candidates=32)
+            store.sync(self.client)
+            self.assertGreater(store.stats()["compression"], compression)
+
+            for query in np.random.default_rng(2).normal(size=(20, 32)).astype(np.float32):
+                exact = ((self.vectors - query) ** 2).sum(axis=1)
+                expected = [str(i) for i in np.argsort(exact)[:5]]
+                result = store.query_collections(["compact_tests"], [query.tolist()], n_results=5)
+                self.assertEqual(result["ids"][0], expected)
+                self.assertAlmostEqual(result["distances"][0][0], float(exact.min()), places=3)
+
+    def test_sync_rebuilds_changed_collections(self):
+        store = CompactStore(self.directory.name, "int8")
+        store.sync(self.client)
+        before = store.indexes["compact_tests"]
+        store.sync(self.client)
+        self.assertIs(store.indexes["compact_tests"], before)
+
+        add_random(self.collection, 10, seed=3, start=300)
+        store.sync(self.client)
+        self.assertEqual(len(store.indexes["compact_tests"]), 310)
+        self.assertEqual(store.query_collections(["missing"], [self.vectors[0].tolist()])["ids"], [[]])
+
+    def test_sync_rebuilds_edited_collections_of_the_same_size(self):
+        store = CompactStore(self.directory.name, "int8")
+        store.sync(self.client)
+        before = store.indexes["compact_tests"]
+        # A re-synced page: same id and count, new text, metadata and vector
+        edited = np.random.default_rng(4).normal(size=32).astype(np.float32)
+        self.collection.update(ids=["7"], embeddings=[edited.tolist()], documents=["section 7, edited"],
+                               metadatas=[{"coda_updated_at": "2024-02-01T00:00:00.000Z"}])
+        store.sync(self.client, ["compact_tests"])
+        self.assertIsNot(store.indexes["compact_tests"], before)
+        result = store.query_collections(["compact_tests"], [edited.tolist()])
+        self.assertEqual((result["ids"][0], result["documents"][0]), (["7"], ["section 7, edited"]))
+        self.assertEqual(result["metadatas"][0], [{"coda_updated_at": "2024-02-01T00:00:00.000Z"}])
+
+    def test_sync_only_reads_the_collections_written_to(self):
+        store = CompactStore(self.directory.name, "int8")
+        store.sync(self.client)
+        before = store.indexes["compact_tests"]
+        # Text is read from chroma for each answer, so an edit that leaves the vector alone shows without a rebuild
+        self.collection.update(ids=["7"], embeddings=[self.vectors[7].tolist()], documents=["section 7, reworded"])
+        with mock.patch.object(CompactStore, "read", side_effect=AssertionError("read a collection not written to")):
+            store.sync(self.client, ["other"])
+        self.assertIs(store.indexes["compact_tests"], before)
+        result = store.query_collections(["compact_tests"], [self.vectors[7].tolist()])
+        self.assertEqual((result["ids"][0], result["documents"][0]), (["7"], ["section 7, reworded"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+
+import chromadb
+
+import context
+from context import adjacency_metadata, expand_hit, join_chunks, pack, ranked_hits, tokenizer_counter, tokens_key
+
+
+class ContextTests(unittest.TestCase):
+    def setUp(self):
+        # Two sections in document order: chunks 0-2 in "intro", 3-4 in "setup"
+        self.client = chromadb.EphemeralClient()
+        locations = [("intro", "0"), ("intro", "1"), ("intro", "2"), ("setup", "3"), ("setup", "4")]
+        adjacency = adjacency_metadata(locations)
+        for (section, chunk_id), metadata in zip(locations, adjacency):
+            collection = self.client.get_or_create_collection(name=section)
+            metadata[tokens_key("test")] = 10
+            collection.add(ids=[chunk_id], documents=[f"chunk {chunk_id} " * 5], embeddings=[[float(chunk_id), 1.0]],
+                           metadatas=[metadata])
+
+    def tearDown(self):
+        for name in ("intro", "setup"):
+            self.client.delete_collection(name=name)
+
+    def hit(self, section, chunk_id):
+        result = self.client.get_collection(name=section).query(query_embeddings=[[float(chunk_id), 1.0]],
+                                                                n_results=1)
+        return ranked_hits(result)[0]
+
+    def test_adjacency_links_neighbours_across_sections(self):
+        metadata = adjacency_metadata([("intro", "2"), ("setup", "3")])
+        self.assertEqual(metadata[0]["next_section"], "setup")
+        self.assertEqual(metadata[1]["prev_id"], "2")
+        self.assertEqual(metadata[0]["prev_section"], "")
+
+    def test_neighbours_cross_into_the_next_section(self):
+        chunks = expand_hit(self.client, self.hit("intro", "2"), "neighbours", budget=1000)
+        self.assertEqual([c["id"] for c in chunks], ["1", "2", "3"])
+
+    def test_section_expansion_stays_in_section_and_budget(self):
+        chunks = expand_hit(self.client, self.hit("intro", "1"), "section", budget=1000)
+        self.assertEqual([c["id"] for c in chunks], ["0", "1", "2"])
+
+        hit = self.hit("intro", "0")
+        chunks = expand_hit(self.client, hit, "section", budget=2 * len(hit["text"]))
+        self.assertEqual([c["id"] for c in chunks], ["0", "1"])
+
+    def test_pack_fits_ranked_hits_in_token_budget(self):
+        hits = [self.hit("intro", "0"), self.hit("setup", "4"), self.hit("intro", "2")]
+        passages, used = pack(self.client, hits, 25, "test")
+        self.assertEqual(used, 20)
+        self.assertEqual([p["rank"] for p in passages], [0, 1])
+
+    def test_pack_does_not_repeat_chunks_across_expanded_passages(self):
+        hits = [self.hit("intro", "1"), self.hit("intro", "2"), self.hit("setup", "4")]
+        passages, used = pack(self.client, hits, 50, "test", expand="neighbours")
+        self.assertEqual([c["id"] for c in passages[0]["chunks"]], ["0", "1", "2"])
+        # Hit 2 is already in the first passage; hit 4 expands to 3 only
+        self.assertEqual([c["id"] for c in passages[1]["chunks"]], ["3", "4"])
+        self.assertEqual(used, 50)
+
+    def test_only_query_tokenizers_are_loaded(self):
+        with mock.patch.object(context, "QUERY_TOKENIZERS", ("broken",)), \
+                mock.patch("context.load_tokenizer", side_effect=ValueError("offline")) as load:
+            with self.assertRaisesRegex(ValueError, "must be one of"):
+                tokenizer_counter("gpt2")
+            # A tokenizer that failed to load is not tried again for the next request
+            for _ in range(2):
+                with self.assertRaisesRegex(ValueError, "not available"):
+                    tokenizer_counter("broken")
+        self.assertEqual(load.call_count, 1)
+
+    def test_join_drops_repeated_overlap(self):
+        first = "The pipeline builds, tests and ships every change."
+        second = "tests and ships every change. Releases are tagged."
+        self.assertEqual(join_chunks([first, second]), "The pipeline builds, tests and ships every change. "
+                                                        "Releases are tagged.")
+        self.assertEqual(join_chunks(["One.", "Two."]), "One.\n\nTwo.")
+
+
+if __name__ == '__main__':
+    unittest.main()
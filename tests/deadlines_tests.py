@@ -0,0 +1,158 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import deadlines
+import document_store
+from deadlines import Deadline, StageTimeout
+from markdown_loader import narrowed_query
+
+
+class FakeEmbedder:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def embed_query(self, text):
+        time.sleep(self.delay)
+        return [1.0, float(len(text) % 3)]
+
+
+def slow(seconds, fn):
+    def wrapper(*args, **kwargs):
+        time.sleep(seconds)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+class DeadlineTests(unittest.TestCase):
+    def test_header_or_default(self):
+        self.assertEqual(Deadline.from_header(None, default_ms=500).seconds, 0.5)
+        self.assertEqual(Deadline.from_header("250", default_ms=500).seconds, 0.25)
+        # Clients cannot ask for more than the maximum, and a default of 0 means no deadline
+        self.assertEqual(Deadline.from_header("90000", max_ms=1000).seconds, 1.0)
+        self.assertIsNone(Deadline.from_header(None, default_ms=0).seconds)
+        for value in ("soon", "-5"):
+            with self.assertRaises(ValueError):
+                Deadline.from_header(value)
+
+    def test_stages_past_the_deadline_are_abandoned(self):
+        deadline = Deadline(0.1)
+        self.assertEqual(deadline.run("fast", lambda: 1), 1)
+        with self.assertRaises(StageTimeout):
+            deadline.run("slow", time.sleep, 1)
+        with self.assertRaises(StageTimeout):
+            deadline.run("after", lambda: 1)
+        self.assertEqual([(s["stage"], s["status"]) for s in deadline.stages],
+                         [("fast", "ok"), ("slow", "timeout"), ("after", "skipped")])
+        self.assertLess(deadline.report()["elapsed_ms"], 500)
+
+    @unittest.skipIf(os.environ.get("QUERY_DEADLINE_MS"), "QUERY_DEADLINE_MS is set")
+    def test_queries_have_a_deadline_by_default(self):
+        self.assertEqual(Deadline.from_header(None).seconds, 2.0)
+
+    def test_zero_default_means_no_deadline(self):
+        self.assertIsNone(Deadline.from_header(None, default_ms=0).seconds)
+
+    def test_abandoned_stages_do_not_starve_later_queries(self):
+        release = threading.Event()
+        # Only the rejection threshold is lowered; the shared pool keeps its threads for the other tests
+        deadlines.stage_executor()
+        with mock.patch.object(deadlines, "QUERY_STAGE_WORKERS", 2):
+            try:
+                for _ in range(2):
+                    with self.assertRaises(StageTimeout):
+                        Deadline(0.05).run("embedding", release.wait)
+                started = time.perf_counter()
+                deadline = Deadline(5)
+                with self.assertRaises(StageTimeout):
+                    deadline.run("embedding", lambda: 1)
+                self.assertEqual(deadline.stages[0]["status"], "rejected")
+                self.assertLess(time.perf_counter() - started, 1)
+            finally:
+                release.set()
+            for _ in range(100):
+                if deadlines.abandoned_stages() == 0:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(Deadline(5).run("embedding", lambda: 1), 1)
+
+    def test_errors_are_raised_not_degraded(self):
+        deadline = Deadline(1)
+        with self.assertRaises(ZeroDivisionError):
+            deadline.run("broken", lambda: 1 / 0)
+        self.assertEqual(deadline.stages[0]["status"], "error")
+        self.assertFalse(deadline.report()["degraded"])
+
+
+class DegradedQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.embedder = FakeEmbedder()
+        with mock.patch("document_store.get_embedder", return_value=self.embedder):
+            self.doc_store = document_store.DocumentStore(db_path=self.folder.name, shards="")
+        client = self.doc_store.client
+        categories = client.get_or_create_collection(name="categories")
+        categories.add(ids=["0", "1"], embeddings=[[1.0, 0.0], [0.0, 1.0]],
+                       documents=["Travel bookings and expenses", "Health and dental benefits"],
+                       metadatas=[{"category": "Travel"}, {"category": "Benefits"}])
+        sections = (("Travel", "Book flights through the portal."), ("Benefits", "Dental cover starts day one."))
+        for name, text in sections:
+            client.get_or_create_collection(name=name).add(ids=["0"], embeddings=[[1.0, 0.0]], documents=[text])
+        self.doc_store.index_changed()
+
+    def tearDown(self):
+        document_store.release_client(self.folder.name)
+        self.folder.cleanup()
+
+    def test_in_time_query_reports_its_stages(self):
+        deadline = Deadline(5)
+        context = self.doc_store.query_context("How do I book travel?", deadline=deadline)
+        self.assertEqual(context["results"], "Book flights through the portal.")
+        report = deadline.report()
+        self.assertFalse(report["degraded"])
+        self.assertEqual([s["stage"] for s in report["stages"]], ["embedding", "cache", "routing", "narrowed_query"])
+
+    def test_question_routed_nowhere_finds_nothing(self):
+        self.assertEqual(narrowed_query(self.doc_store.client, [], "Anything?", [1.0, 0.0])["ids"], [[]])
+        with mock.patch("document_store.route_categories", return_value=[]):
+            context = self.doc_store.query_context("Anything?", deadline=Deadline(5))
+            self.assertEqual(self.doc_store.query_with_doug("Anything?"), "")
+        self.assertEqual(context["results"], "")
+        self.assertEqual(self.doc_store.query_cache.stats()["entries"], 0)
+
+    def test_slow_lookup_falls_back_to_the_category_description(self):
+        with self.doc_store_patch("narrowed_query", 1.0):
+            deadline = Deadline(0.2)
+            context = self.doc_store.query_context("How do I book travel?", expand="neighbours", deadline=deadline)
+        self.assertEqual(context["results"], "Travel bookings and expenses")
+        self.assertEqual(deadline.fallbacks, ["category_description"])
+        self.assertEqual(deadline.stages[-1]["status"], "timeout")
+        # Nothing found by a fallback is cached
+        self.assertEqual(self.doc_store.query_cache.stats()["entries"], 0)
+
+    def test_slow_routing_falls_back_to_keywords(self):
+        with self.doc_store_patch("route_categories", 1.0):
+            # Routing gives up half way, leaving the lookup the other half
+            deadline = Deadline(0.6)
+            hits = self.doc_store.retrieve("Is dental covered by my benefits?", deadline)
+        self.assertEqual(deadline.fallbacks, ["keyword_routing"])
+        self.assertEqual(hits[0]["text"], "Dental cover starts day one.")
+
+    def test_slow_embedding_answers_a_repeated_question_from_the_cache(self):
+        question = "How do I book travel?"
+        self.doc_store.retrieve(question, Deadline(5))
+        self.embedder.delay = 1.0
+        deadline = Deadline(0.2)
+        hits = self.doc_store.retrieve("how do I  book travel?", deadline)
+        self.assertEqual(deadline.fallbacks, ["cached_answer"])
+        self.assertEqual(hits[0]["text"], "Book flights through the portal.")
+
+    def doc_store_patch(self, name, seconds):
+        return mock.patch(f"document_store.{name}", slow(seconds, getattr(document_store, name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import chromadb
+
+import coda_sync
+import document_store
+import markdown_loader
+from benchmarks.coda_standin import CodaStandIn
+from coda_sync import CodaSync
+from ingest_jobs import IngestJobManager
+from watcher import DirectoryWatcher
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), "coda_recordings")
+VOCABULARY = ("dental", "travel", "delivery", "badge")
+
+
+def embed(text):
+    # One dimension per word, so questions land next to the chunks and categories that share their words
+    words = text.lower()
+    return [1.0 if word in words else 0.0 for word in VOCABULARY] + [0.1]
+
+
+def fake_embed(documents):
+    return [embed(d) for d in documents]
+
+
+class FakeEmbedder:
+    def embed_query(self, text):
+        return embed(text)
+
+
+class WordSplitter:
+    def split_text(self, text):
+        return [text]
+
+
+def load_repo(client, repo, markdown, report_dir, path="docs"):
+    with mock.patch("markdown_loader.fetch_markdown", return_value=[{"path": "docs/index.md"}]), \
+            mock.patch("markdown_loader.read_file", return_value=markdown.encode("utf-8")), \
+            mock.patch("ingest_profile.INGEST_REPORT_DIR", report_dir):
+        markdown_loader.load_markdown_data(client, f"https://api.github.com/repos/{repo}/contents/", path=path)
+
+
+def fake_markdown(client, url, *args, **kwargs):
+    client.get_or_create_collection(name="categories").add(
+        ids=["0"], embeddings=[embed("delivery")], documents=["Continuous delivery"],
+        metadatas=[{"category": "Delivery"}])
+    client.get_or_create_collection(name="Delivery").add(
+        ids=["0"], embeddings=[embed("delivery")], documents=["Deliver small batches."])
+
+
+@mock.patch("ingest_profile.embed_documents", fake_embed)
+@mock.patch("document_store.load_markdown_data", fake_markdown)
+@mock.patch("document_store.INDEX_SMOKE_QUERIES", [])
+@mock.patch("ingest.Ingest.make_splitter", lambda self, size, overlap: WordSplitter())
+@mock.patch.object(coda_sync, "EXPORT_POLL_SECONDS", 0.01)
+class RebuildTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        with mock.patch("document_store.get_embedder", return_value=FakeEmbedder()):
+            self.doc_store = document_store.DocumentStore(db_path=self.folder.name, shards="")
+        self.path = os.path.join(self.folder.name, "badges.txt")
+        with open(self.path, "w", encoding="utf-8") as badge_file:
+            badge_file.write("Collect your badge from reception.")
+        # Coda syncs and ingest jobs write ingest reports
+        self.report_dir = mock.patch("ingest_profile.INGEST_REPORT_DIR", os.path.join(self.folder.name, "reports"))
+        self.report_dir.start()
+
+    def tearDown(self):
+        self.report_dir.stop()
+        for name in self.doc_store.generations.list():
+            document_store.release_client(self.doc_store.generations.path(name))
+        self.folder.cleanup()
+
+    def test_files_and_coda_pages_survive_a_rebuild(self):
+        self.assertEqual(self.doc_store.ingestor.process_file(self.path), 1)
+        with CodaStandIn(os.path.join(RECORDINGS, "doc_v1.json")) as standin:
+            CodaSync("dGuide01", api_key="test-key", api_url=standin.api_url).sync(self.doc_store.client)
+        self.doc_store.index_changed()
+        before = self.doc_store.generation
+
+        self.assertNotEqual(self.doc_store.rebuild_index(), before)
+        client = self.doc_store.client
+        self.assertEqual(self.doc_store.retrieve("Is dental covered?")[0]["metadata"]["coda_page"], "canvas-dnt")
+        self.assertEqual(self.doc_store.retrieve("What is continuous delivery?")[0]["text"],
+                         "Deliver small batches.")
+        self.assertEqual(self.doc_store.query_with_doug("Where is my badge?"), "Collect your badge from reception.")
+        # The copied pages are known to the next sync, so nothing is exported again
+        with CodaStandIn(os.path.join(RECORDINGS, "doc_v1.json")) as standin:
+            result = CodaSync("dGuide01", api_key="test-key", api_url=standin.api_url).sync(client)
+        self.assertEqual(result["changed"], 0)
+        self.assertEqual(sorted(self.doc_store.category_descriptions), ["Benefits", "Delivery", "Travel"])
+
+    def test_docs_of_other_repos_survive_a_rebuild(self):
+        load_repo(self.doc_store.client, "unicorns/handbook", "# Dental\nBraces are covered.",
+                  os.path.join(self.folder.name, "reports"))
+        self.doc_store.rebuild_index()
+        sections = self.doc_store.client.get_collection(name="Dental").get()
+        self.assertEqual(sections["ids"], ["unicorns/handbook:docs:0"])
+        categories = self.doc_store.client.get_collection(name="categories").get(ids=["unicorns/handbook:docs:0"])
+        self.assertEqual(categories["documents"], ["Dental"])
+
+    def test_file_written_during_carry_over_lands_in_the_new_generation(self):
+        jobs = IngestJobManager(self.doc_store)
+        submitted = []
+        real_carry_over = document_store.carry_over
+
+        def job_after_carry_over(*args, **kwargs):
+            copied = real_carry_over(*args, **kwargs)
+            submitted.append(jobs.submit("pdf", self.path))
+            # Long enough for the job to write to the copied generation if nothing held it off until the swap
+            time.sleep(0.2)
+            return copied
+
+        with mock.patch("document_store.carry_over", job_after_carry_over):
+            self.doc_store.rebuild_index()
+        submitted[0].future.result(timeout=5)
+        jobs.shutdown()
+        self.assertEqual(submitted[0].state, "succeeded")
+        self.assertEqual(self.doc_store.query_with_doug("Where is my badge?"), "Collect your badge from reception.")
+
+    def test_sharded_rebuild_replaces_the_docs_in_place(self):
+        reports = os.path.join(self.folder.name, "reports")
+        repo = f"{self.doc_store.username}/{self.doc_store.repository}"
+        load_repo(self.doc_store.client, repo, "# Dental\nBraces are covered.", reports,
+                  path=markdown_loader.DOCS_PATH)
+        load_repo(self.doc_store.client, "unicorns/handbook", "# Dental\nCheckups twice a year.", reports)
+
+        def load_docs(client, url):
+            load_repo(client, repo, "# Delivery\nDeliver small batches.", reports, path=markdown_loader.DOCS_PATH)
+
+        with mock.patch("document_store.load_markdown_data", load_docs):
+            self.doc_store.rebuild_shards()
+        client = self.doc_store.client
+        self.assertEqual(client.get_collection(name="Dental").get()["documents"], ["Checkups twice a year."])
+        self.assertEqual(client.get_collection(name="Delivery").get()["documents"], ["Deliver small batches."])
+        self.assertEqual(sorted(client.get_collection(name="categories").get()["documents"]), ["Delivery", "Dental"])
+
+    def test_failed_sharded_rebuild_leaves_the_docs_alone(self):
+        repo = f"{self.doc_store.username}/{self.doc_store.repository}"
+        load_repo(self.doc_store.client, repo, "# Dental\nBraces are covered.",
+                  os.path.join(self.folder.name, "reports"), path=markdown_loader.DOCS_PATH)
+        with mock.patch("document_store.load_markdown_data", lambda client, url: None):
+            with self.assertRaises(ValueError):
+                self.doc_store.rebuild_shards()
+        self.assertIn("empty", self.doc_store.last_rebuild["error"])
+        self.assertEqual(self.doc_store.client.get_collection(name="Dental").get()["documents"],
+                         ["Braces are covered."])
+
+
+@mock.patch("ingest_profile.embed_documents", fake_embed)
+@mock.patch("ingest.Ingest.make_splitter", lambda self, size, overlap: WordSplitter())
+class WatchedFileTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.docs = os.path.join(self.folder.name, "docs")
+        os.makedirs(self.docs)
+        with mock.patch("document_store.get_embedder", return_value=FakeEmbedder()):
+            self.doc_store = document_store.DocumentStore(db_path=os.path.join(self.folder.name, "db"), shards="")
+        self.watcher = DirectoryWatcher(self.doc_store, [self.docs], backend="poll", debounce=0.05,
+                                        poll_interval=0.05).start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        document_store.release_client(self.doc_store.generations.path(self.doc_store.generation))
+        self.folder.cleanup()
+
+    def answer_becomes(self, question, expected, timeout=5):
+        deadline = time.monotonic() + timeout
+        answer = None
+        while time.monotonic() < deadline:
+            answer = self.doc_store.query_context(question)["results"]
+            if answer == expected:
+                return
+            time.sleep(0.05)
+        self.assertEqual(answer, expected)
+
+    def test_changed_file_answers_the_next_query(self):
+        path = os.path.join(self.docs, "badges.md")
+        with open(path, "w", encoding="utf-8") as badge_file:
+            badge_file.write("Collect your badge from reception.")
+        self.answer_becomes("Where do I get a badge?", "Collect your badge from reception.")
+        with open(path, "w", encoding="utf-8") as badge_file:
+            badge_file.write("Badges are posted to you.")
+        self.answer_becomes("Where do I get a badge?", "Badges are posted to you.")
+        os.remove(path)
+        self.answer_becomes("Where do I get a badge?", "")
+
+
+@mock.patch("ingest_profile.embed_documents", fake_embed)
+class MarkdownIdTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.client = chromadb.EphemeralClient()
+        for collection in self.client.list_collections():
+            self.client.delete_collection(collection.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_repos_sharing_a_section_keep_their_own_rows(self):
+        load_repo(self.client, "unicorns/handbook", "# Dental\nBraces are covered.\n\n## Crowns\nAnd crowns.",
+                  self.folder.name)
+        load_repo(self.client, "unicorns/onboarding", "# Dental\nCheckups twice a year.", self.folder.name)
+
+        sections = self.client.get_collection(name="Dental").get(include=["documents", "metadatas"])
+        rows = dict(zip(sections["ids"], zip(sections["documents"], sections["metadatas"])))
+        self.assertEqual(sorted(rows), ["unicorns/handbook:docs:0", "unicorns/onboarding:docs:0"])
+        self.assertEqual(rows["unicorns/onboarding:docs:0"][0], "Checkups twice a year.")
+        self.assertEqual(rows["unicorns/handbook:docs:0"][1]["next_id"], "unicorns/handbook:docs:1")
+        self.assertEqual(rows["unicorns/handbook:docs:0"][1]["next_section"], "Dental_Crowns")
+        self.assertEqual(rows["unicorns/onboarding:docs:0"][1]["docs"], "unicorns/onboarding:docs")
+        categories = self.client.get_collection(name="categories").get()
+        self.assertEqual(len(categories["ids"]), 3)
+
+    def test_reloading_a_repo_replaces_its_rows(self):
+        load_repo(self.client, "unicorns/handbook", "# Dental\nBraces are covered.\n\n## Crowns\nAnd crowns.",
+                  self.folder.name)
+        load_repo(self.client, "unicorns/onboarding", "# Dental\nCheckups twice a year.", self.folder.name)
+        load_repo(self.client, "unicorns/handbook", "# Dental\nBraces are no longer covered.", self.folder.name)
+
+        sections = self.client.get_collection(name="Dental").get()
+        self.assertEqual(dict(zip(sections["ids"], sections["documents"])),
+                         {"unicorns/handbook:docs:0": "Braces are no longer covered.",
+                          "unicorns/onboarding:docs:0": "Checkups twice a year."})
+        self.assertEqual(self.client.get_collection(name="Dental_Crowns").count(), 0)
+        self.assertEqual(len(self.client.get_collection(name="categories").get()["ids"]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
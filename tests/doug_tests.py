@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 
 import chromadb
 
@@ -27,6 +28,17 @@ class DougsGuide(unittest.TestCase):
                                                       "thumb is to limit them to somewhere between three and seven. "
                                                       "As always, less is more."))
 
+    @mock.patch("doug_loader.embed_documents", lambda documents: [[1.0, 0.0] for _ in documents])
+    def test_query_embeds_with_the_configured_backend(self):
+        client = chromadb.EphemeralClient()
+        for collection in client.list_collections():
+            client.delete_collection(collection.name)
+        # Two dimensional vectors: chroma's own embedding function would not match them, nor be loaded
+        client.create_collection(name="categories").add(ids=["0"], embeddings=[[1.0, 0.0]], documents=["Values"],
+                                                        metadatas=[{"category": "Core Values"}])
+        client.create_collection(name="Core_Values").add(ids=["0"], embeddings=[[1.0, 0.1]], documents=["Be kind."])
+        self.assertEqual(query_with_doug(client, "What are our values?")["documents"], [["Be kind."]])
+
     def test_extraction(self):
         category_dict_list = load_csv_into_iterable_map("../metadata/dougs_guide_categories.csv")
         categories_list = [d["Category"] for d in category_dict_list]
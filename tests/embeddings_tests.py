@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+
+from embeddings import OnnxEmbeddings, make_embedder, mean_pool
+
+
+class FakeEncoding:
+    def __init__(self, ids, length):
+        self.ids = ids + [0] * (length - len(ids))
+        self.attention_mask = [1] * len(ids) + [0] * (length - len(ids))
+
+
+class FakeTokenizer:
+    def encode_batch(self, texts):
+        ids = [[len(word) for word in text.split()] for text in texts]
+        length = max(len(i) for i in ids)
+        return [FakeEncoding(i, length) for i in ids]
+
+
+class FakeSession:
+    """Each token's hidden state is [id, 1], padding [100, 100]."""
+
+    def __init__(self):
+        self.batches = []
+
+    def run(self, _, feed):
+        self.batches.append(feed)
+        ids = feed["input_ids"].astype(np.float32)
+        hidden = np.stack([ids, np.ones_like(ids)], axis=-1)
+        hidden[feed["attention_mask"] == 0] = 100.0
+        return [hidden]
+
+
+class EmbeddingsTests(unittest.TestCase):
+    def test_mean_pool_ignores_padding(self):
+        hidden = np.array([[[3.0, 4.0], [9.0, 9.0]], [[0.0, 0.0], [0.0, 0.0]]], dtype=np.float32)
+        mask = np.array([[1, 0], [1, 1]])
+        pooled = mean_pool(hidden, mask)
+        np.testing.assert_allclose(pooled[0], [0.6, 0.8], rtol=1e-6)
+        # An all zero vector stays zero rather than dividing by zero
+        np.testing.assert_array_equal(pooled[1], [0.0, 0.0])
+
+    def test_onnx_embeddings_batches_and_pools(self):
+        embedder = OnnxEmbeddings("unused", threads=1)
+        embedder.tokenizer = FakeTokenizer()
+        embedder.session = FakeSession()
+        embedder.inputs = {"input_ids", "attention_mask"}
+
+        vectors = embedder.embed_documents(["abc", "abc abc abcdefg"] + ["a"] * 40)
+        self.assertEqual(len(vectors), 42)
+        # Mean of [3, 1] and of [3, 1], [3, 1], [7, 1] normalised; padding to the longest text does not count
+        np.testing.assert_allclose(vectors[0], np.array([3.0, 1.0]) / np.sqrt(10), rtol=1e-6)
+        np.testing.assert_allclose(vectors[1], np.array([13 / 3, 1.0]) / np.hypot(13 / 3, 1.0), rtol=1e-6)
+        np.testing.assert_allclose(embedder.embed_query("abc"), vectors[0], rtol=1e-6)
+
+        batches = embedder.session.batches
+        self.assertEqual([len(b["input_ids"]) for b in batches], [32, 10, 1])
+        # Inputs the model does not declare are not fed
+        self.assertNotIn("token_type_ids", batches[0])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            make_embedder("word2vec")
+
+
+if __name__ == "__main__":
+    unittest.main()
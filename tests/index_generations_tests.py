@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from index_generations import IndexGenerations
+
+
+class IndexGenerationsTests(unittest.TestCase):
+    def test_promote_switches_current(self):
+        with tempfile.TemporaryDirectory() as root:
+            generations = IndexGenerations(root)
+            self.assertIsNone(generations.current())
+
+            first = generations.create()
+            generations.promote(first)
+            second = generations.create()
+            self.assertEqual(generations.current(), first)
+
+            generations.promote(second)
+            self.assertEqual(generations.current(), second)
+            self.assertFalse(os.path.exists(os.path.join(root, "CURRENT.tmp")))
+
+    def test_promote_missing_generation(self):
+        with tempfile.TemporaryDirectory() as root:
+            with self.assertRaises(ValueError):
+                IndexGenerations(root).promote("missing")
+
+    def test_garbage_collection_keeps_current_and_protected(self):
+        with tempfile.TemporaryDirectory() as root:
+            generations = IndexGenerations(root, keep=1)
+            names = [generations.create() for _ in range(4)]
+            generations.promote(names[1])
+
+            removed = generations.collect_garbage(protected=[names[2]])
+
+            self.assertEqual(removed, [names[0]])
+            self.assertEqual(generations.list(), names[1:])
+
+    def test_same_second_generations_are_in_creation_order(self):
+        with tempfile.TemporaryDirectory() as root:
+            generations = IndexGenerations(root, keep=2)
+            with mock.patch("time.strftime", return_value="20240101-120000"):
+                names = [generations.create() for _ in range(12)]
+            self.assertEqual(names[10], "20240101-120000-10")
+            self.assertEqual(generations.list(), names)
+            generations.promote(names[-1])
+            self.assertEqual(generations.collect_garbage(), names[:10])
+
+
+if __name__ == '__main__':
+    unittest.main()
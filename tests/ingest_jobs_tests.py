@@ -0,0 +1,131 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import chromadb
+
+import markdown_loader
+from ingest_jobs import IngestJobManager
+from query_cache import SemanticQueryCache
+
+
+class FakeIngestor:
+    def __init__(self, release=None):
+        self.processed = []
+        self.release = release
+
+    def list_files(self, folder_path):
+        return sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path))
+
+    def process_file(self, file_path, profiler=None):
+        if self.release is not None:
+            self.release.wait()
+        self.processed.append(file_path)
+        return 2
+
+
+class FakeDocumentStore:
+    def __init__(self, ingestor, client=None):
+        self.ingestor = ingestor
+        self.client = client
+        self.collection = SimpleNamespace(name="default")
+        self.query_cache = SemanticQueryCache()
+        self.write_lock = threading.RLock()
+        self.changed = []
+
+    def index_changed(self, collections=None):
+        self.changed.append(collections)
+        self.query_cache.invalidate()
+
+
+class IngestJobManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.docs = os.path.join(self.folder.name, "docs")
+        os.makedirs(self.docs)
+        for i in range(3):
+            with open(os.path.join(self.folder.name, "docs", f"doc{i}.md"), "w", encoding="utf-8") as f:
+                f.write("# Doc")
+        self.report_dir = mock.patch("ingest_profile.INGEST_REPORT_DIR", os.path.join(self.folder.name, "reports"))
+        self.report_dir.start()
+
+    def tearDown(self):
+        self.report_dir.stop()
+        self.folder.cleanup()
+
+    def test_directory_job_reports_progress(self):
+        ingestor = FakeIngestor()
+        doc_store = FakeDocumentStore(ingestor)
+        manager = IngestJobManager(doc_store, cpu_share=1.0)
+        job = manager.submit("directory", self.docs)
+        job.future.result(timeout=10)
+
+        status = job.to_dict()
+        self.assertEqual(status["state"], "succeeded")
+        self.assertEqual(status["files_total"], 3)
+        self.assertEqual(status["files_done"], 3)
+        self.assertEqual(status["chunks_done"], 6)
+        self.assertEqual(len(ingestor.processed), 3)
+        self.assertEqual(doc_store.changed, [["default"]])
+
+    def test_cancel_stops_between_files(self):
+        release = threading.Event()
+        ingestor = FakeIngestor(release)
+        manager = IngestJobManager(FakeDocumentStore(ingestor), cpu_share=1.0)
+        job = manager.submit("directory", self.docs)
+
+        manager.cancel(job.id)
+        release.set()
+        job.future.result(timeout=10)
+
+        self.assertEqual(job.state, "cancelled")
+        self.assertLess(len(ingestor.processed), 3)
+
+    def test_finished_jobs_are_forgotten(self):
+        manager = IngestJobManager(FakeDocumentStore(FakeIngestor()), cpu_share=1.0, ttl=60, kept=2)
+        jobs = [manager.submit("directory", self.docs) for _ in range(3)]
+        for job in jobs:
+            job.future.result(timeout=10)
+        self.assertEqual([j.id for j in manager.list()], [j.id for j in jobs[1:]])
+
+        jobs[1].finished_at = time.time() - 120
+        self.assertEqual([j.id for j in manager.list()], [jobs[2].id])
+        self.assertIsNone(manager.get(jobs[1].id))
+
+    @mock.patch("ingest_profile.embed_documents", lambda documents: [[float(len(d)), 1.0] for d in documents])
+    def test_cancelled_github_job_removes_its_partial_rows(self):
+        client = chromadb.EphemeralClient()
+        for collection in client.list_collections():
+            client.delete_collection(collection.name)
+        manager = IngestJobManager(FakeDocumentStore(FakeIngestor(), client), cpu_share=1.0)
+        add_to_collection = markdown_loader.add_to_collection
+
+        def cancel_after_first_section(collection, *args):
+            add_to_collection(collection, *args)
+            if collection.name != "categories":
+                for job in manager.jobs.values():
+                    manager.cancel(job.id)
+
+        with mock.patch("markdown_loader.fetch_markdown", return_value=[{"path": "docs/index.md"}]), \
+                mock.patch("markdown_loader.read_file", return_value=b"# Dental\nBraces.\n\n## Crowns\nCrowns."), \
+                mock.patch("markdown_loader.add_to_collection", cancel_after_first_section):
+            job = manager.submit("github", "docs", repo="unicorns/handbook")
+            job.future.result(timeout=10)
+
+        self.assertEqual(job.state, "cancelled")
+        self.assertEqual(job.chunks_done, 1)
+        self.assertEqual(client.get_collection(name="categories").count(), 0)
+        self.assertEqual(client.get_collection(name="Dental").count(), 0)
+
+    def test_rejects_missing_path(self):
+        manager = IngestJobManager(FakeDocumentStore(FakeIngestor()))
+        with self.assertRaises(ValueError):
+            manager.submit("pdf", os.path.join(self.folder.name, "missing.pdf"))
+
+
+if __name__ == '__main__':
+    unittest.main()
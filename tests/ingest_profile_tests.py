@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+
+from ingest_profile import IngestionProfiler, diff_reports
+
+
+class IngestionProfilerTests(unittest.TestCase):
+    def make_report(self, seconds_by_file):
+        profiler = IngestionProfiler("test")
+        for path, (seconds, chunks) in seconds_by_file.items():
+            with profiler.file(path) as profile:
+                profile.bytes_in = 100
+                profile.chunks_out = chunks
+                with profile.stage("load"):
+                    pass
+        report = profiler.report()
+        # Replace measured times with fixed ones so the assertions are deterministic
+        for f in report["files"]:
+            f["seconds"] = seconds_by_file[f["path"]][0]
+        return report
+
+    def test_report_totals(self):
+        report = self.make_report({"a.pdf": (1.0, 3), "b.pdf": (2.0, 4)})
+
+        self.assertEqual(report["totals"]["files"], 2)
+        self.assertEqual(report["totals"]["bytes_in"], 200)
+        self.assertEqual(report["totals"]["chunks_out"], 7)
+        self.assertIn("load", report["totals"]["stages"])
+
+    def test_errors_are_recorded(self):
+        profiler = IngestionProfiler("test")
+        with self.assertRaises(ValueError):
+            with profiler.file("broken.pdf"):
+                raise ValueError("bad pdf")
+
+        report = profiler.report()
+        self.assertEqual(report["totals"]["errors"], 1)
+        self.assertEqual(report["files"][0]["error"], "bad pdf")
+
+    def test_write(self):
+        profiler = IngestionProfiler("test")
+        with profiler.file("a.md") as profile:
+            profile.chunks_out = 1
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = profiler.write(directory)
+            with open(path, encoding="utf-8") as report_file:
+                self.assertEqual(json.load(report_file)["totals"]["chunks_out"], 1)
+            self.assertTrue(os.path.basename(path).startswith("ingest-test-"))
+            # Another report started the same second is written next to it
+            second = IngestionProfiler("test")
+            second.started_at = profiler.started_at
+            self.assertEqual(second.write(directory), path[:-len(".json")] + "-1.json")
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_diff(self):
+        old = self.make_report({"a.pdf": (1.0, 3), "b.pdf": (2.0, 4)})
+        new = self.make_report({"a.pdf": (4.0, 3), "c.pdf": (1.0, 1)})
+
+        diff = diff_reports(old, new)
+        self.assertEqual(diff["files"][0]["path"], "a.pdf")
+        self.assertEqual(diff["files"][0]["delta"], 3.0)
+        self.assertEqual(diff["added_files"], ["c.pdf"])
+        self.assertEqual(diff["removed_files"], ["b.pdf"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import chromadb
+
+import ingest
+from context import expand_hit
+from file_loaders import parse_file
+from ingest_profile import IngestionProfiler
+
+
+class WordSplitter:
+    def split_text(self, text):
+        words = text.split()
+        return [" ".join(words[i:i + 10]) for i in range(0, len(words), 10)]
+
+
+class WordIngest(ingest.Ingest):
+    def make_splitter(self, chunk_size, chunk_overlap):
+        return WordSplitter()
+
+
+def fake_embed(documents):
+    return [[float(len(d)), 1.0] for d in documents]
+
+
+class FileLoaderTests(unittest.TestCase):
+    def write(self, name, content):
+        path = os.path.join(self.folder.name, name)
+        with open(path, "w", encoding="utf-8") as output_file:
+            output_file.write(content)
+        return path
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_markdown_sections(self):
+        path = self.write("page.md", "---\ntitle: Page\n---\nIntro text\n\n# First\nalpha\n\n## Second ##\nbeta\n")
+        records = list(parse_file(path))
+        self.assertEqual([r["text"] for r in records], ["Intro text", "# First\nalpha", "## Second ##\nbeta"])
+        self.assertEqual([r["metadata"]["heading"] for r in records], ["", "First", "Second"])
+        self.assertEqual(records[2]["metadata"]["level"], 2)
+        self.assertEqual(records[0]["metadata"]["source"], path)
+        self.assertEqual(records[0]["metadata"]["format"], "md")
+
+    def test_html_sections(self):
+        path = self.write("page.html", "<html><head><script>var x;</script></head><body><p>Lead</p>"
+                                       "<h1>Benefits</h1><p>Dental &amp; vision</p><h2>Leave</h2><p>Holidays</p>")
+        records = list(parse_file(path))
+        self.assertEqual([r["metadata"]["heading"] for r in records], ["", "Benefits", "Leave"])
+        self.assertEqual(records[1]["text"], "Benefits\n\nDental & vision")
+        self.assertNotIn("var x", " ".join(r["text"] for r in records))
+
+
+@mock.patch("ingest_profile.embed_documents", fake_embed)
+class IngestTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "notes.txt")
+        self.write(" ".join(f"word{i}" for i in range(25)))
+        client = chromadb.EphemeralClient()
+        self.collection = client.get_or_create_collection(name=f"ingest-{id(self)}")
+        self.ingestor = WordIngest("test", client, self.collection)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, content):
+        with open(self.path, "w", encoding="utf-8") as output_file:
+            output_file.write(content)
+
+    def test_chunks_carry_source_and_fingerprint(self):
+        self.assertEqual(self.ingestor.process_file(self.path), 3)
+        stored = self.collection.get(include=["metadatas"])
+        self.assertEqual(sorted(stored["ids"]), [f"{self.path}:{i}" for i in range(3)])
+        metadata = stored["metadatas"][0]
+        self.assertEqual(metadata["source"], self.path)
+        self.assertEqual(metadata["size"], os.path.getsize(self.path))
+        self.assertEqual(metadata["parser"], "parse_text:1")
+        self.assertEqual(len(metadata["sha256"]), 64)
+        self.assertTrue(all(m["complete"] for m in stored["metadatas"]))
+        chunks = {m["chunk"]: m for m in stored["metadatas"]}
+        self.assertEqual((chunks[0]["prev_id"], chunks[0]["next_id"]), ("", f"{self.path}:1"))
+        self.assertEqual((chunks[1]["prev_section"], chunks[1]["prev_id"]), (self.collection.name, f"{self.path}:0"))
+
+    def test_markdown_file_expands_by_section(self):
+        path = os.path.join(self.folder.name, "guide.md")
+        with open(path, "w", encoding="utf-8") as guide_file:
+            guide_file.write("# Intro\nWelcome aboard.\n\n# Setup\nInstall the tools.")
+        self.ingestor.process_file(self.path)
+        self.ingestor.process_file(path)
+        stored = self.collection.get(ids=[f"{path}:1"], include=["documents", "metadatas"])
+        hit = {"id": stored["ids"][0], "text": stored["documents"][0], "metadata": stored["metadatas"][0]}
+        self.assertEqual((hit["metadata"]["section"], hit["metadata"]["heading"]), (self.collection.name, "Setup"))
+
+        # The section of a file chunk is its own file, not the other files in the collection
+        chunks = expand_hit(self.ingestor.client, hit, "section", budget=1000)
+        self.assertEqual([c["text"] for c in chunks], ["# Intro Welcome aboard.", "# Setup Install the tools."])
+
+    def test_each_file_is_parsed_once(self):
+        with mock.patch("ingest.parse_file", wraps=parse_file) as parse:
+            self.ingestor.process_file(self.path)
+        parse.assert_called_once_with(self.path)
+
+    def test_unchanged_files_are_skipped(self):
+        self.ingestor.process_file(self.path)
+        profiler = IngestionProfiler("test")
+        with mock.patch("ingest.parse_file") as parse:
+            self.assertEqual(self.ingestor.process_file(self.path, profiler=profiler), 0)
+            # Touched but identical: hashed, not parsed, and the new mtime is stored
+            stat = os.stat(self.path)
+            os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+            self.assertEqual(self.ingestor.process_file(self.path, profiler=profiler), 0)
+        parse.assert_not_called()
+        self.assertEqual(profiler.report()["totals"]["skipped"], 2)
+        stored = self.collection.get(include=["metadatas"])
+        self.assertEqual({m["mtime"] for m in stored["metadatas"]}, {os.stat(self.path).st_mtime})
+
+    def test_changed_files_replace_their_chunks(self):
+        self.ingestor.process_file(self.path)
+        self.write("just a few words now")
+        self.assertEqual(self.ingestor.process_file(self.path), 1)
+        stored = self.collection.get()
+        self.assertEqual(stored["ids"], [f"{self.path}:0"])
+        self.assertEqual(stored["documents"], ["just a few words now"])
+
+    def test_failed_parse_leaves_no_chunks(self):
+        def parse_then_fail(path):
+            yield from parse_file(path)
+            raise ValueError("truncated file")
+
+        self.write(" ".join(f"word{i}" for i in range(25 * ingest.WRITE_BATCH_CHUNKS)))
+        with mock.patch("ingest.parse_file", parse_then_fail), mock.patch("ingest.WRITE_BATCH_CHUNKS", 2):
+            self.assertEqual(self.ingestor.process_file(self.path), 0)
+        self.assertEqual(self.collection.get()["ids"], [])
+        # Chunks from a parse that stopped without cleaning up are not taken as up to date
+        self.ingestor.process_file(self.path)
+        self.collection.update(ids=[f"{self.path}:0"], metadatas=[{"source": self.path, "complete": False}])
+        self.assertFalse(self.ingestor.unchanged(self.path, self.ingestor.fingerprint(self.path, 1000, 400)))
+
+    def test_changed_chunking_reingests(self):
+        self.ingestor.process_file(self.path)
+        with mock.patch("ingest.parse_file", wraps=parse_file) as parse:
+            self.ingestor.process_file(self.path, chunk_size=500)
+        parse.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import chromadb
+
+import memory
+from memory import MemoryGovernor, evict_vector_index, loaded_vector_indexes, rss_bytes
+from query_cache import SemanticQueryCache
+
+
+class FakeDocumentStore:
+    def __init__(self, client):
+        self.client = client
+        self.embedding_function = object()
+        self.query_cache = SemanticQueryCache(max_entries=4)
+        self.section_store = None
+        self.category_descriptions = {"Travel": "Booking trips"}
+
+
+class FakeChooser:
+    def __init__(self):
+        self.model = "loaded"
+        self.prefixes = {"prefix": "kv cache"}
+        self.lock = threading.Lock()
+
+
+class MemoryTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.client = chromadb.PersistentClient(path=self.folder.name, settings=memory.chroma_settings())
+        for name in ("categories", "travel", "benefits"):
+            self.client.get_or_create_collection(name=name).add(
+                ids=[str(i) for i in range(20)], embeddings=[[float(i), 1.0, 0.5] for i in range(20)])
+        self.doc_store = FakeDocumentStore(self.client)
+
+    def tearDown(self):
+        from document_store import release_client
+
+        release_client(self.folder.name)
+        self.folder.cleanup()
+
+    def query(self, name):
+        return self.client.get_collection(name=name).query(query_embeddings=[[1.0, 1.0, 0.5]], n_results=1)["ids"]
+
+    def test_loaded_indexes_are_listed_and_evicted(self):
+        for name in ("travel", "benefits"):
+            self.query(name)
+        indexes = {i["collection"]: i for i in loaded_vector_indexes(self.client)}
+        self.assertEqual(indexes["travel"]["elements"], 20)
+        self.assertGreater(indexes["travel"]["bytes"], 20 * 3 * 4)
+
+        self.assertTrue(evict_vector_index(self.client, indexes["travel"]["id"]))
+        self.assertNotIn("travel", [i["collection"] for i in loaded_vector_indexes(self.client)])
+        # The next query loads it again
+        self.assertEqual(self.query("travel"), [["1"]])
+
+    def test_older_chroma_without_a_segment_cache(self):
+        manager = types.SimpleNamespace(_instances={}, _lock=threading.Lock(), _segment_cache={})
+        client = types.SimpleNamespace(_server=types.SimpleNamespace(_manager=manager))
+        self.assertEqual(loaded_vector_indexes(client), [])
+        self.assertFalse(evict_vector_index(client, "travel"))
+
+        class OldSettings:
+            __fields__ = {"chroma_api_impl": None}
+
+        with mock.patch("chromadb.config.Settings", OldSettings), \
+                mock.patch.object(memory, "CHROMA_MEMORY_LIMIT_MB", 64):
+            self.assertIsInstance(memory.chroma_settings(), OldSettings)
+
+    def test_report_breaks_down_rss(self):
+        self.doc_store.query_cache.put([1.0, 0.0], [{"text": "x" * 1000}])
+        report = MemoryGovernor(self.doc_store).report()
+        self.assertGreater(report["rss_bytes"], 0)
+        self.assertIsNone(report["budget_bytes"])
+        self.assertGreaterEqual(report["components"]["query_cache"], 1000)
+        self.assertEqual(report["components"]["category_descriptions"], len("Travel") + len("Booking trips"))
+        self.assertEqual(report["unaccounted_bytes"], report["rss_bytes"] - sum(report["components"].values()))
+
+    def test_budget_evicts_caches_idle_models_and_indexes(self):
+        for name in ("categories", "travel", "benefits"):
+            self.query(name)
+        self.doc_store.query_cache.put([1.0, 0.0], [{"text": "cached"}])
+        chooser = FakeChooser()
+        router = types.SimpleNamespace(chooser=chooser, last_used=time.monotonic() - 600)
+        governor = MemoryGovernor(self.doc_store, budget_mb=1, idle_seconds=300)
+
+        with mock.patch.dict(sys.modules, {"markdown_loader": types.SimpleNamespace(generative_router=router)}):
+            actions = governor.enforce()
+        self.assertEqual(actions[:2], ["query_cache", "generative_model"])
+        self.assertEqual(sorted(actions[2:]), ["vector_index:benefits", "vector_index:travel"])
+        self.assertIsNone(chooser.model)
+        self.assertEqual(chooser.prefixes, {})
+        # Every query routes through the categories, so their index stays
+        self.assertEqual([i["collection"] for i in loaded_vector_indexes(self.client)], ["categories"])
+        self.assertEqual(governor.last_enforcement["actions"], actions)
+
+    def test_recently_used_router_model_is_kept(self):
+        chooser = FakeChooser()
+        router = types.SimpleNamespace(chooser=chooser, last_used=time.monotonic())
+        governor = MemoryGovernor(self.doc_store, budget_mb=1, idle_seconds=300)
+        with mock.patch.dict(sys.modules, {"markdown_loader": types.SimpleNamespace(generative_router=router)}):
+            self.assertEqual(governor.unload_idle_router(), [])
+        self.assertEqual(chooser.model, "loaded")
+
+    def test_no_budget_never_evicts(self):
+        self.doc_store.query_cache.put([1.0, 0.0], [{"text": "cached"}])
+        self.assertEqual(MemoryGovernor(self.doc_store, budget_mb=0).enforce(), [])
+        self.assertEqual(self.doc_store.query_cache.stats()["entries"], 1)
+
+    def test_tracemalloc_snapshots(self):
+        governor = MemoryGovernor(self.doc_store)
+        try:
+            self.assertTrue(governor.snapshot()["started"])
+            retained = [bytearray(1024) for _ in range(100)]
+            first = governor.snapshot(top=5)
+            self.assertFalse(first["started"])
+            self.assertGreater(first["traced_bytes"], 100 * 1024)
+            self.assertIn("memory_tests.py", first["top"][0]["location"])
+            retained.extend(bytearray(1024) for _ in range(200))
+            growth = governor.snapshot(top=5)["growth"]
+            self.assertIn("memory_tests.py", growth[0]["location"])
+        finally:
+            governor.stop_tracing()
+        self.assertGreater(rss_bytes(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import threading
+import unittest
+
+from metrics import CallbackGauge, Counter, Gauge, Histogram, Registry
+
+
+class MetricsTests(unittest.TestCase):
+    def test_counter_sums_across_threads(self):
+        counter = Counter("test_total", "Test counter.", ["outcome"])
+
+        def work():
+            for _ in range(1000):
+                counter.labels("ok").inc()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(counter.labels("ok").value(), 8000)
+        self.assertIn('test_total{outcome="ok"} 8000', counter.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("test_seconds", "Test histogram.", ["stage"], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.labels("routing").observe(value)
+
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="routing",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="routing",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="routing",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{stage="routing"} 6.05', lines)
+        self.assertIn('test_seconds_count{stage="routing"} 4', lines)
+
+    def test_gauge_track(self):
+        gauge = Gauge("test_in_flight", "Test gauge.")
+        with gauge.track():
+            self.assertEqual(gauge.labels().value(), 1)
+        self.assertEqual(gauge.labels().value(), 0)
+
+    def test_registry_renders_callback_gauge(self):
+        registry = Registry()
+        registry.register(CallbackGauge("test_documents", "Test callback.", ["collection"],
+                                        lambda: {"categories": 3}))
+        text = registry.render()
+        self.assertIn("# TYPE test_documents gauge", text)
+        self.assertIn('test_documents{collection="categories"} 3', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
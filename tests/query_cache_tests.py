@@ -0,0 +1,64 @@
+import unittest
+
+from query_cache import SemanticQueryCache
+
+
+class SemanticQueryCacheTests(unittest.TestCase):
+    def test_similar_query_hits(self):
+        cache = SemanticQueryCache(max_entries=4, threshold=0.9)
+        cache.put([1.0, 0.0, 0.0], "core values")
+
+        self.assertEqual(cache.get([0.99, 0.05, 0.0]), "core values")
+        self.assertIsNone(cache.get([0.0, 1.0, 0.0]))
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = SemanticQueryCache(max_entries=2, threshold=0.99)
+        cache.put([1.0, 0.0, 0.0], "a")
+        cache.put([0.0, 1.0, 0.0], "b")
+        cache.get([1.0, 0.0, 0.0])
+        cache.put([0.0, 0.0, 1.0], "c")
+
+        self.assertEqual(cache.get([1.0, 0.0, 0.0]), "a")
+        self.assertIsNone(cache.get([0.0, 1.0, 0.0]))
+        self.assertEqual(cache.get([0.0, 0.0, 1.0]), "c")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_exact_question_is_found_without_an_embedding(self):
+        cache = SemanticQueryCache(max_entries=1, threshold=0.99)
+        cache.put([1.0, 0.0], "a", question="What are the  core values?")
+        self.assertEqual(cache.get_question("what are the core values?"), "a")
+        self.assertEqual(cache.stats()["lookups"], 0)
+
+        # An evicted entry takes its question with it
+        cache.put([0.0, 1.0], "b", question="Who do I ask?")
+        self.assertIsNone(cache.get_question("What are the core values?"))
+        self.assertEqual(cache.get_question("Who do I ask?"), "b")
+
+    def test_invalidate_drops_entries_and_stale_puts(self):
+        cache = SemanticQueryCache(max_entries=4, threshold=0.9)
+        cache.put([1.0, 0.0], "old")
+        generation = cache.generation
+        cache.invalidate()
+        cache.put([0.0, 1.0], "stale", generation)
+
+        self.assertIsNone(cache.get([1.0, 0.0]))
+        self.assertIsNone(cache.get([0.0, 1.0]))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_hit_rate_by_threshold(self):
+        cache = SemanticQueryCache(max_entries=4, threshold=0.99, probes=(0.5, 0.99))
+        cache.put([1.0, 0.0], "a")
+        cache.get([0.8, 0.6])
+
+        rates = cache.stats()["hit_rate_by_threshold"]
+        self.assertEqual(rates["0.5"], 1.0)
+        self.assertEqual(rates["0.99"], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
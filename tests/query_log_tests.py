@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from query_log import QueryLog, read_entries, top_queries, warm
+
+
+class FakeDocumentStore:
+    def __init__(self):
+        self.asked = []
+
+    def query_with_doug(self, text):
+        if text == "broken":
+            raise ValueError("no index")
+        self.asked.append(text)
+
+
+class QueryLogTests(unittest.TestCase):
+    def test_records_and_rotates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = QueryLog(directory, max_bytes=200, backups=2)
+            # Batches of five are each over max_bytes, so every batch the writer picks up ends in a rotation
+            for batch in range(4):
+                for i in range(5):
+                    log.record(f"question {batch * 5 + i}", 0.01)
+                while log.written < (batch + 1) * 5:
+                    time.sleep(0.01)
+            log.close()
+
+            files = sorted(os.listdir(directory))
+            self.assertEqual(files, ["queries.jsonl", "queries.jsonl.1", "queries.jsonl.2"])
+            entries = list(read_entries(directory))
+            # The oldest batch was rotated out
+            self.assertEqual(len(entries), 10)
+            self.assertIn("question 19", [e["q"] for e in entries])
+
+    def test_write_errors_are_counted_and_logging_resumes(self):
+        with tempfile.TemporaryDirectory() as root:
+            directory = os.path.join(root, "logs")
+            log = QueryLog(directory)
+            shutil.rmtree(directory)
+            log.record("lost", 0.01)
+            while log.errors < 1:
+                time.sleep(0.01)
+            os.makedirs(directory)
+            log.record("kept", 0.01)
+            log.close()
+            self.assertEqual((log.errors, log.written), (1, 1))
+            self.assertEqual([e["q"] for e in read_entries(directory)], ["kept"])
+
+    def test_close_does_not_hang_on_a_dead_writer(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch("query_log.QUEUE_SIZE", 2), \
+                mock.patch.object(QueryLog, "_run", lambda self: None):
+            log = QueryLog(directory)
+            for i in range(3):
+                log.record(f"question {i}", 0.01)
+            started = time.perf_counter()
+            log.close(timeout=0.1)
+            self.assertLess(time.perf_counter() - started, 1)
+            self.assertEqual(log.dropped, 1)
+
+    def test_disabled_without_directory(self):
+        log = QueryLog("")
+        log.record("question", 0.01)
+        log.close()
+        self.assertFalse(log.enabled)
+
+    def test_top_queries_normalizes_and_skips_errors(self):
+        entries = [{"q": "What is CD?", "ok": True}, {"q": "what is  cd", "ok": True}, {"q": "What is CD?", "ok": True},
+                   {"q": "Who am I", "ok": True}, {"q": "broken", "ok": False}, {"q": "broken", "ok": False}]
+        self.assertEqual(top_queries(entries, 5), [{"query": "What is CD?", "count": 3},
+                                                   {"query": "Who am I", "count": 1}])
+
+    def test_warm_runs_every_query(self):
+        doc_store = FakeDocumentStore()
+        status = warm(doc_store, ["one", "broken", "two"])
+        self.assertEqual(doc_store.asked, ["one", "two"])
+        self.assertEqual((status["queries"], status["failed"]), (3, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from sharding import balanced_shard_map, merge_results, parse_addresses, shard_for
+
+
+def result(ids, distances):
+    return {"ids": [ids], "distances": [distances], "documents": [[f"doc {i}" for i in ids]],
+            "metadatas": [[{"id": i} for i in ids]]}
+
+
+class ShardingTests(unittest.TestCase):
+    def test_parse_addresses(self):
+        self.assertEqual(parse_addresses("localhost:8100, db:8101,:8102"),
+                         [("localhost", 8100), ("db", 8101), ("localhost", 8102)])
+
+    def test_shard_for_is_stable_and_pins_categories(self):
+        self.assertEqual(shard_for("categories", 4), 0)
+        self.assertEqual(shard_for("delivery", 4), shard_for("delivery", 4))
+        self.assertEqual(shard_for("delivery", 4, {"delivery": 3}), 3)
+        # A map entry for a shard that no longer exists falls back to hashing
+        self.assertLess(shard_for("delivery", 2, {"delivery": 3}), 2)
+
+    def test_merge_results_orders_by_distance(self):
+        merged = merge_results([result(["a", "b"], [0.4, 0.9]), None, result(["c"], [0.1])], 2)
+        self.assertEqual(merged["ids"], [["c", "a"]])
+        self.assertEqual(merged["distances"], [[0.1, 0.4]])
+        self.assertEqual(merged["documents"], [["doc c", "doc a"]])
+
+    def test_balanced_shard_map(self):
+        shard_map = balanced_shard_map({"categories": 10, "a": 100, "b": 60, "c": 50}, 2)
+        self.assertNotIn("categories", shard_map)
+        # categories already weighs on shard 0, so the largest collection goes to shard 1
+        self.assertEqual(shard_map, {"a": 1, "b": 0, "c": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,14 @@
+import unittest
+
+from benchmarks.startup_benchmark import LAZY_MODULES, loaded_after_import
+
+
+class StartupTests(unittest.TestCase):
+    def test_query_path_does_not_import_loaders_or_models(self):
+        # The modules main builds the service from; document loaders and the generative model load on first use
+        loaded = loaded_after_import(["ingest", "markdown_loader", "category_router", "ingest_jobs", "compact_store"])
+        self.assertEqual(loaded, [], f"Imported at startup: {loaded} (lazy modules: {LAZY_MODULES})")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from watcher import DirectoryWatcher, InotifyEvents, walk_files
+
+
+class FakeIngestor:
+    def __init__(self):
+        self.stored = set()
+        self.batches = []
+        self.lock = threading.Lock()
+        self.collection = SimpleNamespace(name="default")
+
+    def list_files(self, folder_path):
+        return [f for f in walk_files(folder_path) if f.endswith(".md")]
+
+    def stored_sources(self, folder_path):
+        with self.lock:
+            return {s for s in self.stored if s.startswith(os.path.join(folder_path, ""))}
+
+    def process_file(self, file_path, profiler=None):
+        with self.lock:
+            self.stored.add(file_path)
+            self.batches[-1].append(("ingest", file_path))
+        return 1
+
+    def remove_file(self, file_path):
+        with self.lock:
+            self.batches[-1].append(("remove", file_path))
+            if file_path in self.stored:
+                self.stored.remove(file_path)
+                return 1
+        return 0
+
+
+class FakeDocumentStore:
+    def __init__(self):
+        self.ingestor = FakeIngestor()
+        self.changes = 0
+        self.write_lock = threading.RLock()
+
+    def index_changed(self, collections=None):
+        self.changes += 1
+        self.ingestor.batches.append([])
+
+
+def inotify_available():
+    try:
+        InotifyEvents([tempfile.gettempdir()]).close()
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+class WatcherTestsMixin:
+    backend = None
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.folder.name)
+        self.write("old.md")
+        self.doc_store = FakeDocumentStore()
+        self.doc_store.ingestor.batches.append([])
+        # A source left from a file deleted while nothing was watching
+        self.doc_store.ingestor.stored.add(os.path.join(self.root, "gone.md"))
+        self.watcher = DirectoryWatcher(self.doc_store, [self.root], backend=self.backend, debounce=0.3,
+                                        max_delay=5, poll_interval=0.1).start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.folder.cleanup()
+
+    def write(self, name, text="text"):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as output_file:
+            output_file.write(text)
+        return path
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return
+            time.sleep(0.02)
+        self.fail(f"Timed out, watcher status {self.watcher.status()}")
+
+    def test_initial_sync(self):
+        self.wait_for(lambda: self.doc_store.changes == 1)
+        self.assertEqual(sorted(self.doc_store.ingestor.batches[0]),
+                         [("ingest", os.path.join(self.root, "old.md")), ("remove", os.path.join(self.root, "gone.md"))])
+
+    def test_bursts_are_coalesced(self):
+        self.wait_for(lambda: self.doc_store.changes == 1)
+        for i in range(5):
+            self.write("burst.md", f"version {i}")
+            self.write(f"nested/page-{i}.md")
+            time.sleep(0.02)
+        self.write("ignored.tmp")
+        self.wait_for(lambda: self.doc_store.changes == 2)
+        batch = self.doc_store.ingestor.batches[1]
+        # Five writes of burst.md are one ingest, and all of the burst is one index update
+        self.assertEqual(sorted(batch), [("ingest", os.path.join(self.root, "burst.md"))] +
+                         [("ingest", os.path.join(self.root, "nested", f"page-{i}.md")) for i in range(5)])
+        self.assertEqual(self.watcher.status()["last_batch"]["files_ingested"], 6)
+
+    def test_removed_files_are_deleted(self):
+        self.wait_for(lambda: self.doc_store.changes == 1)
+        os.remove(os.path.join(self.root, "old.md"))
+        self.wait_for(lambda: self.doc_store.changes == 2)
+        self.assertEqual(self.doc_store.ingestor.batches[1], [("remove", os.path.join(self.root, "old.md"))])
+        self.assertEqual(self.doc_store.ingestor.stored, set())
+
+
+class PollingWatcherTests(WatcherTestsMixin, unittest.TestCase):
+    backend = "poll"
+
+
+@unittest.skipUnless(inotify_available(), "inotify is not available")
+class InotifyWatcherTests(WatcherTestsMixin, unittest.TestCase):
+    backend = "inotify"
+
+    def test_moved_out_directory_is_deleted(self):
+        self.write("docs/a.md")
+        self.write("docs/b.md")
+        self.wait_for(lambda: self.doc_store.ingestor.stored == {os.path.join(self.root, "old.md"),
+                                                                 os.path.join(self.root, "docs", "a.md"),
+                                                                 os.path.join(self.root, "docs", "b.md")})
+        with tempfile.TemporaryDirectory() as elsewhere:
+            os.rename(os.path.join(self.root, "docs"), os.path.join(elsewhere, "docs"))
+            self.wait_for(lambda: self.doc_store.ingestor.stored == {os.path.join(self.root, "old.md")})
+        self.assertEqual(self.watcher.status()["backend"], "inotify")
+
+
+class RemovedEventTests(unittest.TestCase):
+    def test_directory_events_remove_everything_under_them(self):
+        ingestor = FakeIngestor()
+        ingestor.batches.append([])
+        ingestor.stored = {"/docs/a/x.md", "/docs/a/y.md", "/docs/ab.md"}
+        self.assertEqual(DirectoryWatcher.remove(ingestor, "/docs/a/"), 2)
+        self.assertEqual(ingestor.stored, {"/docs/ab.md"})
+        # Files of other types were never stored
+        self.assertEqual(DirectoryWatcher.remove(ingestor, "/docs/notes.swp"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
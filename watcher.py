@@ -0,0 +1,310 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from ingest import INGEST_EXTENSIONS
+from ingest_jobs import INGEST_NICE, lower_thread_priority
+from ingest_profile import IngestionProfiler
+
+# Directories kept continuously indexed, separated by ","; "" disables watching
+WATCH_DIRS = [d.strip() for d in os.environ.get("WATCH_DIRS", "").split(",") if d.strip()]
+# "inotify", "poll", or "auto" for inotify where the kernel has it
+WATCH_BACKEND = os.environ.get("WATCH_BACKEND", "auto")
+# A batch is ingested once no change has arrived for this long...
+WATCH_DEBOUNCE_SECONDS = float(os.environ.get("WATCH_DEBOUNCE_SECONDS", "2"))
+# ...or this long after its first change, so a directory that never goes quiet is still indexed
+WATCH_MAX_DELAY_SECONDS = float(os.environ.get("WATCH_MAX_DELAY_SECONDS", "30"))
+WATCH_POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", "5"))
+
+CHANGED = "changed"
+REMOVED = "removed"
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# Files are reported once they are closed after writing, not on every write
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def walk_files(directory):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            yield os.path.join(root, name)
+
+
+class InotifyEvents:
+    """
+    Change events from the Linux inotify API, called through libc with ctypes. inotify watches single directories,
+    so every subdirectory gets its own watch, including ones created while watching.
+    """
+
+    name = "inotify"
+
+    def __init__(self, directories):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        try:
+            for directory in directories:
+                self.watch_tree(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            # ENOSPC means fs.inotify.max_user_watches is used up
+            raise OSError(code, f"inotify_add_watch {directory} failed. {os.strerror(code)}")
+        self.directories[wd] = directory
+
+    def watch_tree(self, directory):
+        for root, _, _ in os.walk(directory):
+            self.watch(root)
+
+    def read(self, timeout):
+        """The (path, CHANGED or REMOVED) events within timeout seconds, or None when some were lost."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have been written into it before its watch was added
+                    self.watch_tree(path)
+                    events.extend((f, CHANGED) for f in walk_files(path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    # The trailing separator marks a directory: everything stored under it goes
+                    events.append((os.path.join(path, ""), REMOVED))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                events.append((path, CHANGED))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append((path, REMOVED))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingEvents:
+    """Change events from comparing the mtime and size of every file between scans, where inotify is missing."""
+
+    name = "poll"
+
+    def __init__(self, directories, interval=WATCH_POLL_INTERVAL):
+        self.directories = list(directories)
+        self.interval = interval
+        self.snapshot = self.scan()
+        self.next_scan = time.monotonic() + interval
+
+    def scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            for path in walk_files(directory):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def read(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait))
+        self.next_scan = time.monotonic() + self.interval
+        previous, self.snapshot = self.snapshot, self.scan()
+        events = [(path, CHANGED) for path, state in self.snapshot.items() if previous.get(path) != state]
+        events.extend((path, REMOVED) for path in previous.keys() - self.snapshot.keys())
+        return events
+
+    def close(self):
+        pass
+
+
+def make_events(directories, backend=WATCH_BACKEND, interval=WATCH_POLL_INTERVAL):
+    if backend in ("auto", "inotify"):
+        try:
+            return InotifyEvents(directories)
+        except (OSError, AttributeError) as e:
+            if backend == "inotify":
+                raise
+            print(f"make_events: inotify is not available, polling every {interval} seconds. {e}")
+    elif backend != "poll":
+        raise ValueError(f"Unknown watch backend {backend}, expected auto, inotify or poll")
+    return PollingEvents(directories, interval)
+
+
+class DirectoryWatcher:
+    """
+    Keeps local directories indexed. Change events are debounced and coalesced, then each batch re-ingests the
+    created and modified files, deletes the chunks of removed ones and updates the index once.
+    """
+
+    def __init__(self, doc_store, directories=WATCH_DIRS, backend=WATCH_BACKEND, debounce=WATCH_DEBOUNCE_SECONDS,
+                 max_delay=WATCH_MAX_DELAY_SECONDS, poll_interval=WATCH_POLL_INTERVAL, nice=INGEST_NICE):
+        self.doc_store = doc_store
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.backend = backend
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.nice = nice
+        self.events = None
+        self.ingestor = None
+        self.pending = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.batches = 0
+        self.files_ingested = 0
+        self.files_removed = 0
+        self.chunks = 0
+        self.last_batch = None
+
+    def start(self):
+        # Created before the initial sync so changes made during it are not missed
+        self.events = make_events(self.directories, self.backend, self.poll_interval)
+        self.thread = threading.Thread(target=self.run, name="watcher", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        lower_thread_priority(self.nice)
+        try:
+            self.sync()
+            first = last = None
+            while not self.stop_event.is_set():
+                events = self.events.read(self.debounce if self.pending else 1.0)
+                now = time.monotonic()
+                if events is None:
+                    # The kernel dropped events, so nothing short of a full comparison is reliable
+                    self.sync()
+                    continue
+                for path, kind in events:
+                    self.pending[path] = kind
+                    first = now if first is None else first
+                    last = now
+                if self.pending and (now - last >= self.debounce or now - first >= self.max_delay):
+                    self.flush(lag=now - first)
+                    first = last = None
+        finally:
+            self.events.close()
+
+    def sync(self):
+        """Brings the index in line with the directories: up to date files are skipped on their fingerprint."""
+        ingestor = self.doc_store.ingestor
+        self.ingestor = ingestor
+        for directory in self.directories:
+            on_disk = set(ingestor.list_files(directory))
+            for path in on_disk:
+                self.pending[path] = CHANGED
+            for path in ingestor.stored_sources(directory) - on_disk:
+                self.pending[path] = REMOVED
+        if self.pending:
+            self.flush(lag=0.0)
+
+    def flush(self, lag):
+        # A rebuild waits for the batch before it copies the index, so none of it is left behind in the old generation
+        with self.doc_store.write_lock:
+            # A new index generation was swapped in since the last batch; it has to be brought up to date first
+            if self.doc_store.ingestor is not self.ingestor:
+                self.sync()
+                return
+            batch, self.pending = self.pending, {}
+            ingestor = self.ingestor
+            profiler = IngestionProfiler("watch")
+            started = time.perf_counter()
+            ingested = removed = chunks = 0
+            for path, kind in sorted(batch.items()):
+                try:
+                    if kind == CHANGED and os.path.isfile(path):
+                        if os.path.splitext(path)[1].lower() in INGEST_EXTENSIONS:
+                            chunks += ingestor.process_file(path, profiler=profiler)
+                            ingested += 1
+                    else:
+                        removed += self.remove(ingestor, path)
+                except Exception as e:
+                    print(f"DirectoryWatcher: Updating {path} failed. {e}")
+            if chunks or removed:
+                self.doc_store.index_changed([ingestor.collection.name])
+
+        self.batches += 1
+        self.files_ingested += ingested
+        self.files_removed += removed
+        self.chunks += chunks
+        self.last_batch = {"events": len(batch), "files_ingested": ingested, "files_removed": removed,
+                           "chunks": chunks, "skipped": profiler.report()["totals"]["skipped"],
+                           "seconds": round(time.perf_counter() - started, 3),
+                           # From the first change in the batch to the index serving it
+                           "lag_seconds": round(lag + time.perf_counter() - started, 3), "finished_at": time.time()}
+
+    @staticmethod
+    def remove(ingestor, path):
+        # A directory moved out of a watched one only produces one event, for the directory itself
+        if path.endswith(os.sep):
+            paths = sorted(ingestor.stored_sources(path))
+        elif os.path.splitext(path)[1].lower() in INGEST_EXTENSIONS:
+            paths = [path]
+        else:
+            return 0
+        return sum(1 for p in paths if ingestor.remove_file(p))
+
+    def status(self):
+        return {
+            "backend": self.events.name if self.events is not None else None,
+            "directories": self.directories,
+            "running": self.thread is not None and self.thread.is_alive(),
+            "pending": len(self.pending),
+            "batches": self.batches,
+            "files_ingested": self.files_ingested,
+            "files_removed": self.files_removed,
+            "chunks": self.chunks,
+            "last_batch": self.last_batch,
+        }